@@ -0,0 +1,617 @@
+#!/usr/bin/env python
+"""Benchmarks for the GeoAlchemy datasource and FeatureServerController.
+
+Synthetic point, line and polygon layers of the requested sizes are
+created in a SpatiaLite or PostGIS database (see geobench.py) and reused
+by later runs. The following are then timed against them:
+
+select
+    GeoAlchemy.select for every combination of bbox size (as a fraction
+    of the layer extent), attribute filter and page size, with the
+    features encoded in each output format.
+write
+    create, update and delete transactions of --write-batch features.
+wsgi
+    GET requests to FeatureServerController.default through a WSGI
+    application loaded from a paste config, for the same combinations as
+    select. Only run when --app is given.
+
+Every run checks the number of features it got, and that each has a
+geometry, against a plain SQL count of the rows matching its bbox and
+filter, and stops with an AssertionError rather than timing a wrong
+answer. The layers are checked to hold the requested number of rows,
+each with a geometry, before anything is timed.
+
+Every case is run --repeat times after a warmup run and reports latency
+percentiles, rows per second and the peak resident memory of the process
+(its growth during the case is reported too, peaks of earlier cases can
+hide it). Results are written as JSON; --compare prints the change of the
+median latencies against the results of an earlier run and exits with
+status 1 if any case got slower than --threshold allows.
+
+Example::
+
+    python benchmarks/bench_featureserver.py --dburi sqlite:///geobench.db \\
+        --rows 10000,100000 --output before.json
+    python benchmarks/bench_featureserver.py --dburi sqlite:///geobench.db \\
+        --rows 10000,100000 --output after.json --compare before.json
+
+To benchmark through WSGI, the application in --app must serve the
+synthetic layers with FeatureServerControllers bound to the same
+database. --print-config prints the geo.<layer> settings to add to its
+config, with benchmarks/ on the application's sys.path. The layers are
+then requested at --url, in which {layer} is replaced by the layer name.
+"""
+
+import optparse
+import os
+import platform
+import random
+import sys
+import time
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from sqlalchemy import create_engine
+from sqlalchemy.orm import scoped_session, sessionmaker
+import sqlalchemy
+
+from FeatureServer.Server import Server
+from FeatureServer.Service import Request
+from FeatureServer.Service.Action import Action
+from vectorformats.Feature import Feature
+from vectorformats.Formats import WKT
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+import geobench
+
+from tgext.geo.featureserver.datasource import GeoAlchemy
+from tgext.geo.featureserver import streaming, binary
+
+# attribute filters, as request parameters
+FILTERS = {
+    'none': {},
+    'eq': {'category__eq': '3'},
+    'range': {'value__gte': '0.75'},
+    'like': {'name__ilike': 'ab'},
+}
+
+# the same filters as SQL conditions, for checking the selected rows
+FILTER_SQL = {
+    'none': None,
+    'eq': 'category = 3',
+    'range': 'value >= 0.75',
+    'like': "lower(name) LIKE '%ab%'",
+}
+
+FORMATS = ('features', 'geojson', 'gml', 'kml', 'wkb', 'twkb')
+
+
+def csv(value, convert=str):
+    return [convert(v.strip()) for v in value.split(',') if v.strip()]
+
+
+def peak_rss():
+    """Peak resident memory of the process in kilobytes."""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        peak //= 1024
+    return peak
+
+
+def percentile(values, fraction):
+    values = sorted(values)
+    index = int(round(fraction * (len(values) - 1)))
+    return values[index]
+
+
+def summary(latencies, rows):
+    total = sum(latencies)
+    ms = [l * 1000.0 for l in latencies]
+    return {
+        'latency_ms': {
+            'min': min(ms),
+            'p50': percentile(ms, 0.5),
+            'p90': percentile(ms, 0.9),
+            'p99': percentile(ms, 0.99),
+            'max': max(ms),
+            'mean': sum(ms) / len(ms),
+        },
+        'rows': sum(rows) / float(len(rows)),
+        'rows_per_sec': total and sum(rows) / total or 0.0,
+    }
+
+
+def measure(case, repeat, run):
+    """Time run(iteration), which returns the number of rows it handled,
+       and add the statistics to case."""
+    run(-1)
+    before = peak_rss()
+    latencies = []
+    rows = []
+    for i in range(repeat):
+        start = time.time()
+        rows.append(run(i))
+        latencies.append(time.time() - start)
+    case.update(summary(latencies, rows))
+    after = peak_rss()
+    case['peak_rss_kb'] = after
+    if before is not None:
+        case['rss_growth_kb'] = after - before
+    return case
+
+
+def bboxes(fraction, count, seed):
+    """count square bboxes covering fraction of the layer extent, at
+       random but reproducible places."""
+    extent = geobench.EXTENT
+    width = (extent[2] - extent[0]) * fraction ** 0.5
+    height = (extent[3] - extent[1]) * fraction ** 0.5
+    rnd = random.Random('%s-%s' % (seed, fraction))
+    result = []
+    for i in range(count):
+        x = rnd.uniform(extent[0], extent[2] - width)
+        y = rnd.uniform(extent[1], extent[3] - height)
+        result.append((x, y, x + width, y + height))
+    return result
+
+
+def bbox_param(bbox):
+    return ','.join(['%.6f' % c for c in bbox])
+
+
+def datasource(layer, kind, rows, session, page_sizes):
+    return GeoAlchemy(
+        layer,
+        srid = geobench.SRID,
+        fid = 'gid',
+        geometry = 'the_geom',
+        order = 'gid',
+        writable = True,
+        session = session,
+        dburi = None,
+        layer = layer,
+        model = 'geobench',
+        cls = geobench.class_name(kind, rows),
+        queryable = 'name,category,value',
+        max_features = max(page_sizes))
+
+
+def check_features(features, expected, query):
+    """Raise AssertionError unless there are expected features, each with
+       a geometry."""
+    if len(features) != expected:
+        raise AssertionError('%d features selected instead of %d for %r'
+                             % (len(features), expected, query))
+    missing = len([f for f in features if not f.geometry])
+    if missing:
+        raise AssertionError('%d of %d features have no geometry for %r'
+                             % (missing, len(features), query))
+
+
+def select_case(source, server, layer, params, expected, format):
+    """Return run(iteration) selecting and encoding the features for
+       the parameters of the iteration, which are expected[iteration]."""
+    def run(i):
+        query = params[max(i, 0)]
+        source.set_request_params(query)
+        service = Request(server)
+        service.parse(query, '/' + layer, '', None, 'GET')
+        features = []
+        try:
+            if format == 'features':
+                for action in service.actions:
+                    features.extend(source.select(action))
+                check_features(features, expected[max(i, 0)], query)
+            elif format in binary.encoders:
+                geometry_format, content_type, encoder = \
+                    binary.encoders[format]
+                for action in service.actions:
+                    features.extend(source.iter_select(action,
+                                                       geometry_format))
+                check_features(features, expected[max(i, 0)], query)
+                for chunk in encoder(features, layer, srid=source.srid):
+                    pass
+            else:
+                content_type, encoder = streaming.encoders[format]
+                for action in service.actions:
+                    features.extend(source.select(action))
+                check_features(features, expected[max(i, 0)], query)
+                for chunk in encoder(features, layer):
+                    pass
+        finally:
+            source.release()
+        return len(features)
+    return run
+
+
+def request_params(layer_bboxes, filter, page_size, repeat):
+    params = []
+    for bbox in layer_bboxes[:repeat]:
+        query = dict(FILTERS[filter])
+        query['bbox'] = bbox_param(bbox)
+        query['maxfeatures'] = str(page_size)
+        params.append(query)
+    return params
+
+
+def expected_counts(engine, cls, params, filter):
+    """The number of features each of the requests of params should
+       select, counted in SQL."""
+    counts = []
+    for query in params:
+        bbox = [float(c) for c in query['bbox'].split(',')]
+        matching = geobench.matching(engine, cls, bbox, FILTER_SQL[filter])
+        counts.append(min(matching, int(query['maxfeatures'])))
+    return counts
+
+
+def run_select(options, engine, session, layers, results, log):
+    postgres = geobench.is_postgres(engine)
+    for kind, rows, layer in layers:
+        source = datasource(layer, kind, rows, session, options.page_sizes)
+        server = Server({layer: source})
+        cls = geobench.layer_class(kind, rows, engine)
+        for fraction in options.bbox_sizes:
+            layer_bboxes = bboxes(fraction, options.repeat, options.seed)
+            for filter in options.filters:
+                for page_size in options.page_sizes:
+                    params = request_params(layer_bboxes, filter, page_size,
+                                            options.repeat)
+                    expected = expected_counts(engine, cls, params, filter)
+                    for format in options.formats:
+                        if format == 'twkb' and not postgres:
+                            continue
+                        case = {'benchmark': 'select', 'layer': kind,
+                                'table_rows': rows, 'bbox': fraction,
+                                'filter': filter, 'maxfeatures': page_size,
+                                'format': format}
+                        measure(case, options.repeat,
+                                select_case(source, server, layer, params,
+                                            expected, format))
+                        log(case)
+                        results.append(case)
+
+
+def transaction(source, actions):
+    """Run actions in one transaction, return the features handed back
+       by the datasource, completed with their ids on commit. Raises
+       AssertionError if a created feature got no id."""
+    source.set_request_params({})
+    source.begin()
+    try:
+        try:
+            results = []
+            for action in actions:
+                results.extend(getattr(source, action.method)(action))
+            source.commit()
+        except:
+            source.rollback()
+            raise
+    finally:
+        source.release()
+    missing = [r for r in results if r.id is None]
+    if missing:
+        raise AssertionError('%d of %d written features got no id'
+                             % (len(missing), len(results)))
+    return results
+
+
+def write_action(method, id=None, feature=None):
+    action = Action()
+    action.method = method
+    action.id = id
+    action.feature = feature
+    return action
+
+
+def run_write(options, engine, session, layers, results, log):
+    for kind, rows, layer in layers:
+        source = datasource(layer, kind, rows, session, options.page_sizes)
+        rnd = random.Random('%s-write-%s' % (options.seed, layer))
+        created = []
+
+        def features():
+            result = []
+            for i in range(options.write_batch):
+                values = geobench.row_values(kind, rnd)
+                wkt = values.pop('wkt')
+                result.append(Feature(None, WKT.from_wkt(wkt), values))
+            return result
+
+        def create(i):
+            actions = [write_action('create', feature=feature)
+                       for feature in features()]
+            created.extend(transaction(source, actions))
+            return len(actions)
+
+        def update(i):
+            batch = created[:options.write_batch]
+            created[:options.write_batch] = []
+            updates = features()
+            actions = []
+            for old, new in zip(batch, updates):
+                actions.append(write_action('update', old.id, new))
+            transaction(source, actions)
+            created.extend(batch)
+            return len(actions)
+
+        def delete(i):
+            batch = created[:options.write_batch]
+            created[:options.write_batch] = []
+            transaction(source, [write_action('delete', feature.id)
+                                 for feature in batch])
+            return len(batch)
+
+        # update and delete work on the features written by create, and
+        # delete removes all of them again
+        cls = geobench.layer_class(kind, rows, engine)
+        written = rows + (options.repeat + 1) * options.write_batch
+        for name, run, table_rows in (('create', create, written),
+                                      ('update', update, written),
+                                      ('delete', delete, rows)):
+            case = {'benchmark': 'write', 'layer': kind, 'table_rows': rows,
+                    'operation': name, 'batch': options.write_batch}
+            measure(case, options.repeat, run)
+            geobench.check(engine, cls, table_rows)
+            log(case)
+            results.append(case)
+
+
+def run_wsgi(options, engine, layers, results, log):
+    from paste.deploy import loadapp
+    from webtest import TestApp
+    app = TestApp(loadapp(options.app, relative_to=os.getcwd()))
+    extensions = {'features': 'geojson'}
+    for kind, rows, layer in layers:
+        url = options.url.replace('{layer}', layer)
+        cls = geobench.layer_class(kind, rows, engine)
+        for fraction in options.bbox_sizes:
+            layer_bboxes = bboxes(fraction, options.repeat, options.seed)
+            for filter in options.filters:
+                for page_size in options.page_sizes:
+                    params = request_params(layer_bboxes, filter, page_size,
+                                            options.repeat)
+                    for format in options.formats:
+                        format = extensions.get(format, format)
+                        if format == 'twkb':
+                            continue
+
+                        expected = expected_counts(engine, cls, params,
+                                                   filter)
+
+                        def run(i, format=format, params=params,
+                                expected=expected):
+                            query = dict(params[max(i, 0)])
+                            query['format'] = format
+                            response = app.get(url, params=query)
+                            if i < 0 and format == 'geojson':
+                                # checked once, parsing would be timed
+                                features = [Feature(f.get('id'),
+                                                    f.get('geometry'))
+                                            for f in json.loads(
+                                                response.body)['features']]
+                                check_features(features, expected[0], query)
+                            return len(response.body)
+                        case = {'benchmark': 'wsgi', 'layer': kind,
+                                'table_rows': rows, 'bbox': fraction,
+                                'filter': filter, 'maxfeatures': page_size,
+                                'format': format}
+                        measure(case, options.repeat, run)
+                        # run returns response sizes, not rows
+                        case['bytes'] = case.pop('rows')
+                        case['bytes_per_sec'] = case.pop('rows_per_sec')
+                        log(case)
+                        results.append(case)
+
+
+def print_config(layers):
+    for kind, rows, layer in layers:
+        print 'geo.%s.model = geobench' % layer
+        print 'geo.%s.cls = %s' % (layer, geobench.class_name(kind, rows))
+        print 'geo.%s.table = %s' % (layer, geobench.table_name(kind, rows))
+        print 'geo.%s.srid = %d' % (layer, geobench.SRID)
+        print 'geo.%s.writable = false' % layer
+
+
+RESULT_FIELDS = ('latency_ms', 'rows', 'rows_per_sec', 'bytes',
+                 'bytes_per_sec', 'peak_rss_kb', 'rss_growth_kb')
+
+
+def case_key(case):
+    """The parameters identifying a case across runs."""
+    return tuple(sorted([(k, v) for k, v in case.items()
+                         if k not in RESULT_FIELDS]))
+
+
+def compare(results, path, threshold):
+    """Print the median latency of every case relative to the run saved
+       in path, return whether none regressed by more than threshold."""
+    baseline = dict([(case_key(case), case)
+                     for case in json.load(open(path))['results']])
+    ok = True
+    for case in results:
+        old = baseline.get(case_key(case))
+        if old is None:
+            continue
+        before = old['latency_ms']['p50']
+        after = case['latency_ms']['p50']
+        ratio = before and after / before or 1.0
+        flag = ''
+        if ratio > 1.0 + threshold:
+            flag = '  REGRESSION'
+            ok = False
+        print '%-70s %9.2fms %9.2fms %+6.1f%%%s' % (
+            describe(case), before, after, (ratio - 1.0) * 100, flag)
+    return ok
+
+
+def describe(case):
+    keys = ('benchmark', 'layer', 'table_rows', 'operation', 'bbox',
+            'filter', 'maxfeatures', 'format')
+    return ' '.join(['%s' % case[k] for k in keys if k in case])
+
+
+def metadata(options):
+    try:
+        import pkg_resources
+        version = pkg_resources.get_distribution('tgext.geo').version
+    except Exception:
+        version = None
+    dburi = options.dburi
+    if '@' in dburi:
+        # keep credentials out of the results
+        scheme, rest = dburi.split('://', 1)
+        dburi = '%s://***@%s' % (scheme, rest.split('@', 1)[1])
+    return {
+        'tgext.geo': version,
+        'sqlalchemy': sqlalchemy.__version__,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'dburi': dburi,
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'options': {
+            'rows': options.rows, 'kinds': options.kinds,
+            'bbox_sizes': options.bbox_sizes, 'filters': options.filters,
+            'page_sizes': options.page_sizes, 'formats': options.formats,
+            'repeat': options.repeat, 'write_batch': options.write_batch,
+            'seed': options.seed,
+        },
+    }
+
+
+def parse_args(argv):
+    parser = optparse.OptionParser(usage='%prog [options]',
+                                   description=__doc__.splitlines()[0])
+    parser.add_option('--dburi', default='sqlite:///geobench.db',
+                      help='database of the synthetic layers')
+    parser.add_option('--spatialite', default='mod_spatialite',
+                      help='SpatiaLite extension loaded into SQLite '
+                           'connections')
+    parser.add_option('--rows', default='10000',
+                      help='comma separated layer sizes, e.g. '
+                           '10000,1000000,10000000')
+    parser.add_option('--kinds', default=','.join(geobench.KINDS),
+                      help='geometry types of the layers')
+    parser.add_option('--benchmarks', default='select,write',
+                      help='select, write and/or wsgi')
+    parser.add_option('--bbox-sizes', default='0.0001,0.001,0.01',
+                      help='bbox areas as fractions of the layer extent')
+    parser.add_option('--filters', default='none,eq,range',
+                      help='attribute filters, of %s'
+                           % ', '.join(sorted(FILTERS)))
+    parser.add_option('--page-sizes', default='100,1000',
+                      help='maxfeatures values')
+    parser.add_option('--formats', default='features,geojson,wkb',
+                      help='output formats, of %s' % ', '.join(FORMATS))
+    parser.add_option('--repeat', type='int', default=20,
+                      help='timed runs of every case')
+    parser.add_option('--write-batch', type='int', default=100,
+                      help='features written per transaction')
+    parser.add_option('--seed', default='0',
+                      help='seed of the generated data and bboxes')
+    parser.add_option('--app', default=None,
+                      help='paste config of the application for the wsgi '
+                           'benchmark, e.g. config:development.ini')
+    parser.add_option('--url', default='/{layer}/all',
+                      help='path of the layers in the application')
+    parser.add_option('--print-config', action='store_true',
+                      help='print the layer settings for --app and exit')
+    parser.add_option('-o', '--output', default='geobench.json',
+                      help='JSON results file, - for standard output')
+    parser.add_option('--compare', default=None,
+                      help='JSON results of an earlier run to compare to')
+    parser.add_option('--threshold', type='float', default=0.1,
+                      help='median latency increase counted as a '
+                           'regression by --compare')
+    parser.add_option('-q', '--quiet', action='store_true')
+    options, args = parser.parse_args(argv)
+    options.rows = csv(options.rows, int)
+    options.kinds = csv(options.kinds)
+    options.benchmarks = csv(options.benchmarks)
+    options.bbox_sizes = csv(options.bbox_sizes, float)
+    options.filters = csv(options.filters)
+    options.page_sizes = csv(options.page_sizes, int)
+    options.formats = csv(options.formats)
+    for name, values, known in (('kind', options.kinds, geobench.KINDS),
+                                ('filter', options.filters, FILTERS),
+                                ('format', options.formats, FORMATS)):
+        for value in values:
+            if value not in known:
+                parser.error('unknown %s %s' % (name, value))
+    if options.repeat < 1:
+        parser.error('--repeat must be at least 1')
+    if 'wsgi' in options.benchmarks and not options.app:
+        parser.error('the wsgi benchmark needs --app')
+    return options
+
+
+def main(argv=None):
+    options = parse_args(argv)
+    layers = [(kind, rows, geobench.table_name(kind, rows))
+              for rows in options.rows for kind in options.kinds]
+
+    def log(message):
+        if options.quiet:
+            return
+        if isinstance(message, dict):
+            message = '%-70s p50 %9.2fms  p99 %9.2fms  %10.0f rows/s' % (
+                describe(message), message['latency_ms']['p50'],
+                message['latency_ms']['p99'],
+                message.get('rows_per_sec', message.get('bytes_per_sec')))
+        print >> sys.stderr, message
+
+    engine_options = {}
+    if options.dburi.startswith('sqlite'):
+        engine_options['listeners'] = [
+            geobench.SpatialiteListener(options.spatialite)]
+    engine = create_engine(options.dburi, **engine_options)
+    for kind, rows, layer in layers:
+        geobench.layer_class(kind, rows, engine)
+    if options.print_config:
+        print_config(layers)
+        return 0
+
+    geobench.init_spatialite(engine)
+    for kind, rows, layer in layers:
+        geobench.load(engine, kind, rows, options.seed, log=log)
+    session = scoped_session(sessionmaker(bind=engine))
+
+    results = []
+    if 'select' in options.benchmarks:
+        run_select(options, engine, session, layers, results, log)
+    if 'write' in options.benchmarks:
+        run_write(options, engine, session, layers, results, log)
+    if 'wsgi' in options.benchmarks:
+        run_wsgi(options, engine, layers, results, log)
+
+    output = json.dumps({'metadata': metadata(options), 'results': results},
+                        indent=2, sort_keys=True)
+    if options.output == '-':
+        print output
+    else:
+        out = open(options.output, 'w')
+        try:
+            out.write(output)
+        finally:
+            out.close()
+        log('results written to %s' % options.output)
+
+    if options.compare:
+        if not compare(results, options.compare, options.threshold):
+            return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
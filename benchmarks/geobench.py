@@ -0,0 +1,222 @@
+"""Synthetic layers for the tgext.geo benchmarks.
+
+Each layer is a GeoAlchemy mapped class over a table of random points,
+lines or polygons, generated from a fixed seed so that runs against
+different versions of tgext.geo read the same data. The classes are
+created on demand and set as attributes of this module, which is the
+model the GeoAlchemy datasource imports them from (model = geobench).
+"""
+
+import math
+import random
+
+from sqlalchemy import Column, Integer, Float, Unicode, func, bindparam, \
+    text
+from sqlalchemy.ext.declarative import declarative_base
+from geoalchemy import GeometryColumn, GeometryDDL, Point, LineString, \
+    Polygon
+
+try:
+    from sqlalchemy.interfaces import PoolListener
+except ImportError:
+    PoolListener = object
+
+Base = declarative_base()
+
+SRID = 4326
+EXTENT = (-180.0, -90.0, 180.0, 90.0)
+KINDS = ('point', 'line', 'polygon')
+
+_geometry_types = {
+    'point': Point,
+    'line': LineString,
+    'polygon': Polygon,
+}
+
+
+class SpatialiteListener(PoolListener):
+    """Load the SpatiaLite extension into every new SQLite connection."""
+
+    def __init__(self, library='mod_spatialite'):
+        self.library = library
+
+    def connect(self, dbapi_con, con_record):
+        dbapi_con.enable_load_extension(True)
+        dbapi_con.execute("SELECT load_extension('%s')" % self.library)
+
+
+def is_postgres(engine):
+    return engine.dialect.name in ('postgres', 'postgresql')
+
+
+def comparator(engine):
+    """GeoAlchemy comparator providing the spatial operators on engine."""
+    if is_postgres(engine):
+        from geoalchemy.postgis import PGComparator
+        return PGComparator
+    from geoalchemy.spatialite import SQLiteComparator
+    return SQLiteComparator
+
+
+def init_spatialite(engine):
+    """Create the SpatiaLite metadata tables of a new database."""
+    if is_postgres(engine):
+        return
+    tables = engine.execute("SELECT name FROM sqlite_master WHERE "
+                            "name = 'geometry_columns'").fetchall()
+    if tables:
+        return
+    try:
+        engine.execute("SELECT InitSpatialMetadata(1)")
+    except Exception:
+        engine.execute("SELECT InitSpatialMetadata()")
+
+
+def class_name(kind, rows):
+    return 'Geobench%s%d' % (kind.capitalize(), rows)
+
+
+def table_name(kind, rows):
+    return 'geobench_%s_%d' % (kind, rows)
+
+
+def layer_class(kind, rows, engine):
+    """Return the mapped class of the kind layer with rows rows, created
+       on first use."""
+    name = class_name(kind, rows)
+    cls = globals().get(name)
+    if cls is None:
+        cls = type(name, (Base,), {
+            '__tablename__': table_name(kind, rows),
+            'gid': Column(Integer, primary_key=True),
+            'name': Column(Unicode(16)),
+            'category': Column(Integer),
+            'value': Column(Float),
+            'the_geom': GeometryColumn(
+                _geometry_types[kind](2, srid=SRID),
+                comparator=comparator(engine)),
+        })
+        GeometryDDL(cls.__table__)
+        globals()[name] = cls
+    return cls
+
+
+def _coords(coords):
+    return ', '.join(['%.6f %.6f' % c for c in coords])
+
+
+def _clamp(x, y):
+    return (min(max(x, EXTENT[0]), EXTENT[2]),
+            min(max(y, EXTENT[1]), EXTENT[3]))
+
+
+def geometry_wkt(kind, rnd):
+    """A random geometry of kind as WKT."""
+    x = rnd.uniform(EXTENT[0], EXTENT[2])
+    y = rnd.uniform(EXTENT[1], EXTENT[3])
+    if kind == 'point':
+        return 'POINT(%.6f %.6f)' % (x, y)
+    step = (EXTENT[2] - EXTENT[0]) * 0.0005
+    if kind == 'line':
+        coords = [(x, y)]
+        for i in range(9):
+            x, y = _clamp(x + rnd.uniform(-step, step),
+                          y + rnd.uniform(-step, step))
+            coords.append((x, y))
+        return 'LINESTRING(%s)' % _coords(coords)
+    coords = []
+    for i in range(12):
+        angle = 2 * math.pi * i / 12
+        radius = step * rnd.uniform(0.5, 1.0)
+        coords.append(_clamp(x + radius * math.cos(angle),
+                             y + radius * math.sin(angle)))
+    coords.append(coords[0])
+    return 'POLYGON((%s))' % _coords(coords)
+
+
+def row_values(kind, rnd):
+    return {
+        'name': u''.join([rnd.choice(u'abcdefghij') for i in range(8)]),
+        'category': rnd.randint(0, 9),
+        'value': rnd.random(),
+        'wkt': geometry_wkt(kind, rnd),
+    }
+
+
+def count(engine, cls):
+    table = cls.__table__
+    if not table.exists(bind=engine):
+        return None
+    return engine.execute(table.count()).scalar()
+
+
+def geometry_count(engine, cls):
+    table = cls.__table__
+    return engine.execute(table.count().where(
+        table.c.the_geom != None)).scalar()
+
+
+def check(engine, cls, rows):
+    """Raise AssertionError unless the table of cls holds rows rows, each
+       with a geometry, so no timing is reported for a partly loaded
+       layer or geometries the database failed to parse."""
+    found = count(engine, cls)
+    if found != rows:
+        raise AssertionError('%s holds %s rows instead of %d'
+                             % (cls.__tablename__, found, rows))
+    geometries = geometry_count(engine, cls)
+    if geometries != rows:
+        raise AssertionError('%s has %d geometries for %d rows'
+                             % (cls.__tablename__, geometries, rows))
+
+
+def matching(engine, cls, bbox, where=None):
+    """Number of rows of cls whose geometry intersects bbox and that
+       match the SQL condition where, counted in plain SQL to check the
+       features the datasource returns."""
+    if is_postgres(engine):
+        intersects = ('ST_Intersects(the_geom, ST_MakeEnvelope(:minx, '
+                      ':miny, :maxx, :maxy, %d))' % SRID)
+    else:
+        intersects = ('Intersects(the_geom, BuildMbr(:minx, :miny, :maxx, '
+                      ':maxy, %d)) = 1' % SRID)
+    sql = 'SELECT count(*) FROM %s WHERE %s' % (cls.__tablename__,
+                                                 intersects)
+    if where:
+        sql += ' AND %s' % where
+    return engine.execute(text(sql), minx=bbox[0], miny=bbox[1],
+                          maxx=bbox[2], maxy=bbox[3]).scalar()
+
+
+def load(engine, kind, rows, seed=0, batch=10000, log=None):
+    """Create the table of the kind layer with rows rows and fill it,
+       unless it already holds that many rows."""
+    cls = layer_class(kind, rows, engine)
+    table = cls.__table__
+    existing = count(engine, cls)
+    if existing == rows:
+        check(engine, cls, rows)
+        return cls
+    if existing is not None:
+        table.drop(bind=engine)
+    table.create(bind=engine)
+    name = is_postgres(engine) and 'ST_GeomFromText' or 'GeomFromText'
+    insert = table.insert().values(
+        the_geom=getattr(func, name)(bindparam('wkt'), SRID))
+    rnd = random.Random('%s-%s-%s' % (seed, kind, rows))
+    done = 0
+    while done < rows:
+        size = min(batch, rows - done)
+        connection = engine.connect()
+        transaction = connection.begin()
+        connection.execute(insert,
+                           [row_values(kind, rnd) for i in range(size)])
+        transaction.commit()
+        connection.close()
+        done += size
+        if log:
+            log('%s: %d/%d rows' % (table.name, done, rows))
+    if is_postgres(engine):
+        engine.execute('ANALYZE %s' % table.name)
+    check(engine, cls, rows)
+    return cls
@@ -26,6 +26,9 @@ setup(name='tgext.geo',
       geo-model = tgext.geo.commands:TGGeoModelCommand
       geo-layer = tgext.geo.commands:TGGeoLayerCommand
       geo-tilecache = tgext.geo.commands:TGGeoTileCacheCommand
+      geo-vectortile = tgext.geo.commands:TGGeoVectorTileCommand
+      geo-tilecache-seed = tgext.geo.commands:TGGeoTileCacheSeedCommand
+      geo-explain = tgext.geo.commands:TGGeoExplainCommand
       """,
       )
 
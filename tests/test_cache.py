@@ -0,0 +1,84 @@
+"""The LRU cache shared by the feature and tile services."""
+
+import unittest
+
+from tgext.geo import cache
+from tgext.geo.cache import LRUCache
+
+
+class Clock(object):
+    """Stands in for the time module of tgext.geo.cache."""
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+class LRUCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+        self.time = cache.time
+        cache.time = self.clock
+
+    def tearDown(self):
+        cache.time = self.time
+
+    def test_get_set(self):
+        lru = LRUCache()
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.get('a', 1), 1)
+        lru.set('a', 'A')
+        self.assertEqual(lru.get('a'), 'A')
+        lru.set('a', 'B')
+        self.assertEqual(lru.get('a'), 'B')
+        self.assertEqual(lru.stats(), {'entries': 1, 'bytes': 1, 'hits': 2,
+                                       'misses': 2, 'evictions': 0})
+
+    def test_evicts_least_recently_used(self):
+        lru = LRUCache(max_entries=2)
+        lru.set('a', 'A')
+        lru.set('b', 'B')
+        lru.get('a')
+        lru.set('c', 'C')
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.get('a'), 'A')
+        self.assertEqual(lru.get('c'), 'C')
+        self.assertEqual(lru.stats()['evictions'], 1)
+
+    def test_memory_budget(self):
+        lru = LRUCache(max_entries=0, max_bytes=100)
+        lru.set('a', 'A', 60)
+        lru.set('b', 'B', 30)
+        self.assertEqual(lru.stats()['bytes'], 90)
+        lru.set('c', 'C', 30)
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.stats()['bytes'], 60)
+        # larger than the whole budget, never stored
+        lru.set('d', 'D', 101)
+        self.assertEqual(lru.get('d'), None)
+        self.assertEqual(lru.get('b'), 'B')
+
+    def test_ttl(self):
+        lru = LRUCache(ttl=10)
+        lru.set('a', 'A')
+        self.clock.now += 9
+        self.assertEqual(lru.get('a'), 'A')
+        self.clock.now += 2
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.stats()['entries'], 0)
+
+    def test_delete_and_clear(self):
+        lru = LRUCache()
+        lru.set('a', 'A', 5)
+        lru.set('b', 'B', 5)
+        lru.delete('a')
+        lru.delete('missing')
+        self.assertEqual(lru.get('a'), None)
+        self.assertEqual(lru.stats()['bytes'], 5)
+        lru.clear()
+        self.assertEqual(lru.get('b'), None)
+        self.assertEqual(lru.stats()['entries'], 0)
+        self.assertEqual(lru.stats()['bytes'], 0)
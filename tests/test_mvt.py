@@ -0,0 +1,182 @@
+"""Mapbox vector tile encoding, and the tile features of the datasource."""
+
+import unittest
+
+from sqlalchemy import Column, Integer, Unicode, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from geoalchemy import GeometryColumn, Geometry
+from geoalchemy.spatialite import SQLiteComparator
+from vectorformats.Feature import Feature
+
+from tgext.geo.featureserver import mvt, wkb
+from tgext.geo.featureserver.datasource import GeoAlchemy
+
+Base = declarative_base()
+
+
+class Area(Base):
+    __tablename__ = 'areas'
+    gid = Column(Integer, primary_key=True)
+    name = Column(Unicode(16))
+    the_geom = GeometryColumn(Geometry(2, srid=3857),
+                              comparator=SQLiteComparator)
+
+
+BBOX = (0, 0, 4096, 4096)
+SQUARE = [[0, 0], [0, 10], [10, 10], [10, 0], [0, 0]]
+FAR_SQUARE = [[100, 100], [100, 110], [110, 110], [110, 100], [100, 100]]
+MULTIPOLYGON = {'type': 'MultiPolygon', 'coordinates': [[SQUARE],
+                                                        [FAR_SQUARE]]}
+COLLECTION = {'type': 'GeometryCollection', 'geometries': [
+    {'type': 'Point', 'coordinates': [50, 50]},
+    {'type': 'LineString', 'coordinates': [[0, 0], [20, 0]]},
+    {'type': 'Polygon', 'coordinates': [SQUARE]}]}
+
+
+def varints(data):
+    """Decode a run of protobuf varints."""
+    values = []
+    value = shift = 0
+    for char in data:
+        byte = ord(char)
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def points(commands):
+    """The absolute tile coordinates of the points of a single ring or
+       line in geometry commands."""
+    result = []
+    x = y = 0
+    index = 0
+    while index < len(commands):
+        command, count = commands[index] & 0x7, commands[index] >> 3
+        index += 1
+        if command == mvt.CLOSE_PATH:
+            continue
+        for i in range(count):
+            dx, dy = commands[index:index + 2]
+            x += (dx >> 1) ^ -(dx & 1)
+            y += (dy >> 1) ^ -(dy & 1)
+            result.append((x, y))
+            index += 2
+    return result
+
+
+class TileGeometryTest(unittest.TestCase):
+
+    def encode(self, geometry):
+        return mvt.TileGeometry(BBOX).encode(geometry)
+
+    def test_point(self):
+        self.assertEqual(self.encode({'type': 'Point',
+                                      'coordinates': [1, 4095]}),
+                         (mvt.POINT, [mvt._command(mvt.MOVE_TO, 1), 2, 2]))
+
+    def test_line_drops_repeated_points(self):
+        gtype, commands = self.encode({'type': 'LineString', 'coordinates':
+                                       [[0, 4096], [0.2, 4096], [3, 4096]]})
+        self.assertEqual(gtype, mvt.LINESTRING)
+        self.assertEqual(commands, [mvt._command(mvt.MOVE_TO, 1), 0, 0,
+                                    mvt._command(mvt.LINE_TO, 1), 6, 0])
+
+    def test_multipolygon(self):
+        gtype, commands = self.encode(MULTIPOLYGON)
+        self.assertEqual(gtype, mvt.POLYGON)
+        self.assertEqual(commands.count(mvt._command(mvt.CLOSE_PATH, 1)), 2)
+
+    def test_collection_keeps_polygons(self):
+        self.assertEqual(self.encode(COLLECTION),
+                         self.encode({'type': 'Polygon',
+                                      'coordinates': [SQUARE]}))
+
+    def test_collection_of_points(self):
+        gtype, commands = self.encode({'type': 'GeometryCollection',
+            'geometries': [{'type': 'Point', 'coordinates': [1, 4095]},
+                           {'type': 'Point', 'coordinates': [2, 4095]}]})
+        self.assertEqual(gtype, mvt.POINT)
+        self.assertEqual(commands[0], mvt._command(mvt.MOVE_TO, 2))
+
+    def test_collapsed(self):
+        self.assertEqual(self.encode({'type': 'Polygon', 'coordinates':
+            [[[0, 0], [0, 0.1], [0.1, 0.1], [0, 0]]]}), None)
+
+    def test_ring_orientation(self):
+        for ring in (SQUARE, list(reversed(SQUARE))):
+            gtype, commands = self.encode({'type': 'Polygon',
+                                           'coordinates': [ring]})
+            self.assertTrue(mvt.area(points(commands)) > 0)
+
+
+class EncodeTest(unittest.TestCase):
+
+    def test_layer(self):
+        features = [Feature(1, MULTIPOLYGON, {'name': u'a', 'none': None}),
+                    Feature(2, {'type': 'Point', 'coordinates': [5, 5]},
+                            {'name': u'a'})]
+        tile = mvt.encode([('areas', features, BBOX, 4096)])
+        self.assertEqual(tile[0], '\x1a')
+        self.assertTrue('areas' in tile)
+        # the shared key and value are written once
+        self.assertEqual(tile.count('name'), 1)
+        self.assertEqual(tile.count('none'), 0)
+        self.assertTrue(tile.endswith(mvt._uint(5, 4096)))
+
+    def test_zigzag(self):
+        self.assertEqual([mvt._zigzag(v) for v in (0, -1, 1, -2)],
+                         [0, 1, 2, 3])
+        self.assertEqual(varints(mvt._varint(300)), [300])
+
+
+class IterTileTest(unittest.TestCase):
+    """iter_tile reads WKB whatever the layer's geometry_decoder is."""
+
+    def setUp(self):
+        engine = create_engine('sqlite://')
+        self.session = sessionmaker(bind=engine)()
+        self.datasource = GeoAlchemy('areas', srid=3857, fid='gid',
+                                     geometry='the_geom', order='gid',
+                                     session=self.session, dburi=None,
+                                     layer='areas', model=__name__,
+                                     cls='Area')
+        self.datasource._spatial_index = False
+        self.queries = []
+
+    def tearDown(self):
+        self.session.close()
+
+    def execute(self, rows):
+        def execute(query):
+            self.queries.append(str(query.statement.compile(
+                bind=self.session.bind)))
+            return rows
+        self.datasource.execute = execute
+
+    def tile_geometries(self, geometry_decoder):
+        self.datasource.geometry_decoder = geometry_decoder
+        self.execute([(1, u'multi', wkb.encode(MULTIPOLYGON)),
+                      (2, u'collection', wkb.encode(COLLECTION))])
+        self.datasource.set_request_params({})
+        return [feature.geometry for feature in
+                self.datasource.iter_tile(0, 0, 0)]
+
+    def test_wkt_layer(self):
+        multi, collection = self.tile_geometries('wkt')
+        self.assertTrue('AsBinary(' in self.queries[0])
+        self.assertTrue('AsText(' not in self.queries[0])
+        self.assertEqual(multi['type'], 'MultiPolygon')
+        self.assertEqual(len(multi['coordinates']), 2)
+        self.assertEqual(multi['coordinates'][1][0], FAR_SQUARE)
+        self.assertEqual(collection['type'], 'GeometryCollection')
+        self.assertEqual([g['type'] for g in collection['geometries']],
+                         ['Point', 'LineString', 'Polygon'])
+
+    def test_wkb_layer(self):
+        multi, collection = self.tile_geometries('wkb')
+        self.assertEqual(len(multi['coordinates']), 2)
+        self.assertEqual(len(collection['geometries']), 3)
@@ -0,0 +1,136 @@
+"""Row to Feature mapping of the FeatureProjector."""
+
+import datetime
+import decimal
+import unittest
+
+from sqlalchemy import Column, Date, DateTime, Float, Integer, Numeric, \
+    Unicode
+from sqlalchemy.ext.declarative import declarative_base
+from geoalchemy import GeometryColumn, Point
+
+from tgext.geo.featureserver.projector import FeatureProjector, names
+
+Base = declarative_base()
+
+
+class Road(Base):
+    __tablename__ = 'roads'
+    gid = Column(Integer, primary_key=True)
+    name = Column(Unicode(32))
+    lanes = Column(Integer)
+    width = Column(Float)
+    toll = Column(Numeric(6, 2))
+    opened = Column(Date)
+    surveyed = Column(DateTime)
+    the_geom = GeometryColumn(Point(2, srid=4326))
+
+
+class Resolver(object):
+
+    def resolve(self, model, cls):
+        return globals()[cls]
+
+
+class Layer(object):
+    """The datasource settings the projector reads."""
+
+    registry = Resolver()
+    model = __name__
+    cls = 'Road'
+    geom_cls = None
+    encoding = 'utf-8'
+    fid_col = 'gid'
+    geom_col = 'the_geom'
+    attribute_cols = '*'
+    attribute_ignore = []
+    order = 'gid'
+
+    def __init__(self, **settings):
+        self.__dict__.update(settings)
+
+
+class NamesTest(unittest.TestCase):
+
+    def test_string(self):
+        self.assertEqual(names(' a, b ,,c'), ['a', 'b', 'c'])
+
+    def test_sequence(self):
+        self.assertEqual(names(('a', 'b')), ['a', 'b'])
+        self.assertEqual(names(None), [])
+
+
+class FeatureProjectorTest(unittest.TestCase):
+
+    def plan_names(self, plan):
+        return [col for attribute, col, convert in plan]
+
+    def test_plan_skips_fid_and_geometry(self):
+        projector = FeatureProjector(Layer())
+        self.assertEqual(self.plan_names(projector.plan),
+                         ['name', 'lanes', 'width', 'toll', 'opened',
+                          'surveyed'])
+
+    def test_attribute_cols_and_ignore(self):
+        projector = FeatureProjector(Layer(attribute_cols='name, lanes, toll',
+                                           attribute_ignore='toll'))
+        self.assertEqual(self.plan_names(projector.plan), ['name', 'lanes'])
+
+    def test_select_plan(self):
+        projector = FeatureProjector(Layer())
+        self.assertTrue(projector.select_plan() is projector.plan)
+        plan = projector.select_plan('lanes,name,missing')
+        self.assertEqual(self.plan_names(plan), ['name', 'lanes'])
+        self.assertTrue(
+            projector.select_plan(['missing', 'name', 'lanes']) is plan)
+
+    def test_columns(self):
+        projector = FeatureProjector(Layer())
+        plan = projector.select_plan('name')
+        self.assertEqual(projector.columns(plan),
+                         [Road.gid, Road.name])
+        projector = FeatureProjector(Layer(order='lanes'))
+        self.assertEqual(projector.columns(plan),
+                         [Road.gid, Road.name, Road.lanes])
+
+    def test_feature(self):
+        projector = FeatureProjector(Layer())
+        row = (7, 'Main', 2, 3.5, decimal.Decimal('1.50'),
+               datetime.date(2001, 2, 3),
+               datetime.datetime(2001, 2, 3, 4, 5, 6), 'POINT(1 2)')
+        feature = projector.feature(row)
+        self.assertEqual(feature.id, 7)
+        self.assertEqual(feature.sort_key, 7)
+        self.assertEqual(feature.geometry['type'], 'Point')
+        self.assertEqual(feature.properties, {
+            'name': u'Main', 'lanes': 2, 'width': 3.5, 'toll': u'1.50',
+            'opened': '2001-02-03', 'surveyed': '2001-02-03 04:05:06'})
+        self.assertTrue(isinstance(feature.properties['name'], unicode))
+
+    def test_feature_order_and_nulls(self):
+        projector = FeatureProjector(Layer(order='name'))
+        plan = projector.select_plan('toll')
+        feature = projector.feature((7, None, 'Main', 'POINT(1 2)'),
+                                    plan=plan)
+        self.assertEqual(feature.properties, {'toll': None})
+        self.assertEqual(feature.sort_key, 'Main')
+
+    def test_feature_without_geometry(self):
+        projector = FeatureProjector(Layer())
+        plan = projector.select_plan('name')
+        self.assertEqual(projector.feature((7, 'Main', None), plan=plan),
+                         None)
+
+    def test_feature_undecoded(self):
+        projector = FeatureProjector(Layer())
+        plan = projector.select_plan('name')
+        feature = projector.feature((7, 'Main', 'raw'), decode=None,
+                                    plan=plan)
+        self.assertEqual(feature.geometry, 'raw')
+
+    def test_feature_empty_geometry(self):
+        projector = FeatureProjector(Layer())
+        plan = projector.select_plan('name')
+        self.assertEqual(projector.feature((7, 'Main', 'raw'),
+                                           decode=lambda data: None,
+                                           plan=plan), None)
@@ -0,0 +1,123 @@
+"""Selects from a real SpatiaLite layer through the GeoAlchemy datasource.
+
+Skipped when SQLite cannot load the mod_spatialite extension.
+"""
+
+import unittest
+
+from sqlalchemy import Column, Integer, Unicode, create_engine
+from sqlalchemy.ext.declarative import declarative_base
+from sqlalchemy.orm import sessionmaker
+from geoalchemy import GeometryColumn, GeometryDDL, Point, Polygon, \
+    WKTSpatialElement
+from geoalchemy.spatialite import SQLiteComparator
+
+try:
+    from sqlalchemy.interfaces import PoolListener
+except ImportError:
+    PoolListener = object
+
+from FeatureServer.Service import Action
+
+from tgext.geo.featureserver.datasource import GeoAlchemy
+
+Base = declarative_base()
+
+
+class Spot(Base):
+    __tablename__ = 'spots'
+    gid = Column(Integer, primary_key=True)
+    name = Column(Unicode(16))
+    the_geom = GeometryColumn(Point(2, srid=4326),
+                              comparator=SQLiteComparator)
+
+
+class Lake(Base):
+    __tablename__ = 'lakes'
+    gid = Column(Integer, primary_key=True)
+    name = Column(Unicode(16))
+    the_geom = GeometryColumn(Polygon(2, srid=4326),
+                              comparator=SQLiteComparator)
+
+
+GeometryDDL(Spot.__table__)
+GeometryDDL(Lake.__table__)
+
+
+class SpatialiteListener(PoolListener):
+
+    def connect(self, dbapi_con, con_record):
+        dbapi_con.enable_load_extension(True)
+        dbapi_con.execute("SELECT load_extension('mod_spatialite')")
+
+
+def spatialite_engine():
+    """An in-memory SpatiaLite database, None without the extension."""
+    engine = create_engine('sqlite://', listeners=[SpatialiteListener()])
+    try:
+        engine.execute("SELECT InitSpatialMetadata(1)")
+    except Exception:
+        return None
+    return engine
+
+
+class SpatialiteSelectTest(unittest.TestCase):
+
+    def setUp(self):
+        self.engine = spatialite_engine()
+        if self.engine is None:
+            raise unittest.SkipTest('mod_spatialite is not available')
+        Base.metadata.create_all(bind=self.engine)
+        self.session = sessionmaker(bind=self.engine)()
+        for gid, name, wkt in ((1, u'one', 'POINT(1 1)'),
+                               (2, u'two', 'POINT(2 2)'),
+                               (3, u'far', 'POINT(50 50)')):
+            self.session.add(Spot(gid=gid, name=name,
+                                  the_geom=WKTSpatialElement(wkt, 4326)))
+        self.session.add(Lake(gid=1, name=u'lake', the_geom=WKTSpatialElement(
+            'POLYGON((0 0, 0 3, 3 3, 3 0, 0 0))', 4326)))
+        self.session.commit()
+
+    def tearDown(self):
+        self.session.close()
+
+    def datasource(self, cls):
+        return GeoAlchemy(cls.__tablename__, srid=4326, fid='gid',
+                          geometry='the_geom', order='gid',
+                          session=self.session, dburi=None,
+                          layer=cls.__tablename__, model=__name__,
+                          cls=cls.__name__)
+
+    def select(self, datasource, params=None, bbox=None):
+        datasource.set_request_params(params or {})
+        action = Action()
+        action.bbox = bbox
+        return datasource.select(action)
+
+    def test_points(self):
+        features = self.select(self.datasource(Spot), bbox=[0, 0, 10, 10])
+        self.assertEqual([f.id for f in features], [1, 2])
+        for feature in features:
+            self.assertEqual(feature.geometry['type'], 'Point')
+        self.assertEqual(features[0].geometry['coordinates'], [1.0, 1.0])
+
+    def test_polygons(self):
+        features = self.select(self.datasource(Lake))
+        self.assertEqual(len(features), 1)
+        self.assertEqual(features[0].geometry['type'], 'Polygon')
+        self.assertEqual(len(features[0].geometry['coordinates'][0]), 5)
+
+    def test_wkb_decoder(self):
+        datasource = self.datasource(Spot)
+        datasource.geometry_decoder = 'wkb'
+        features = self.select(datasource)
+        self.assertEqual(len(features), 3)
+        for feature in features:
+            self.assertNotEqual(feature.geometry, None)
+
+    def test_reprojected(self):
+        features = self.select(self.datasource(Spot),
+                               {'srsname': 'EPSG:3857'})
+        self.assertEqual(len(features), 3)
+        x, y = features[0].geometry['coordinates']
+        self.assertAlmostEqual(x, 111319.49, 1)
@@ -0,0 +1,144 @@
+"""Tile grid and bbox helpers of the FeatureServer datasource."""
+
+import unittest
+from array import array
+
+from tgext.geo.featureserver import tiles
+from tgext.geo.featureserver.wkb import Coordinates
+
+SQUARE = [[0, 0], [0, 4], [4, 4], [4, 0], [0, 0]]
+HOLE = [[1, 1], [1, 3], [3, 3], [3, 1], [1, 1]]
+
+
+class GridTest(unittest.TestCase):
+
+    def test_default_extent(self):
+        self.assertEqual(tiles.default_extent(900913), tiles.MERCATOR_EXTENT)
+        self.assertEqual(tiles.default_extent('4326'),
+                         tiles.GEOGRAPHIC_EXTENT)
+        self.assertEqual(tiles.default_extent(2056), None)
+
+    def test_parse_srs(self):
+        self.assertEqual(tiles.parse_srs('EPSG:3857'), 3857)
+        self.assertEqual(tiles.parse_srs('urn:ogc:def:crs:EPSG::4326'), 4326)
+        self.assertEqual(tiles.parse_srs(
+            'http://www.opengis.net/gml/srs/epsg.xml#2056'), 2056)
+        self.assertEqual(tiles.parse_srs('CRS:84'), 4326)
+        self.assertRaises(ValueError, tiles.parse_srs, 'WGS84')
+
+    def test_parse_extent(self):
+        self.assertEqual(tiles.parse_extent('0,0,10, 20', 2056),
+                         (0.0, 0.0, 10.0, 20.0))
+        self.assertEqual(tiles.parse_extent(None, 4326),
+                         tiles.GEOGRAPHIC_EXTENT)
+
+    def test_tile_bounds(self):
+        extent = (0, 0, 16, 16)
+        self.assertEqual(tiles.tile_bounds(0, 0, 0, extent), (0, 0, 16, 16))
+        self.assertEqual(tiles.tile_bounds(2, 1, 0, extent), (4, 12, 8, 16))
+
+    def test_zoom_resolution(self):
+        self.assertEqual(tiles.zoom_resolution(1, (0, 0, 512, 512)), 1.0)
+
+    def test_snap(self):
+        extent = (0.0, 0.0, 16.0, 16.0)
+        self.assertEqual(tiles.snap([1, 1, 2, 2], extent),
+                         [(1.0, 1.0, 2.0, 2.0)])
+        snapped = tiles.snap([3, 3, 5, 5], extent)
+        self.assertEqual(len(snapped), 4)
+        for tile in snapped:
+            self.assertEqual(tile[2] - tile[0], 2.0)
+        # nearby requests share their tiles
+        self.assertEqual(tiles.snap([3.1, 3.1, 4.9, 4.9], extent), snapped)
+
+
+class BoundsTest(unittest.TestCase):
+
+    def test_point(self):
+        self.assertEqual(tiles.bounds({'type': 'Point',
+                                       'coordinates': [1, 2]}),
+                         (1, 2, 1, 2))
+
+    def test_polygon(self):
+        self.assertEqual(tiles.bounds({'type': 'Polygon',
+                                       'coordinates': [SQUARE]}),
+                         (0, 0, 4, 4))
+
+    def test_coordinates(self):
+        line = Coordinates(array('d', [5, 1, 2, 7, 3, 4]))
+        self.assertEqual(tiles.bounds({'type': 'LineString',
+                                       'coordinates': line}),
+                         (2, 1, 5, 7))
+
+    def test_collection(self):
+        geometry = {'type': 'GeometryCollection', 'geometries': [
+            {'type': 'Point', 'coordinates': [-1, 5]},
+            {'type': 'LineString', 'coordinates': [[2, 2], [3, 9]]}]}
+        self.assertEqual(tiles.bounds(geometry), (-1, 2, 3, 9))
+
+    def test_empty(self):
+        self.assertEqual(tiles.bounds({'type': 'LineString',
+                                       'coordinates': []}), None)
+
+    def test_intersects(self):
+        self.assertTrue(tiles.intersects((0, 0, 2, 2), (2, 2, 3, 3)))
+        self.assertFalse(tiles.intersects((0, 0, 2, 2), (2.1, 0, 3, 3)))
+
+
+class GeometryIntersectsTest(unittest.TestCase):
+
+    def intersects(self, gtype, coordinates, bbox):
+        return tiles.geometry_intersects({'type': gtype,
+                                          'coordinates': coordinates}, bbox)
+
+    def test_point(self):
+        self.assertTrue(self.intersects('Point', [1, 1], (0, 0, 1, 1)))
+        self.assertFalse(self.intersects('Point', [1, 2], (0, 0, 1, 1)))
+        self.assertTrue(self.intersects('MultiPoint', [[5, 5], [1, 1]],
+                                        (0, 0, 1, 1)))
+
+    def test_line(self):
+        # the diagonal's bounds overlap the bbox, the line does not
+        diagonal = [[0, 0], [4, 4]]
+        self.assertFalse(self.intersects('LineString', diagonal,
+                                         (3, 0, 4, 1)))
+        self.assertTrue(self.intersects('LineString', diagonal,
+                                        (1, 0, 3, 2)))
+        self.assertTrue(self.intersects('LineString', [[-1, 1], [5, 1]],
+                                        (0, 0, 2, 2)))
+        self.assertTrue(self.intersects('MultiLineString',
+                                        [diagonal, [[3, -1], [3, 2]]],
+                                        (2.5, 0, 4, 1)))
+
+    def test_polygon(self):
+        triangle = [[[0, 0], [4, 4], [4, 0], [0, 0]]]
+        self.assertFalse(self.intersects('Polygon', triangle, (0, 3, 1, 4)))
+        self.assertTrue(self.intersects('Polygon', triangle, (3, 1, 3.5, 2)))
+        # bbox inside the polygon, polygon inside the bbox
+        self.assertTrue(self.intersects('Polygon', [SQUARE],
+                                        (0.2, 0.2, 0.8, 0.8)))
+        self.assertTrue(self.intersects('Polygon', [SQUARE], (-1, -1, 5, 5)))
+
+    def test_hole(self):
+        self.assertFalse(self.intersects('Polygon', [SQUARE, HOLE],
+                                         (1.5, 1.5, 2.5, 2.5)))
+        self.assertTrue(self.intersects('Polygon', [SQUARE, HOLE],
+                                        (0.2, 0.2, 0.8, 0.8)))
+
+    def test_multipolygon(self):
+        far = [[[10, 10], [10, 11], [11, 11], [10, 10]]]
+        self.assertTrue(self.intersects('MultiPolygon', [far, [SQUARE]],
+                                        (1, 1, 2, 2)))
+        self.assertFalse(self.intersects('MultiPolygon', [far],
+                                         (1, 1, 2, 2)))
+
+    def test_coordinates(self):
+        ring = Coordinates(array('d', [0, 0, 0, 4, 4, 4, 4, 0, 0, 0]))
+        self.assertTrue(self.intersects('Polygon', [ring], (1, 1, 2, 2)))
+
+    def test_collection(self):
+        geometry = {'type': 'GeometryCollection', 'geometries': [
+            {'type': 'Point', 'coordinates': [9, 9]},
+            {'type': 'LineString', 'coordinates': [[0, 0], [4, 4]]}]}
+        self.assertTrue(tiles.geometry_intersects(geometry, (1, 0, 3, 2)))
+        self.assertFalse(tiles.geometry_intersects(geometry, (3, 0, 4, 1)))
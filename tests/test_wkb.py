@@ -0,0 +1,126 @@
+"""WKB decoding and encoding."""
+
+import struct
+import unittest
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+from tgext.geo.featureserver import wkb
+
+SQUARE = [[0.0, 0.0], [0.0, 1.0], [1.0, 1.0], [1.0, 0.0], [0.0, 0.0]]
+NAN = float('nan')
+
+
+def point(order, code, *ordinates):
+    """WKB of a point in byte order '<' or '>' with type code."""
+    flag = order == '<' and '\x01' or '\x00'
+    return flag + struct.pack(order + 'I%dd' % len(ordinates), code,
+                              *ordinates)
+
+
+class DecodeTest(unittest.TestCase):
+
+    def test_point(self):
+        for order in '<>':
+            geometry = wkb.decode(point(order, 1, 1.5, -2.0))
+            self.assertEqual(geometry, {'type': 'Point',
+                                        'coordinates': [1.5, -2.0]})
+
+    def test_empty_point(self):
+        self.assertEqual(wkb.decode(point('<', 1, NAN, NAN)), None)
+        self.assertEqual(wkb.decode_lists(point('>', 1, NAN, NAN)), None)
+
+    def test_empty_point_in_collections(self):
+        data = '\x01' + struct.pack('<II', 4, 2) + \
+            point('<', 1, NAN, NAN) + point('<', 1, 1.0, 2.0)
+        self.assertEqual(wkb.decode_lists(data),
+                         {'type': 'MultiPoint', 'coordinates': [[1.0, 2.0]]})
+        data = '\x01' + struct.pack('<II', 7, 1) + point('<', 1, NAN, NAN)
+        self.assertEqual(wkb.decode(data),
+                         {'type': 'GeometryCollection', 'geometries': []})
+
+    def test_ewkb(self):
+        # EWKB point with Z and an SRID
+        data = point('<', 1 | wkb.EWKB_Z | wkb.EWKB_SRID, 1.0, 2.0, 3.0)
+        data = data[:5] + struct.pack('<I', 4326) + data[5:]
+        self.assertEqual(wkb.decode(data)['coordinates'], [1.0, 2.0, 3.0])
+
+    def test_iso_m(self):
+        geometry = wkb.decode(point('<', 2001, 1.0, 2.0, 7.0))
+        self.assertEqual(geometry['coordinates'], [1.0, 2.0, 7.0])
+        self.assertTrue(geometry['measured'])
+
+    def test_polygon(self):
+        geometry = {'type': 'Polygon', 'coordinates': [SQUARE]}
+        decoded = wkb.decode(wkb.encode(geometry))
+        ring = decoded['coordinates'][0]
+        self.assertTrue(isinstance(ring, wkb.Coordinates))
+        self.assertEqual(len(ring), 5)
+        self.assertEqual(ring[2], (1.0, 1.0))
+        self.assertEqual(ring[-1], (0.0, 0.0))
+        self.assertEqual(ring, SQUARE)
+        self.assertEqual(ring.tolist(), SQUARE)
+        self.assertEqual(wkb.decode_lists(wkb.encode(geometry)), geometry)
+
+    def test_big_endian_line(self):
+        data = '\x00' + struct.pack('>II4d', 2, 2, 1.0, 2.0, 3.0, 4.0)
+        self.assertEqual(wkb.decode(data)['coordinates'].tolist(),
+                         [[1.0, 2.0], [3.0, 4.0]])
+
+    def test_unsupported_type(self):
+        self.assertRaises(ValueError, wkb.decode, point('<', 17, 0.0, 0.0))
+
+    def test_unicode_data(self):
+        data = unicode(point('<', 1, 1.0, 2.0), 'latin-1')
+        self.assertEqual(wkb.decode(data)['coordinates'], [1.0, 2.0])
+
+
+class CoordinatesTest(unittest.TestCase):
+
+    def test_slicing(self):
+        coords = wkb.decode(wkb.encode({'type': 'LineString',
+                                        'coordinates': SQUARE}))['coordinates']
+        self.assertEqual(coords[1:3], SQUARE[1:3])
+        self.assertEqual(coords[::2], [tuple(p) for p in SQUARE[::2]])
+        self.assertRaises(IndexError, lambda: coords[5])
+
+
+class EncodeTest(unittest.TestCase):
+
+    def roundtrip(self, geometry):
+        self.assertEqual(wkb.decode_lists(wkb.encode(geometry)), geometry)
+
+    def test_roundtrips(self):
+        self.roundtrip({'type': 'Point', 'coordinates': [1.0, 2.0]})
+        self.roundtrip({'type': 'MultiLineString',
+                        'coordinates': [SQUARE[:2], SQUARE[2:]]})
+        self.roundtrip({'type': 'MultiPolygon',
+                        'coordinates': [[SQUARE], [SQUARE]]})
+        self.roundtrip({'type': 'GeometryCollection', 'geometries': [
+            {'type': 'Point', 'coordinates': [1.0, 2.0]},
+            {'type': 'LineString', 'coordinates': SQUARE}]})
+
+    def test_z(self):
+        data = wkb.encode({'type': 'Point', 'coordinates': [1.0, 2.0, 3.0]})
+        self.assertEqual(struct.unpack('<I', data[1:5])[0], 1001)
+
+    def test_too_many_ordinates(self):
+        self.assertRaises(ValueError, wkb.encode,
+                          {'type': 'Point', 'coordinates': [1.0] * 5})
+
+
+class GeoJSONTest(unittest.TestCase):
+
+    def test_coordinates(self):
+        geometry = wkb.decode(wkb.encode({'type': 'Polygon',
+                                          'coordinates': [SQUARE]}))
+        self.assertEqual(json.loads(wkb.geojson(geometry)),
+                         {'type': 'Polygon', 'coordinates': [SQUARE]})
+
+    def test_drops_m(self):
+        geometry = wkb.decode(point('<', 2001, 1.0, 2.0, 7.0))
+        self.assertEqual(json.loads(wkb.geojson(geometry)),
+                         {'type': 'Point', 'coordinates': [1.0, 2.0]})
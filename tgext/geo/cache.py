@@ -0,0 +1,103 @@
+"""In-process LRU cache shared by the tgext.geo feature and tile services."""
+
+import threading
+import time
+
+
+class LRUCache(object):
+    """Least recently used cache with optional TTL and memory budget.
+
+    Entries are evicted once there are more than max_entries of them or
+    their sizes add up to more than max_bytes; a limit of 0 disables the
+    check. Entries older than ttl seconds are treated as missing. The
+    cache is safe to share between threads.
+    """
+
+    def __init__(self, max_entries=1000, max_bytes=0, ttl=0):
+        self.max_entries = int(max_entries)
+        self.max_bytes = int(max_bytes)
+        self.ttl = float(ttl)
+        self.lock = threading.Lock()
+        self.clear()
+        self.hits = self.misses = self.evictions = 0
+
+    def clear(self):
+        self.lock.acquire()
+        try:
+            # key -> [prev, next, key, value, size, expires]
+            self.entries = {}
+            self.root = root = []
+            root[:] = [root, root, None, None, 0, 0]
+            self.bytes = 0
+        finally:
+            self.lock.release()
+
+    def _unlink(self, link):
+        prev, next = link[0], link[1]
+        prev[1] = next
+        next[0] = prev
+
+    def _append(self, link):
+        root = self.root
+        last = root[0]
+        link[0], link[1] = last, root
+        last[1] = root[0] = link
+
+    def _remove(self, link):
+        self._unlink(link)
+        del self.entries[link[2]]
+        self.bytes -= link[4]
+
+    def get(self, key, default=None):
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link is None:
+                self.misses += 1
+                return default
+            if link[5] and link[5] < time.time():
+                self._remove(link)
+                self.misses += 1
+                return default
+            self._unlink(link)
+            self._append(link)
+            self.hits += 1
+            return link[3]
+        finally:
+            self.lock.release()
+
+    def set(self, key, value, size=1):
+        if self.max_bytes and size > self.max_bytes:
+            return
+        expires = self.ttl and time.time() + self.ttl or 0
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link is not None:
+                self._remove(link)
+            link = [None, None, key, value, size, expires]
+            self._append(link)
+            self.entries[key] = link
+            self.bytes += size
+            while ((self.max_entries and len(self.entries) > self.max_entries)
+                   or (self.max_bytes and self.bytes > self.max_bytes)):
+                self._remove(self.root[1])
+                self.evictions += 1
+        finally:
+            self.lock.release()
+
+    def delete(self, key):
+        self.lock.acquire()
+        try:
+            link = self.entries.get(key)
+            if link is not None:
+                self._remove(link)
+        finally:
+            self.lock.release()
+
+    def stats(self):
+        return {'entries': len(self.entries),
+                'bytes': self.bytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'evictions': self.evictions}
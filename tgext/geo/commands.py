@@ -6,20 +6,29 @@ on the MapFish paster commands.
 
 Currently available commands:
 
-    geo-controller, geo-model, geo-layer, geo-tilecache
+    geo-controller, geo-model, geo-layer, geo-tilecache, geo-vectortile,
+    geo-tilecache-seed, geo-explain
 """
 
 import os
 import sys
+import time
 from ConfigParser import ConfigParser, NoOptionError
 
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
 from paste.script.command import Command, BadCommand
 from paste.script.filemaker import FileOp
 
 import pylons.util as util
 
 __all__ = ['TGGeoControllerCommand', 'TGGeoModelCommand', \
-		'TGGeoLayerCommand', 'TGGeoTileCacheCommand']
+		'TGGeoLayerCommand', 'TGGeoTileCacheCommand', \
+		'TGGeoVectorTileCommand', 'TGGeoTileCacheSeedCommand', \
+		'TGGeoExplainCommand']
 
 def can_import(name):
     """Attempt to __import__ the specified package/module, returning True when
@@ -162,10 +171,111 @@ class TGGeoControllerCommand(Command):
             msg = str(sys.exc_info()[1])
             raise BadCommand('An unknown error occurred. %s' % msg)
 
+def _indexName(table, column, kind):
+    return '%s_%s_%s' % (table.replace('.', '_'), column, kind)
+
+def _indexStatements(config, name, table, geomColName):
+    """Build the index statements for PostGIS and SpatiaLite of the
+    spatialindex, indexes and cluster options of a layers.ini section.
+
+    indexes is a comma separated list of columns, each optionally followed
+    by the kind of index: btree (default), pattern (prefix filters), lower
+    (case insensitive prefix filters), trigram or fts (search filters,
+    PostGIS only)."""
+    def option(key, default=''):
+        if config.has_option(name, key):
+            return config.get(name, key).strip()
+        return default
+    postgis = []
+    spatialite = []
+    spatialIndex = option('spatialindex', 'false').lower() in \
+        ('true', 'yes', 'on', '1')
+    if spatialIndex:
+        postgis.append('CREATE INDEX IF NOT EXISTS %s ON %s USING GIST (%s)'
+            % (_indexName(table, geomColName, 'gist'), table, geomColName))
+        spatialite.append("SELECT CreateSpatialIndex('%s', '%s')"
+            % (table, geomColName))
+    for index in option('indexes').split(','):
+        if not index.strip():
+            continue
+        column, kind = (index.strip().split(':') + ['btree'])[:2]
+        indexName = _indexName(table, column, kind)
+        if kind == 'btree':
+            definition = 'ON %s (%s)' % (table, column)
+            postgis.append('CREATE INDEX IF NOT EXISTS %s %s'
+                           % (indexName, definition))
+            spatialite.append('CREATE INDEX IF NOT EXISTS %s %s'
+                              % (indexName, definition))
+        elif kind == 'pattern':
+            postgis.append('CREATE INDEX IF NOT EXISTS %s ON %s '
+                '(%s text_pattern_ops)' % (indexName, table, column))
+            spatialite.append('CREATE INDEX IF NOT EXISTS %s ON %s (%s)'
+                              % (indexName, table, column))
+        elif kind == 'lower':
+            postgis.append('CREATE INDEX IF NOT EXISTS %s ON %s '
+                '(lower(%s) text_pattern_ops)' % (indexName, table, column))
+            spatialite.append('CREATE INDEX IF NOT EXISTS %s ON %s '
+                '(lower(%s))' % (indexName, table, column))
+        elif kind == 'trigram':
+            if 'CREATE EXTENSION IF NOT EXISTS pg_trgm' not in postgis:
+                postgis.insert(0, 'CREATE EXTENSION IF NOT EXISTS pg_trgm')
+            postgis.append('CREATE INDEX IF NOT EXISTS %s ON %s USING GIN '
+                '(%s gin_trgm_ops)' % (indexName, table, column))
+        elif kind == 'fts':
+            postgis.append('CREATE INDEX IF NOT EXISTS %s ON %s USING GIN '
+                "(to_tsvector('simple', %s))" % (indexName, table, column))
+        else:
+            raise BadCommand('Unknown index kind %s for %s in layers.ini'
+                             % (kind, column))
+    if option('cluster', 'false').lower() in ('true', 'yes', 'on', '1'):
+        if not spatialIndex:
+            raise BadCommand('cluster needs spatialindex in layers.ini')
+        postgis.append('CLUSTER %s USING %s'
+                       % (table, _indexName(table, geomColName, 'gist')))
+    if postgis:
+        postgis.append('ANALYZE %s' % table)
+    return postgis, spatialite
+
+def _indexString(modelTabObj, table, postgis, spatialite):
+    """Python source creating the indexes, appended to the model"""
+    if not postgis and not spatialite:
+        return ''
+    lines = ['', '# indexes of layers.ini, created by create_indexes()',
+             '%s_indexes = {' % modelTabObj]
+    for dialect, statements in (('postgresql', postgis),
+                                ('sqlite', spatialite)):
+        lines.append('    %r: [' % dialect)
+        for statement in statements:
+            lines.append('        %r,' % statement)
+        lines.append('    ],')
+    lines.extend([
+        '}',
+        '',
+        'def create_indexes(engine=None):',
+        '    """Create the missing indexes of the %s table, e.g. from'
+            % table,
+        '    websetup.py"""',
+        '    engine = engine or %s.bind' % modelTabObj,
+        '    dialect = engine.dialect.name',
+        "    if dialect == 'postgres':",
+        "        dialect = 'postgresql'",
+        '    for statement in %s_indexes.get(dialect, []):' % modelTabObj,
+        '        engine.execute(statement)',
+        ''])
+    return '\n'.join(lines)
+
 class TGGeoModelCommand(Command):
     """Create a geo model
 
     The TGGeoModel command will create the standard model template file.
+    If the layer's section of layers.ini sets spatialindex, indexes or
+    cluster, the model also gets a create_indexes() function creating
+    the spatial index of the geometry column, the attribute indexes and
+    clustering the table on the spatial index::
+
+        spatialindex = true
+        indexes = name:pattern, category, title:trigram
+        cluster = true
 
     Example usage::
 
@@ -217,6 +327,8 @@ class TGGeoModelCommand(Command):
             idColType, idColName = \
                 config.get(name, 'idcolumn').split(':')[:2]
             geomColName = config.get(name, 'geomcolumn')
+            postgis, spatialite = _indexStatements(config, name, table,
+                                                   geomColName)
 
             # check the name isn't the same as the package
             basePkg = fileOp.find_dir('controllers', True)[0]
@@ -242,7 +354,9 @@ class TGGeoModelCommand(Command):
                  'epsg': epsg,
                  'idColType': idColType,
                  'idColName': idColName,
-                 'geomColName': geomColName})
+                 'geomColName': geomColName,
+                 'indexString': _indexString(modelTabObj, table, postgis,
+                                             spatialite)})
             fileOp.copy_file(template='model.py_tmpl',
                          dest=os.path.join('model', directory),
                          filename=name)
@@ -309,7 +423,11 @@ class TGGeoTileCacheCommand(Command):
     """Create a tilecache controller and accompanying functional test
 
     The TGGeoTileCache command will create the tilecache controller template
-    file and associated functional test.
+    file and associated functional test. If the [cache] section of
+    tilecache.cfg sets memory_size, the most requested tiles, up to that
+    many bytes, are also kept in memory in front of the configured cache.
+    Tiles are served with an ETag, and with the Cache-Control header set
+    by cache_control in the [cache] section.
 
     Example usage::
 
@@ -370,6 +488,26 @@ class TGGeoTileCacheCommand(Command):
                 if (section == 'cache'):
                     baseDir = config.get(section, 'base')
                     cacheType = config.get(section, 'type')
+                    cacheString = '%s("%s")' % (cacheType, baseDir)
+                    cacheControl = None
+                    if config.has_option(section, 'cache_control'):
+                        cacheControl = config.get(section, 'cache_control')
+                    # optional in-memory tier in front of the cache
+                    if config.has_option(section, 'memory_size'):
+                        memorySize = config.get(section, 'memory_size')
+                        try:
+                            memorySize = int(memorySize)
+                        except ValueError:
+                            raise BadCommand(
+                                'memory_size in tilecache.cfg must be a '
+                                'number of bytes, not %r' % memorySize)
+                        if memorySize <= 0:
+                            raise BadCommand(
+                                'memory_size in tilecache.cfg must be '
+                                'positive, not %d' % memorySize)
+                        importString += 'from tgext.geo.tilecache import MemoryCache\n'
+                        cacheString = 'MemoryCache(%s, max_bytes=%d)' % (
+                            cacheString, memorySize)
                 else:
                     params = {}
                     params['layer'] = section
@@ -425,6 +563,8 @@ class TGGeoTileCacheCommand(Command):
                  'basePkg': basePkg,
                  'baseDir': baseDir,
                  'cacheType': cacheType,
+                 'cacheString': cacheString,
+                 'cacheControl': repr(cacheControl),
                  'importString': importString,
                  'layersString': layersString,
                  'tilecacheLayers': tilecacheLayers})
@@ -442,3 +582,472 @@ class TGGeoTileCacheCommand(Command):
             msg = str(sys.exc_info()[1])
             raise BadCommand('An unknown error occurred. %s' % msg)
 
+
+class TGGeoVectorTileCommand(Command):
+    """Create a vector tile controller and accompanying functional test
+
+    The TGGeoVectorTile command will create a controller serving a layer
+    of layers.ini as Mapbox vector tiles, and its functional test. The
+    controller is named after the layer, with a _tiles suffix.
+
+    Example usage::
+
+        yourproj% paster geo-vectortile foos
+        Creating yourproj/yourproj/controllers/foos_tiles.py
+        Creating yourproj/yourproj/tests/functional/test_foos_tiles.py
+
+    If you'd like to have controllers underneath a directory, just include
+    the path as the layer name and the necessary directories will be
+    created for you::
+
+        yourproj% paster geo-vectortile admin/foos
+        Creating yourproj/controllers/admin
+        Creating yourproj/yourproj/controllers/admin/foos_tiles.py
+        Creating yourproj/yourproj/tests/functional/test_admin_foos_tiles.py
+    """
+    summary = __doc__.splitlines()[0]
+    usage = '\n' + __doc__
+
+    min_args = 1
+    max_args = 1
+    group_name = 'tgext.geo'
+
+    default_verbosity = 3
+
+    parser = Command.standard_parser(simulate=True)
+    parser.add_option('--no-test',
+                      action='store_true',
+                      dest='no_test',
+                      help="Don't create the test; just the controller")
+
+    def command(self):
+        """Main command to create a tgext.geo vector tile controller"""
+        try:
+            fileOp = FileOp(source_dir=os.path.join(
+                os.path.dirname(__file__), 'paster_templates'))
+            try:
+                name, directory = fileOp.parse_path_name_args(self.args[0])
+            except:
+                raise BadCommand('No egg_info directory was found')
+
+            # read layers.ini
+            config = ConfigParser()
+            config.read(['layers.ini'])
+            # check passed layer is in layers.ini
+            if not config.has_section(name):
+                raise BadCommand(
+                    'There is no layer named %s in layers.ini' % name)
+
+            # get layer parameters
+            singularName = config.get(name, 'singular')
+            table = config.get(name, 'table')
+            epsg = config.get(name, 'epsg')
+            idColType, idColName = \
+                config.get(name, 'idcolumn').split(':')[:2]
+            geomColName = config.get(name, 'geomcolumn')
+            tileExtent = '4096'
+            if config.has_option(name, 'tileextent'):
+                tileExtent = config.get(name, 'tileextent')
+            tileBuffer = '64'
+            if config.has_option(name, 'tilebuffer'):
+                tileBuffer = config.get(name, 'tilebuffer')
+
+            # check the name isn't the same as the package
+            basePkg = fileOp.find_dir('controllers', True)[0]
+            if basePkg.lower() == name.lower():
+                raise BadCommand(
+                    'Your controller name should not be the same as '
+                    'the package name %s' % basePkg)
+
+            # validate the name
+            layerName = name
+            name = name.replace('-', '_') + '_tiles'
+            validateName(name)
+
+            # set test file name
+            fullName = os.path.join(directory, name)
+            if not fullName.startswith(os.sep):
+                fullName = os.sep + fullName
+            testName = fullName.replace(os.sep, '_')[1:]
+
+            # set template vars
+            modName = layerName.replace('-', '_')
+            fullModName = os.path.join(directory, name)
+            contrClass = util.class_name_from_module_name(name)
+            modelClass = util.class_name_from_module_name(singularName)
+
+            # setup the vector tile controller
+            fileOp.template_vars.update(
+                {'modName': modName,
+                 'fullModName': fullModName,
+                 'layerName': layerName,
+                 'contrClass': contrClass,
+                 'modelClass': modelClass,
+                 'basePkg': basePkg,
+                 'table': table,
+                 'epsg': epsg,
+                 'idColName': idColName,
+                 'geomColName': geomColName,
+                 'tileExtent': tileExtent,
+                 'tileBuffer': tileBuffer})
+            fileOp.copy_file(template='vectortile.py_tmpl',
+                         dest=os.path.join('controllers', directory),
+                         filename=name)
+            if not self.options.no_test:
+                fileOp.copy_file(template='test_controller.py_tmpl',
+                             dest=os.path.join('tests', 'functional'),
+                             filename='test_' + testName)
+
+        except BadCommand, e:
+            raise BadCommand('An error occurred. %s' % e)
+        except:
+            msg = str(sys.exc_info()[1])
+            raise BadCommand('An unknown error occurred. %s' % msg)
+
+# TileCache service of a seeding worker process
+_seedService = None
+
+def _seedInit(configFile):
+    """Load the TileCache service in a seeding worker process"""
+    global _seedService
+    from TileCache.Service import Service
+    _seedService = Service.load(configFile)
+
+def _tileExists(cache, tile):
+    """Check whether tile is in cache, without reading it from disk"""
+    if cache.__class__.__name__ == 'Disk':
+        return os.path.exists(cache.getKey(tile))
+    return cache.get(tile) is not None
+
+def _metaSize(layer, z):
+    """Metatile size of layer at level z, (1, 1) for layers without
+    metatiles"""
+    if hasattr(layer, 'getMetaSize'):
+        return layer.getMetaSize(z)
+    return (1, 1)
+
+def _seedRow(unit):
+    """Render the metatiles of one row of a seeding run, skipping those
+    whose tiles are all cached already unless force is set. Returns the
+    unit along with the number of tiles rendered and skipped"""
+    from TileCache.Layer import Tile
+    layerName, z, y, startX, endX, force = unit
+    layer = _seedService.layers[layerName]
+    metaSize = _metaSize(layer, z)
+    rendered = skipped = 0
+    for x in range(startX, endX, metaSize[0]):
+        tiles = [Tile(layer, x + i, y + j, z)
+                 for i in range(metaSize[0]) for j in range(metaSize[1])]
+        if not force and not [t for t in tiles
+                              if not _tileExists(_seedService.cache, t)]:
+            skipped += len(tiles)
+            continue
+        _seedService.renderTile(Tile(layer, x, y, z), force=force)
+        rendered += len(tiles)
+    return unit, rendered, skipped
+
+class TGGeoTileCacheSeedCommand(Command):
+    """Seed the tiles of tilecache.cfg layers in parallel
+
+    The TGGeoTileCacheSeed command renders the tiles of a bbox and range
+    of zoom levels into the cache configured in tilecache.cfg, using a
+    pool of processes. Metatiled layers are rendered a metatile at a time
+    and tiles already in the cache are skipped. Finished rows are appended
+    to a checkpoint file, so an interrupted run picks up where it stopped
+    when run again with the same options.
+
+    Example usage::
+
+        yourproj% paster geo-tilecache-seed --start 0 --stop 10 basemap
+        basemap z00 row 0: 1 rendered, 0 skipped (3.2 tiles/s)
+        ...
+
+    Without layer names, all layers of tilecache.cfg are seeded.
+    """
+    summary = __doc__.splitlines()[0]
+    usage = '\n' + __doc__
+
+    min_args = 0
+    max_args = None
+    group_name = 'tgext.geo'
+
+    default_verbosity = 1
+
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--config',
+                      dest='config',
+                      default='tilecache.cfg',
+                      help="TileCache configuration file")
+    parser.add_option('--bbox',
+                      dest='bbox',
+                      help="minx,miny,maxx,maxy to seed, in layer units "
+                           "(default: the layer bbox)")
+    parser.add_option('--start',
+                      dest='start',
+                      type='int',
+                      default=0,
+                      help="First zoom level to seed")
+    parser.add_option('--stop',
+                      dest='stop',
+                      type='int',
+                      default=5,
+                      help="Zoom level to stop at (not seeded)")
+    parser.add_option('--processes',
+                      dest='processes',
+                      type='int',
+                      help="Number of seeding processes "
+                           "(default: one per CPU)")
+    parser.add_option('--checkpoint',
+                      dest='checkpoint',
+                      default='tilecache-seed.checkpoint',
+                      help="File recording the rows seeded so far")
+    parser.add_option('--force',
+                      action='store_true',
+                      dest='force',
+                      help="Render tiles even if they are cached")
+
+    def units(self, service, names, done):
+        """List the rows of metatiles left to seed"""
+        units = []
+        for name in names:
+            layer = service.layers[name]
+            bbox = layer.bbox
+            if self.options.bbox:
+                bbox = [float(c) for c in self.options.bbox.split(',')]
+            for z in range(self.options.start, self.options.stop):
+                bottomleft = layer.getClosestCell(z, bbox[0:2])
+                topright = layer.getClosestCell(z, bbox[2:4])
+                metaSize = _metaSize(layer, z)
+                # metatiles start at multiples of the metatile size, rows
+                # and columns starting in between would render metatiles
+                # twice and count tiles outside of them
+                startX = bottomleft[0] - bottomleft[0] % metaSize[0]
+                startY = bottomleft[1] - bottomleft[1] % metaSize[1]
+                for y in range(startY, topright[1] + 1, metaSize[1]):
+                    unit = (name, z, y, startX, topright[0] + 1,
+                            bool(self.options.force))
+                    if '%s/%s/%s' % unit[:3] not in done:
+                        units.append(unit)
+        return units
+
+    def command(self):
+        """Main command to seed tilecache layers"""
+        try:
+            import multiprocessing
+            from TileCache.Service import Service
+
+            if not os.path.exists(self.options.config):
+                raise BadCommand('There is no %s' % self.options.config)
+            service = Service.load(self.options.config)
+            names = self.args or service.layers.keys()
+            for name in names:
+                if name not in service.layers:
+                    raise BadCommand(
+                        'There is no layer named %s in %s'
+                        % (name, self.options.config))
+
+            # the first line of the checkpoint holds the options of the
+            # run, each following line a finished row
+            run = json.dumps({'config': os.path.abspath(self.options.config),
+                              'layers': sorted(names),
+                              'bbox': self.options.bbox,
+                              'start': self.options.start,
+                              'stop': self.options.stop}, sort_keys=True)
+            done = {}
+            checkpoint = self.options.checkpoint
+            if os.path.exists(checkpoint):
+                lines = open(checkpoint).readlines()
+                if not lines or lines[0].strip() != run:
+                    raise BadCommand(
+                        '%s was written by a run with other options, run '
+                        'with the same ones or remove it' % checkpoint)
+                # a line cut short by an interruption is not a row
+                done = dict([(line.strip(), True) for line in lines[1:]
+                             if line.endswith('\n')])
+                if self.verbose:
+                    print 'Resuming from %s: %d rows already seeded' % (
+                        checkpoint, len(done))
+                log = open(checkpoint, 'a')
+                if not lines[-1].endswith('\n'):
+                    log.write('\n')
+            else:
+                log = open(checkpoint, 'w')
+                log.write(run + '\n')
+                log.flush()
+
+            units = self.units(service, names, done)
+            pool = multiprocessing.Pool(self.options.processes,
+                                        _seedInit, (self.options.config,))
+            start = time.time()
+            total = 0
+            try:
+                for unit, rendered, skipped in \
+                        pool.imap_unordered(_seedRow, units):
+                    log.write('%s/%s/%s\n' % unit[:3])
+                    log.flush()
+                    total += rendered
+                    if self.verbose:
+                        print '%s z%02d row %d: %d rendered, %d skipped ' \
+                              '(%.1f tiles/s)' % (unit[0], unit[1], unit[2],
+                              rendered, skipped,
+                              total / (time.time() - start + .0001))
+                pool.close()
+            except:
+                pool.terminate()
+                log.close()
+                raise
+            pool.join()
+            log.close()
+            # the run is complete, the next one starts from scratch
+            if os.path.exists(checkpoint):
+                os.remove(checkpoint)
+            if self.verbose:
+                print 'Seeded %d tiles in %.1fs (%.1f tiles/s)' % (total,
+                    time.time() - start, total / (time.time() - start + .0001))
+
+        except BadCommand, e:
+            raise BadCommand('An error occurred. %s' % e)
+        except:
+            msg = str(sys.exc_info()[1])
+            raise BadCommand('An unknown error occurred. %s' % msg)
+
+class TGGeoExplainCommand(Command):
+    """Check the query plans of FeatureServer layers
+
+    The TGGeoExplain command loads the application from its config file
+    and runs EXPLAIN on the queries the GeoAlchemy datasource of each
+    layer issues for a feature id, a bbox, and every --filter with and
+    without the bbox. It reports the estimated cost and rows of each query
+    (on PostGIS) and the tables it reads sequentially, which usually
+    means an index is missing.
+
+    Example usage::
+
+        yourproj% paster geo-explain --config development.ini \\
+                      --filter name__startswith=ab foos
+        foos   id                 cost      8.29  rows      1  ok
+        foos   bbox               cost     12.54  rows     40  ok
+        foos   name__startswith   cost   1893.00  rows    410  SEQ SCAN foos
+        ...
+
+    Without layer names, all layers configured in the application are
+    checked.
+    """
+    summary = __doc__.splitlines()[0]
+    usage = '\n' + __doc__
+
+    min_args = 0
+    max_args = None
+    group_name = 'tgext.geo'
+
+    default_verbosity = 1
+
+    parser = Command.standard_parser(verbose=True)
+    parser.add_option('--config',
+                      dest='config',
+                      default='development.ini',
+                      help="Application configuration file")
+    parser.add_option('--bbox',
+                      dest='bbox',
+                      help="minx,miny,maxx,maxy of the bbox queries "
+                           "(default: a 1/256 wide box in the middle of "
+                           "the layer grid)")
+    parser.add_option('--filter',
+                      action='append',
+                      dest='filters',
+                      default=[],
+                      help="Attribute filter as column__operator=value, "
+                           "may be repeated")
+    parser.add_option('--fail',
+                      action='store_true',
+                      dest='fail',
+                      help="Exit with an error if a query reads a table "
+                           "sequentially")
+
+    def queries(self, datasource):
+        """List the (description, action) pairs to explain for a layer"""
+        from FeatureServer.Service.Action import Action
+        extent = datasource.snap_extent
+        if self.options.bbox:
+            bbox = [float(c) for c in self.options.bbox.split(',')]
+        elif extent is None:
+            raise BadCommand('Layer %s has no geo.%s.snap_extent, pass '
+                             '--bbox' % (datasource.name, datasource.name))
+        else:
+            cx = (extent[0] + extent[2]) / 2.0
+            cy = (extent[1] + extent[3]) / 2.0
+            half = (extent[2] - extent[0]) / 512.0
+            bbox = [cx - half, cy - half, cx + half, cy + half]
+        def action(id=None, bbox=None, attributes=None):
+            a = Action()
+            a.method = 'select'
+            a.id = id
+            a.bbox = bbox
+            a.attributes = attributes or {}
+            return a
+        queries = [('id', action(id=1)), ('bbox', action(bbox=bbox))]
+        for filter in self.options.filters:
+            key, value = filter.split('=', 1)
+            column, type = (key.split('__') + ['eq'])[:2]
+            attributes = {column: {'column': column, 'type': type,
+                                   'value': value}}
+            queries.append((key, action(attributes=attributes)))
+            queries.append(('bbox+' + key,
+                            action(bbox=bbox, attributes=attributes)))
+        return queries
+
+    def command(self):
+        """Main command to explain the queries of FeatureServer layers"""
+        try:
+            from paste.deploy import loadapp
+            from tg import config
+            from tgext.geo.featureserver.registry import registry
+
+            if not os.path.exists(self.options.config):
+                raise BadCommand('There is no %s' % self.options.config)
+            loadapp('config:%s' % os.path.abspath(self.options.config))
+            names = self.args or sorted([key.split('.')[1]
+                for key in config.keys()
+                if key.startswith('geo.') and key.endswith('.cls')
+                and key.count('.') == 2])
+            if not names:
+                raise BadCommand('No geo.<layer>.cls settings in %s'
+                                 % self.options.config)
+
+            scans = 0
+            for name in names:
+                if not registry.settings(name)['cls']:
+                    raise BadCommand('There is no layer named %s in %s'
+                                     % (name, self.options.config))
+                datasource = registry.datasource(name)
+                datasource.set_request_params({})
+                try:
+                    for description, action in self.queries(datasource):
+                        steps = datasource.explain(
+                            datasource.select_query(action))
+                        operation, table, cost, rows, scan = steps[0]
+                        tables = [step[1] for step in steps if step[4]]
+                        scans += len(tables)
+                        status = 'ok'
+                        if tables:
+                            status = 'SEQ SCAN ' + ', '.join(tables)
+                        if cost is None:
+                            print '%-12s %-20s %s' % (name, description,
+                                                      status)
+                        else:
+                            print '%-12s %-20s cost %9.2f  rows %6s  %s' % (
+                                name, description, cost, rows, status)
+                        if self.verbose > 1:
+                            for step in steps:
+                                print '    %s %s' % (step[0], step[1] or '')
+                finally:
+                    datasource.release()
+
+            if scans and self.options.fail:
+                raise BadCommand('%d sequential scans found' % scans)
+
+        except BadCommand, e:
+            raise BadCommand('An error occurred. %s' % e)
+        except:
+            msg = str(sys.exc_info()[1])
+            raise BadCommand('An unknown error occurred. %s' % msg)
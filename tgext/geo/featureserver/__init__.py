@@ -1 +1,2 @@
-from controller import FeatureServerController
+from controller import FeatureServerController, VectorTileController, \
+    MultiFeatureServerController
@@ -0,0 +1,132 @@
+"""Binary feature encoders.
+
+The geometry of the features handed to these encoders is the WKB or TWKB
+produced by the database, passed through without being parsed.
+
+The wkb and twkb formats are a sequence of little endian length prefixed
+records, one per feature::
+
+    uint32 length, feature id as UTF-8 text
+    uint32 length, properties as a UTF-8 JSON object
+    uint32 length, geometry bytes
+
+FlatGeobuf output is written with GDAL's FlatGeobuf driver, including the
+packed R-tree spatial index, and needs the GDAL Python bindings.
+"""
+
+import struct
+import uuid
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+try:
+    from osgeo import gdal, ogr, osr
+except ImportError:
+    gdal = ogr = osr = None
+
+from streaming import chunked
+import wkb
+
+
+def _record(data):
+    return struct.pack('<I', len(data)) + data
+
+
+def _id(fid):
+    if fid is None:
+        return ''
+    if isinstance(fid, unicode):
+        return fid.encode('utf-8')
+    return str(fid)
+
+
+def _wkb(geometry):
+    """Geometry bytes; decoded geometries are encoded back to WKB."""
+    if isinstance(geometry, dict):
+        return wkb.encode(geometry)
+    return str(geometry)
+
+
+def records(features, layer=None, srid=None):
+    """Encode features as length prefixed id, properties and geometry
+       records."""
+    for piece in chunked(_records(features)):
+        yield piece
+
+
+def _records(features):
+    for feature in features:
+        yield _record(_id(feature.id)) + \
+            _record(json.dumps(feature.properties)) + \
+            _record(_wkb(feature.geometry))
+
+
+def _field_type(value):
+    if isinstance(value, bool):
+        return ogr.OFTInteger
+    if isinstance(value, (int, long)):
+        return ogr.OFTInteger64
+    if isinstance(value, float):
+        return ogr.OFTReal
+    return ogr.OFTString
+
+
+def flatgeobuf(features, layer='layer', srid=4326):
+    """Encode features as a FlatGeobuf file with a spatial index. The
+       index covers all features, so the file is only produced once the
+       last feature has been read."""
+    if ogr is None:
+        raise ImportError("FlatGeobuf output requires the GDAL Python "
+                          "bindings (osgeo)")
+    path = '/vsimem/%s-%s.fgb' % (layer, uuid.uuid4().hex)
+    features = iter(features)
+    first = next(features, None)
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(int(srid))
+    datasource = ogr.GetDriverByName('FlatGeobuf').CreateDataSource(path)
+    try:
+        fgb_layer = datasource.CreateLayer(str(layer), srs, ogr.wkbUnknown,
+                                           ['SPATIAL_INDEX=YES'])
+        fields = []
+        if first is not None:
+            for key, value in sorted(first.properties.items()):
+                fgb_layer.CreateField(ogr.FieldDefn(str(key),
+                                                    _field_type(value)))
+                fields.append(key)
+            definition = fgb_layer.GetLayerDefn()
+            feature = first
+            while feature is not None:
+                fgb_feature = ogr.Feature(definition)
+                for key in fields:
+                    value = feature.properties.get(key)
+                    if value is not None:
+                        fgb_feature.SetField(str(key), value)
+                fgb_feature.SetGeometry(
+                    ogr.CreateGeometryFromWkb(_wkb(feature.geometry)))
+                fgb_layer.CreateFeature(fgb_feature)
+                feature = next(features, None)
+        # closing the datasource writes the header and the index
+        datasource = None
+        size = gdal.VSIStatL(path).size
+        handle = gdal.VSIFOpenL(path, 'rb')
+        try:
+            data = gdal.VSIFReadL(1, size, handle)
+        finally:
+            gdal.VSIFCloseL(handle)
+    finally:
+        datasource = None
+        gdal.Unlink(path)
+    yield data
+
+
+# request format name -> (geometry format selected from the database,
+#                         content type, encoder)
+encoders = {
+    'wkb': ('wkb', 'application/octet-stream', records),
+    'twkb': ('twkb', 'application/octet-stream', records),
+    'fgb': ('wkb', 'application/flatgeobuf', flatgeobuf),
+    'flatgeobuf': ('wkb', 'application/flatgeobuf', flatgeobuf),
+}
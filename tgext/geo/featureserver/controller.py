@@ -1,66 +1,326 @@
-from tg import config, request, response, expose
+from tg import request, response, expose, abort
 from tg.controllers import TGController
 from FeatureServer.Server import Server
+from FeatureServer.Service import Request
 import cgi as cgimod
-from datasource import GeoAlchemy
+import types
+try:
+    import simplejson as json
+except ImportError:
+    import json
+from email.Utils import formatdate, parsedate_tz, mktime_tz
+from hashlib import md5
+from sqlalchemy import text
+from sqlalchemy.orm import scoped_session, sessionmaker
+import calendar
+import datetime
+import urllib
+from registry import registry
+from datasource import TransactionError
+from workers import ThreadPool
+from timing import LayerStats
+import streaming
+import binary
+import mvt
+import tiles
+
+
+def request_params():
+    """The query string parameters of the request, with lowercased
+       keys."""
+    params = {}
+    if request.environ.has_key('QUERY_STRING'):
+        for key, value in cgimod.parse_qsl(
+            request.environ['QUERY_STRING'], keep_blank_values=True):
+            params[key.lower()] = value
+    return params
+
+
+def request_format(params):
+    """Return the output format requested by the format parameter or the
+       extension of the path, lowercased."""
+    if params.get('format'):
+        return params['format'].lower()
+    last = request.path_info.split("/")[-1].split(".")
+    if len(last) > 1:
+        return last[-1].lower()
+    return "geojson"
 
 
 class FeatureServerController(TGController):
+    """Serve a FeatureServer layer configured by its geo.<layer>.*
+       settings.
+
+       With geo.<layer>.etags, GET responses carry ETag (and when known
+       Last-Modified) validators and conditional requests are answered
+       with 304. The validators come from geo.<layer>.etag_query, SQL
+       returning a value that changes with the data, such as
+       "SELECT max(updated_at) FROM roads" or a row of a version table
+       maintained by triggers; a timestamp (taken as UTC unless it has
+       a time zone) also gives Last-Modified.
+       Without it, geo.<layer>.single_process = true uses a version
+       counted by the writes of this process, which is only right when
+       one process serves and writes the layer and nothing else changes
+       the table. Otherwise no validators are sent."""
 
     def __init__(self, name, session, allow_only=None):
-        self.model = config.get("geo.%s.model"%name, None)
-        self.cls = config.get("geo.%s.cls"%name, None)
-        self.table = config.get("geo.%s.table"%name, self.cls.lower())
+        settings = registry.settings(name)
         self.layer = name
-        self.fid = config.get("geo.%s.fid"%name, "gid")
-        self.geometry = config.get("geo.%s.geometry"%name, "the_geom")
-        self.geom_rel = config.get("geo.%s.geom_rel"%name, None)
-        self.geom_cls = config.get("geo.%s.geom_cls"%name, None)
-        self.join_condition = config.get("geo.%s.join_condition"%name, None)
-        self.order = config.get("geo.%s.order"%name, self.fid)
-        self.srid = config.get("geo.%s.srid"%name, 4326)
-        self.dburi = config.get("sqlalchemy.url", None)
-        self.dburi = config.get("geo.%s.dburi"%name, self.dburi)
-        self.sql_echo = config.get("sqlalchemy.echo", None)
-        self.writable = config.get("geo.%s.writable"%name, False)
-        self.encoding = config.get("geo.%s.encoding"%name, "utf-8")
-        self.attribute_cols = config.get("geo.%s.attribute_cols"%name, "*")
-        self.attribute_ignore = config.get("geo.%s.attribute_ignore"%name, [])
-
-        datasource = GeoAlchemy(
-            self.layer, 
-            srid = self.srid,
-            fid = self.fid,
-            geometry = self.geometry,
-            order = self.order,
-            attribute_cols = self.attribute_cols,
-            attribute_ignore = self.attribute_ignore,
-            writable = self.writable,
-            encoding = self.encoding,
-            session = session,
-            dburi = self.dburi,
-            sql_echo = self.sql_echo,
-            layer = self.layer,
-            model = self.model,
-            geom_rel = self.geom_rel,
-            geom_cls = self.geom_cls,
-            join_condition = self.join_condition,
-            cls = self.cls
-        )
-
-        self.server = Server({self.layer: datasource})
+        self.session = session
+        self.srid = settings['srid']
+        self.streaming = settings['streaming']
+        self.etags = settings['etags']
+        self.etag_query = settings['etag_query']
+        self.single_process = settings['single_process']
+        self.cache_control = settings['cache_control']
+        self.timing = settings['timing']
+        self.stats_data = None
+        if self.timing:
+            self.stats_data = LayerStats()
+        self._server = None
         self.allow_only = allow_only
         super(FeatureServerController, self).__init__()
 
+    @property
+    def datasource(self):
+        """The layer's datasource, built by the registry on first use."""
+        return registry.datasource(self.layer, self.session)
+
+    @property
+    def server(self):
+        if self._server is None:
+            self._server = Server({self.layer: self.datasource})
+        return self._server
+
+    def _actions(self, params, path_info=None):
+        """Parse a GET request into its FeatureServer select actions, or
+           None if it is not made of select actions only."""
+        service = Request(self.server)
+        service.parse(params, path_info or request.path_info, "", None,
+                      "GET")
+        actions = [action for action in service.actions
+                   if action.method == 'select']
+        if not actions or len(actions) != len(service.actions):
+            return None
+        return actions
+
+    def _features(self, actions, geometry_format='wkt'):
+        for action in actions:
+            for feature in self.datasource.iter_select(action,
+                                                       geometry_format):
+                yield feature
+
+    def _stream(self, params, format):
+        """Encode the selected features as they are read from the
+           database instead of rendering the whole response up front."""
+        actions = self._actions(params)
+        if actions is None:
+            return None
+        content_type, encoder = streaming.encoders[format]
+        response.headers['Content-type'] = content_type
+        return encoder(self._features(actions, 'arrays'), self.layer)
+
+    def _binary(self, params, format):
+        """Encode the selected features in one of the binary formats,
+           passing the geometry bytes from the database through."""
+        actions = self._actions(params)
+        if actions is None:
+            abort(400, "Binary formats only support feature selection")
+        geometry_format, content_type, encoder = binary.encoders[format]
+        if encoder is binary.flatgeobuf and binary.ogr is None:
+            # the encoder is a generator, it would only fail once the
+            # response has started
+            abort(501, "FlatGeobuf output requires the GDAL Python "
+                       "bindings (osgeo)")
+        response.headers['Content-type'] = content_type
+        return encoder(self._features(actions, geometry_format), self.layer,
+                       srid=self.datasource.output_srid() or self.srid)
+
+    def _hits(self, params):
+        """Answer resultType=hits requests with the number of matching
+           features, counted by the database without fetching them: an
+           empty FeatureCollection with numberOfFeatures for GML, a JSON
+           object for GeoJSON."""
+        format = request_format(params)
+        if format not in ('gml', 'wfs', 'geojson', 'json'):
+            abort(400, "resultType=hits is not supported for format %s"
+                       % format)
+        actions = self._actions(params)
+        if actions is None:
+            abort(400, "resultType=hits only supports feature selection")
+        total = 0
+        estimated = False
+        for action in actions:
+            count, estimate = self.datasource.hits(action)
+            total += count
+            estimated = estimated or estimate
+        if format in ('gml', 'wfs'):
+            response.headers['Content-type'] = 'text/xml'
+            return streaming.gml_hits(total)
+        response.headers['Content-type'] = 'application/json'
+        return json.dumps({'layer': self.layer, 'numberOfFeatures': total,
+                           'estimated': estimated})
+
+    def _released(self, chunks, timer=None):
+        """Release the datasource's sessions once a streamed response
+           has been sent."""
+        try:
+            for chunk in chunks:
+                if timer is not None:
+                    timer.bytes += len(chunk)
+                yield chunk
+        finally:
+            self.datasource.release()
+            self._record(timer)
+
+    def _timed(self, timer, resp):
+        """Finish timing a request answered with resp, sending the
+           timings as a Server-Timing header."""
+        if timer is None:
+            return
+        if isinstance(resp, basestring):
+            timer.bytes = len(resp)
+        self._record(timer)
+        response.headers['Server-Timing'] = timer.server_timing()
+
+    def _record(self, timer):
+        if timer is not None and timer.total is None:
+            timer.finish()
+            self.stats_data.record(timer)
+
+    @expose('json')
+    def stats(self, reset=None):
+        """GET /stats: request timing histograms of the layer, when
+           geo.<layer>.timing is set, and the counters of its cache."""
+        result = {'layer': self.layer}
+        if self.stats_data is not None:
+            result['timing'] = self.stats_data.as_dict()
+            if reset:
+                self.stats_data.reset()
+        if self.datasource.cache is not None:
+            result['cache'] = self.datasource.cache.stats()
+        return result
+
+    def _data_version(self):
+        """(version, modification time or None) of the layer's data, None
+           if it cannot be known (see the class docstring)."""
+        datasource = self.datasource
+        if self.etag_query:
+            value = datasource.read_session.execute(
+                text(self.etag_query)).scalar()
+            modified = None
+            if isinstance(value, datetime.datetime):
+                modified = calendar.timegm(value.utctimetuple())
+            return value, modified
+        if self.single_process:
+            return datasource.version, datasource.modified
+        return None
+
+    def _not_modified(self, params):
+        """Set the validators of a GET response and tell whether the
+           client's copy is still current. The ETag combines the data
+           version with the normalized request, so it can be checked
+           without running the query."""
+        if not self.etags or request.method != 'GET':
+            return False
+        if self.cache_control:
+            response.headers['Cache-Control'] = self.cache_control
+        version = self._data_version()
+        if version is None:
+            return False
+        version, modified = version
+        etag = '"%s"' % md5(repr((self.layer, version, request.path_info,
+                                  sorted(params.items())))).hexdigest()
+        response.headers['ETag'] = etag
+        if modified is not None:
+            modified = int(modified)
+            response.headers['Last-Modified'] = formatdate(modified,
+                                                           usegmt=True)
+        if_none_match = request.environ.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            return etag in [tag.strip() for tag in if_none_match.split(',')] \
+                or if_none_match.strip() == '*'
+        if_modified_since = request.environ.get('HTTP_IF_MODIFIED_SINCE')
+        if if_modified_since and modified is not None:
+            since = parsedate_tz(if_modified_since)
+            return since is not None and modified <= mktime_tz(since)
+        return False
+
     @expose()
     def default(self, *args, **kw):
-        params = {}
-        if request.environ.has_key('QUERY_STRING'):
-            for key, value in cgimod.parse_qsl(
-                request.environ['QUERY_STRING'], keep_blank_values=True):
-                params[key.lower()] = value
+        params = request_params()
+        self.datasource.set_request_params(params)
+        if self._not_modified(params):
+            self.datasource.release()
+            response.status_int = 304
+            return ''
+
+        timer = self.datasource.start_timer()
+        try:
+            resp = self._respond(params)
+        except:
+            self.datasource.release()
+            raise
+        if isinstance(resp, types.GeneratorType):
+            # the timings are only known once the response is sent, they
+            # go to the layer statistics but not into a header
+            return self._released(resp, timer)
+        self._link_next(params)
+        self.datasource.release()
+        self._timed(timer, resp)
+        return resp
+
+    def _transaction(self, params, data, method):
+        """Run a write request. A write the layer cannot apply rolls the
+           transaction back and is answered with 400 and a failed
+           WFS-T transaction result, as JSON outside of GML/WFS."""
+        try:
+            response.headers['Content-type'],resp = self.server.dispatchRequest(
+                params=params, path_info=request.path_info,
+                base_path="", post_data=data, request_method=method)
+        except TransactionError, e:
+            response.status_int = 400
+            if request_format(params) in ('gml', 'wfs'):
+                response.headers['Content-type'] = 'text/xml'
+                return streaming.transaction_failed(str(e))
+            response.headers['Content-type'] = 'application/json'
+            return json.dumps({'layer': self.layer, 'status': 'FAILED',
+                               'message': str(e)})
+        return resp
+
+    def _link_next(self, params):
+        """Point a keyset paged response to its next page with a Link
+           header, the request with the after and after_fid parameters of
+           the cursor."""
+        cursor = self.datasource.next_cursor()
+        if cursor is None:
+            return
+        params = dict(params)
+        for key, value in cursor.items():
+            if isinstance(value, unicode):
+                value = value.encode('utf-8')
+            params[key] = str(value)
+        response.headers['Link'] = '<%s?%s>; rel="next"' % (
+            request.path_url, urllib.urlencode(sorted(params.items())))
 
+    def _respond(self, params):
         if request.method == 'GET':
+            try:
+                self.datasource.output_srid()
+            except ValueError, e:
+                abort(400, str(e))
+            if params.get('resulttype', '').lower() == 'hits':
+                return self._hits(params)
+            format = request_format(params)
+            if format in binary.encoders:
+                return self._binary(params, format)
+            # a keyset page is bounded by max_features and answered whole,
+            # its next cursor is only known once the page has been read
+            if (self.streaming and format in streaming.encoders
+                    and self.datasource.paging != 'keyset'):
+                resp = self._stream(params, format)
+                if resp is not None:
+                    return resp
             response.headers['Content-type'],resp = self.server.dispatchRequest(
                 path_info=request.path_info, params=params, base_path= "")
             return resp
@@ -69,16 +329,129 @@ class FeatureServerController(TGController):
                 data = request.POST.keys()[0]
             else:
                 data = request.body
-            response.headers['Content-type'],resp = self.server.dispatchRequest(
-                params=params, path_info=request.path_info,
-                base_path="", post_data=data, request_method="POST")
-            return resp
+            return self._transaction(params, data, "POST")
         elif request.method == 'DELETE':
-            response.headers['Content-type'],resp = self.server.dispatchRequest(
-                params=params, path_info=request.path_info,
-                base_path="", post_data="", request_method="DELETE")
-            return resp
+            return self._transaction(params, "", "DELETE")
         else:
             flash("Unsupported method type %s" % request.method)
             redirect (request.referer)
 
+
+class VectorTileController(FeatureServerController):
+    """Serve a FeatureServer layer as Mapbox vector tiles, requested as
+       z/x/y.pbf on the standard XYZ Web Mercator grid whatever the
+       layer's SRID."""
+
+    def __init__(self, name, session, allow_only=None):
+        super(VectorTileController, self).__init__(name, session,
+                                                   allow_only)
+        settings = registry.settings(name)
+        self.tile_extent = int(settings['tile_extent'])
+        self.tile_buffer = int(settings['tile_buffer'])
+
+    @expose()
+    def default(self, *args, **kw):
+        if len(args) < 3:
+            abort(404)
+        try:
+            z, x, y = [int(arg.split('.')[0]) for arg in args[-3:]]
+        except ValueError:
+            abort(404)
+        if z < 0 or not (0 <= x < 2 ** z and 0 <= y < 2 ** z):
+            abort(404)
+        params = request_params()
+        # replaces the parameters a previous request left on this thread,
+        # such as propertyname
+        self.datasource.set_request_params(params)
+        if self._not_modified(params):
+            self.datasource.release()
+            response.status_int = 304
+            return ''
+        bbox = tiles.tile_bounds(z, x, y, tiles.MERCATOR_EXTENT)
+        timer = self.datasource.start_timer()
+        try:
+            features = self.datasource.iter_tile(z, x, y, self.tile_extent,
+                                                 self.tile_buffer)
+            tile = mvt.encode([(self.layer, features, bbox,
+                                self.tile_extent)])
+        finally:
+            self.datasource.release()
+        response.headers['Content-type'] = \
+            'application/vnd.mapbox-vector-tile'
+        self._timed(timer, tile)
+        return tile
+
+
+class MultiFeatureServerController(TGController):
+    """Serve several FeatureServer layers from one controller.
+
+       The layers of a request are given as a comma separated list, either
+       as the first path segment or as the layers parameter. They are
+       selected concurrently on a pool of at most workers threads, each
+       with its own session, and merged into one GeoJSON, GML or KML
+       document in which every feature is tagged with its layer.
+
+       A session is not safe to use from several threads, so session
+       should be a scoped_session (as the DBSession of a TurboGears
+       model is), giving each worker thread a session of its own. A
+       plain session is replaced by a scoped session over its engine;
+       one bound to no engine is refused with a ValueError."""
+
+    def __init__(self, names, session, allow_only=None, workers=4):
+        if isinstance(names, basestring):
+            names = [name.strip() for name in names.split(',')]
+        if session is not None and not hasattr(session, 'remove'):
+            if session.bind is None:
+                raise ValueError("MultiFeatureServerController needs a "
+                                 "scoped_session, or a session bound to "
+                                 "an engine")
+            session = scoped_session(sessionmaker(bind=session.bind))
+        self.layers = dict([(name, FeatureServerController(name, session))
+                            for name in names])
+        self.pool = ThreadPool(workers)
+        self.allow_only = allow_only
+        super(MultiFeatureServerController, self).__init__()
+
+    def _select(self, task):
+        """Select the features of one layer, on a pool thread."""
+        name, params = task
+        controller = self.layers[name]
+        datasource = controller.datasource
+        datasource.set_request_params(params)
+        try:
+            actions = controller._actions(params, "/" + name)
+            if actions is None:
+                return []
+            features = []
+            for action in actions:
+                features.extend(datasource.select(action))
+            return features
+        finally:
+            datasource.release(shared=True)
+
+    @expose()
+    def default(self, *args, **kw):
+        if request.method != 'GET':
+            abort(405)
+        params = request_params()
+        names = params.pop('layers', None) or (args and args[0]) or ''
+        names = [name for name in names.split(',') if name]
+        if not names:
+            abort(404)
+        for name in names:
+            if name not in self.layers:
+                abort(404, "Unknown layer %s" % name)
+        format = request_format(params)
+        if format not in streaming.formats:
+            abort(400, "Unsupported format %s" % format)
+        for name in names:
+            try:
+                self.layers[name].datasource.srs_srid(params.get('srsname'))
+            except ValueError, e:
+                abort(400, str(e))
+        results = self.pool.map(self._select,
+                                [(name, params) for name in names])
+        document, content_type = streaming.formats[format]
+        response.headers['Content-type'] = content_type
+        return streaming.document(document, zip(names, results),
+                                  tag_layer=True)
@@ -1,24 +1,43 @@
 from FeatureServer.DataSource import DataSource
 from vectorformats.Feature import Feature
 from vectorformats.Formats import WKT
-from sqlalchemy import create_engine, and_, func
-from sqlalchemy.orm import sessionmaker
+from sqlalchemy import and_, or_, func, bindparam, text
+from sqlalchemy.exc import DBAPIError
+from sqlalchemy.orm import class_mapper
+from sqlalchemy.sql import select, table, column, literal_column
+from geoalchemy.base import RawColumn
+from projector import FeatureProjector, names
+from timing import RequestTimer
+from registry import registry as layer_registry
+import tiles
+import wkb
+from tgext.geo.cache import LRUCache
 
 import copy
-import datetime
 import operator
+import threading
+import time
 
 try:
-    import decimal
-except:
-    pass
-    
+    import simplejson as json
+except ImportError:
+    import json
+
+class TransactionError (ValueError):
+    """A write that cannot be applied as asked, such as an update of a
+       missing feature or of a property the layer does not have. The
+       transaction is rolled back and reported as failed to the
+       client."""
+
+
 class GeoAlchemy (DataSource):
     """GeoAlchemy datasource. Setting up the table is beyond the scope of
        FeatureServer. However, GeoAlchemy supports table creation with
        geometry data types and can be used in a separate creation script."""
 
-    query_action_types = ['eq', 'ne', 'lt', 'gt', 'ilike', 'like', 'gte', 'lte']
+    query_action_types = ['eq', 'ne', 'lt', 'gt', 'ilike', 'like', 'gte', 'lte',
+                          'in', 'between', 'startswith', 'istartswith',
+                          'isnull', 'notnull', 'search']
 
     query_operators = {
         'eq': operator.eq,
@@ -29,10 +48,26 @@ class GeoAlchemy (DataSource):
         'gte': operator.ge,
     }
 
+    # number of values each operator compares with, None for a list
+    operator_arity = {
+        'in': None,
+        'between': 2,
+        'isnull': 0,
+        'notnull': 0,
+    }
+
     def __init__(self, name, srid=4326, fid="gid", geometry="the_geom",
             order="", attribute_cols='*', attribute_ignore=[], writable=True,
             encoding="utf-8", geom_cls=None, geom_rel=None,
-            join_condition=None, sql_echo=False, session=None, **args):
+            join_condition=None, sql_echo=False, session=None,
+            max_features=1000, paging="offset", yield_per=0,
+            bbox_filter="intersects", cache=None, cache_precision=6,
+            snap_bbox=False, snap_extent=None, simplify=False,
+            simplify_factor=1.0, twkb_precision=6, pool_size=None,
+            max_overflow=None, statement_timeout=None, read_dburi=None,
+            timing=False, search_mode="like", search_config="simple",
+            registry=None, hits_estimate=False, geometry_decoder="wkt",
+            output_srids=None, **args):
         DataSource.__init__(self, name, **args)
         self.dburi          = args["dburi"]
         self.sql_echo       = sql_echo
@@ -50,182 +85,996 @@ class GeoAlchemy (DataSource):
         self.encoding       = encoding
         self.attribute_cols = attribute_cols
         self.attribute_ignore = attribute_ignore
+        self.max_features   = int(max_features)
+        self.paging         = paging
+        self.yield_per      = int(yield_per)
+        self.bbox_filter    = bbox_filter
+        self.cache          = cache
+        self.cache_precision = int(cache_precision)
+        self.snap_bbox      = snap_bbox
+        self.snap_extent    = tiles.parse_extent(snap_extent, srid)
+        self.simplify       = simplify
+        self.simplify_factor = float(simplify_factor)
+        self.twkb_precision = int(twkb_precision)
+        self._local         = threading.local()
+        self._projector     = None
+        self._dialect       = None
+        self._spatial_index = None
+        self.pool_size      = pool_size
+        self.max_overflow   = max_overflow
+        self.statement_timeout = statement_timeout
+        self.read_dburi     = read_dburi
+        self.timing         = timing
+        self.search_mode    = search_mode
+        self.search_config  = search_config
+        self.registry       = registry or layer_registry
+        self.hits_estimate  = hits_estimate
+        self.geometry_decoder = geometry_decoder
+        self.output_srids   = [int(s) for s in names(output_srids)]
+        # attribute filter expressions by filter shape
+        self.predicates     = LRUCache(max_entries=256)
+        # bumped by every commit writing features in this process, for
+        # the response validators of single process deployments
+        self.version        = 0
+        self.modified       = None
+        # scoped sessions created here, removed by release()
+        self.scoped_sessions = []
 
         if not self.session:
-            self.engine = create_engine(self.dburi, echo=self.sql_echo)
-            self.session = sessionmaker(bind=self.engine)()
+            self.engine, self.session = self.create_session(self.dburi)
+        self.read_session = self.session
+        if self.read_dburi and not self.writable:
+            # read-only layers can be served from a replica
+            self.read_engine, self.read_session = \
+                self.create_session(self.read_dburi)
+        elif (self.session not in self.scoped_sessions and self.dburi and
+              (pool_size is not None or max_overflow is not None
+               or statement_timeout)):
+            # the pool settings cannot be applied to the application's
+            # session, reads go through an engine of the layer's own
+            self.read_engine, self.read_session = \
+                self.create_session(self.dburi)
+
+    def create_session(self, dburi):
+        """Return the pooled engine for dburi and a thread local session
+           over it, so concurrent requests each get their own session and
+           connection. Layers on the same database share them."""
+        engine, session = self.registry.session(dburi, self.sql_echo,
+            self.pool_size, self.max_overflow, self.statement_timeout)
+        if session not in self.scoped_sessions:
+            self.scoped_sessions.append(session)
+        return engine, session
+
+    def release(self, shared=False):
+        """Return the connections of the current thread's sessions to the
+           pool once a request is done with them. With shared, the thread's
+           session of a scoped session handed in by the application is
+           removed as well, for threads the application does not manage."""
+        for session in self.scoped_sessions:
+            session.remove()
+        if shared and hasattr(self.session, 'remove') and \
+                self.session not in self.scoped_sessions:
+            self.session.remove()
+
+    def projector(self):
+        """Return the FeatureProjector for this layer, compiled on first
+           use."""
+        if self._projector is None:
+            self._projector = FeatureProjector(self)
+        return self._projector
+
+    def set_request_params(self, params):
+        """Make the raw request parameters available to the datasource
+           for the current thread. FeatureServer only hands the parsed
+           Action to the datasource, which does not carry paging cursors
+           and similar extensions."""
+        self._local.params = params or {}
+        self._local.cursor = None
+
+    def request_param(self, key, default=None):
+        return getattr(self._local, 'params', {}).get(key, default)
+
+    def next_cursor(self):
+        """The after and after_fid parameters of the page following the
+           last keyset paged select of the current thread, None if that
+           page was the last one."""
+        return getattr(self._local, 'cursor', None)
+
+    def start_timer(self):
+        """Start timing the request handled by the current thread, if
+           the layer is instrumented, and return its RequestTimer."""
+        timer = None
+        if self.timing:
+            timer = RequestTimer()
+        self._local.timer = timer
+        return timer
+
+    def timer(self):
+        """The RequestTimer of the current thread's request, or None."""
+        return getattr(self._local, 'timer', None)
 
     def feature_predicate(self, key,operator_name,value):
+        return self.attribute_predicate(key, operator_name,
+            self.operator_values(operator_name, value))
+
+    def operator_values(self, operator_name, value):
+        """The values an attribute filter compares its column with, from
+           the request value: like patterns are built here, in takes a
+           comma separated list and between two values."""
+        arity = self.operator_arity.get(operator_name, 1)
+        if arity == 0:
+            return []
+        if arity != 1:
+            values = [v.strip() for v in value.split(',')]
+            if arity is not None and len(values) != arity:
+                raise ValueError("%s needs %d comma separated values"
+                                 % (operator_name, arity))
+            return values
+        if operator_name in ('like', 'ilike'):
+            return ['%'+value+'%']
+        if operator_name == 'startswith':
+            return [self.like_escape(value) + '%']
+        if operator_name == 'istartswith':
+            return [self.like_escape(value).lower() + '%']
+        if operator_name == 'search' and self.search_mode == 'like':
+            return ['%' + self.like_escape(value) + '%']
+        return [value]
+
+    def like_escape(self, value):
+        """Escape the LIKE wildcards in value, with backslash."""
+        for char in ('\\', '%', '_'):
+            value = value.replace(char, '\\' + char)
+        return value
+
+    def attribute_predicate(self, key, operator_name, values):
+        """Filter expression applying operator_name to column key and the
+           values, literals or bind parameters.
+
+           startswith and istartswith are prefix patterns, which a B-tree
+           index can answer (on PostgreSQL one with text_pattern_ops, on
+           lower(column) for istartswith), unlike the substring patterns
+           of like and ilike. search is a case insensitive substring match
+           unless search_mode is 'fts', matching the words of the value
+           with PostgreSQL full text search, or 'trigram', using the
+           similarity operator of pg_trgm; GIN indexes answer both."""
         if operator_name == 'like':
-            return key.like('%'+value+'%')
+            return key.like(values[0])
         elif operator_name == 'ilike':
-            return key.ilike('%'+value+'%')
+            return key.ilike(values[0])
+        elif operator_name == 'startswith':
+            return key.like(values[0], escape='\\')
+        elif operator_name == 'istartswith':
+            return func.lower(key).like(values[0], escape='\\')
+        elif operator_name == 'in':
+            return key.in_(values)
+        elif operator_name == 'between':
+            return key.between(values[0], values[1])
+        elif operator_name == 'isnull':
+            return key == None
+        elif operator_name == 'notnull':
+            return key != None
+        elif operator_name == 'search':
+            if self.search_mode == 'fts':
+                return func.to_tsvector(self.search_config, key).op('@@')(
+                    func.plainto_tsquery(self.search_config, values[0]))
+            elif self.search_mode == 'trigram':
+                return key.op('%')(values[0])
+            return key.ilike(values[0], escape='\\')
         else:
-            return self.query_operators[operator_name](key,value)
+            return self.query_operators[operator_name](key,values[0])
+
+    def attribute_filter(self, attributes):
+        """Return the filter expression of an action's attribute filters,
+           with bind parameters in place of the values, and the values.
+           The expression is built once for each filter shape (columns,
+           operators and number of values) and reused by the requests
+           sharing it."""
+        shape = []
+        values = {}
+        for k, v in sorted(attributes.items()):
+            operands = self.operator_values(v['type'], v['value'])
+            shape.append((k, v['type'], len(operands)))
+            for index, operand in enumerate(operands):
+                values['f_%s_%s_%d' % (k, v['type'], index)] = operand
+        shape = tuple(shape)
+        predicate = self.predicates.get(shape)
+        if predicate is None:
+            cls = self.projector().cls
+            predicates = []
+            for k, operator_name, count in shape:
+                column = getattr(cls, k)
+                # the type of the table column, mapped attributes only
+                # have one from SQLAlchemy 0.8 on
+                coltype = cls.__table__.c[k].type
+                params = [bindparam('f_%s_%s_%d' % (k, operator_name, index),
+                                    type_=coltype)
+                          for index in range(count)]
+                predicates.append(
+                    self.attribute_predicate(column, operator_name, params))
+            predicate = and_(*predicates)
+            self.predicates.set(shape, predicate)
+        return predicate, values
 
     def bbox2wkt(self, bbox):
         return "POLYGON((%s %s, %s %s, %s %s, %s %s, %s %s))" % (bbox[0],
         bbox[1],bbox[0],bbox[3],bbox[2],bbox[3],bbox[2],bbox[1],bbox[0],bbox[1])
 
+    def dialect_name(self):
+        """Name of the database dialect the layer's class is bound to."""
+        if self._dialect is None:
+            bind = self.session.get_bind(class_mapper(self.projector().cls))
+            self._dialect = bind.dialect.name
+        return self._dialect
+
+    def spatial_func(self, name):
+        """Return the SQL function name, prefixed with ST_ on PostGIS where
+           newer functions only exist in the prefixed form."""
+        if self.dialect_name() in ('postgres', 'postgresql'):
+            return getattr(func, 'ST_' + name)
+        return getattr(func, name)
+
+    def simplify_tolerance(self):
+        """Simplification tolerance for the resolution (map units per
+           pixel) or zoom level of the request, None if the layer or the
+           request do not ask for simplification. Zoom levels are those of
+           the layer grid, so they are ignored for projected layers
+           without a snap_extent."""
+        if not self.simplify:
+            return None
+        resolution = self.request_param('resolution')
+        zoom = self.request_param('zoom')
+        try:
+            if resolution:
+                resolution = float(resolution)
+            elif zoom and self.snap_extent is not None:
+                resolution = tiles.zoom_resolution(int(zoom),
+                                                   self.snap_extent)
+        except ValueError:
+            return None
+        if not resolution:
+            return None
+        return resolution * self.simplify_factor
+
+    def geometry_expression(self, geom_element):
+        """The geometry as it should be returned for this request."""
+        tolerance = self.simplify_tolerance()
+        if tolerance:
+            return self.spatial_func('SimplifyPreserveTopology')(
+                geom_element, tolerance)
+        return geom_element
+
+    def srs_srid(self, srs_name):
+        """The SRID of srsName srs_name, None for the layer's own SRID.
+           With output_srids, only those can be asked for."""
+        if not srs_name:
+            return None
+        srid = tiles.parse_srs(srs_name)
+        if srid == int(self.srid):
+            return None
+        if self.output_srids and srid not in self.output_srids:
+            raise ValueError("Layer %s is not available in srsName %s"
+                             % (self.name, srs_name))
+        return srid
+
+    def output_srid(self):
+        """The SRID the request asked for with srsName, None unless the
+           geometries and the bbox have to be transformed."""
+        return self.srs_srid(self.request_param('srsname'))
+
+    def reproject(self, geometry):
+        """geometry transformed in the database to the output SRID."""
+        srid = self.output_srid()
+        if srid is None:
+            return geometry
+        return self.spatial_func('Transform')(geometry, srid)
+
+    def geometry_column(self, geom_element, geometry_format='wkt'):
+        """Select expression serializing the geometry in the database as
+           WKT, WKB or TWKB, in the output SRID."""
+        return self.serialize(
+            self.reproject(self.geometry_expression(geom_element)),
+            geometry_format)
+
+    def serialize(self, geometry, geometry_format='wkt'):
+        """Select expression serializing geometry for geometry_format.
+           Geometries decoded here ('wkt' and 'arrays') are read as WKB
+           when the layer's geometry_decoder is 'wkb', 'tile' geometries
+           always are."""
+        if geometry_format in ('wkb', 'tile') or (
+                self.geometry_decoder == 'wkb' and
+                geometry_format in ('wkt', 'arrays')):
+            return self.spatial_func('AsBinary')(geometry)
+        elif geometry_format == 'twkb':
+            return self.spatial_func('AsTWKB')(geometry, self.twkb_precision)
+        return self.spatial_func('AsText')(geometry)
+
+    def decoder(self, geometry_format='wkt'):
+        """The function decoding geometries selected for geometry_format,
+           None when the bytes from the database are passed on. 'wkt'
+           geometries decode to the nested lists FeatureServer expects,
+           'arrays' geometries to wkb.Coordinates sequences when the layer
+           decodes WKB. 'tile' geometries are always decoded from WKB:
+           clipped to a tile they may turn into collections, which
+           WKT.from_wkt cannot read, and it flattens multipolygons."""
+        if geometry_format == 'tile':
+            return wkb.decode
+        if geometry_format not in ('wkt', 'arrays'):
+            return None
+        if self.geometry_decoder != 'wkb':
+            return WKT.from_wkt
+        if geometry_format == 'arrays':
+            return wkb.decode
+        return wkb.decode_lists
+
+    def envelope(self, bbox, srid=None):
+        """The polygon of bbox in the layer SRID, transformed from srid
+           if given."""
+        from_text = self.spatial_func('GeomFromText')
+        if srid is None:
+            return from_text(self.bbox2wkt(bbox), self.srid)
+        return self.spatial_func('Transform')(
+            from_text(self.bbox2wkt(bbox), srid), self.srid)
+
+    def bbox_predicate(self, geom_element, bbox, srid=None):
+        """Filter on bbox, with the envelope built from a bound WKT
+           parameter inside the main query. The bounding box overlap test
+           is the one the spatial index answers; unless bbox_filter is
+           'bbox' (enough for point layers) the exact intersection is
+           checked on the rows it leaves. A bbox in another srid is
+           transformed to the layer's, never the column to the bbox's, so
+           the index still applies."""
+        envelope = self.envelope(bbox, srid)
+        if self.dialect_name() in ('postgres', 'postgresql'):
+            overlaps = geom_element.op('&&')(envelope)
+        elif self.spatialite_index():
+            overlaps = self.spatial_index_predicate(envelope)
+        else:
+            overlaps = func.MbrIntersects(geom_element, envelope)
+        if self.bbox_filter == 'bbox':
+            return overlaps
+        return and_(overlaps, geom_element.intersects(envelope))
+
+    def geometry_table(self):
+        """Name of the table holding the geometry column."""
+        projector = self.projector()
+        if self.geom_rel and self.geom_cls:
+            return projector.geom_cls.__tablename__
+        return projector.cls.__tablename__
+
+    def spatialite_index(self):
+        """Whether the geometry column has a SpatiaLite R*Tree index (as
+           created by geo-model), looked up in geometry_columns once."""
+        if self._spatial_index is None:
+            enabled = None
+            if self.dialect_name() == 'sqlite':
+                bind = self.read_session.get_bind(
+                    class_mapper(self.projector().cls))
+                try:
+                    enabled = bind.execute(text(
+                        "SELECT spatial_index_enabled FROM geometry_columns "
+                        "WHERE lower(f_table_name) = lower(:table) "
+                        "AND lower(f_geometry_column) = lower(:column)"),
+                        table=self.geometry_table(),
+                        column=self.geom_col).scalar()
+                except DBAPIError:
+                    enabled = None
+            # 1 is an R*Tree, 2 an MBR cache SpatialIndex cannot search
+            self._spatial_index = enabled == 1
+        return self._spatial_index
+
+    def spatial_index_predicate(self, envelope):
+        """Restrict the geometry table to the rows the SpatiaLite R*Tree
+           finds for envelope; MbrIntersects alone scans the table."""
+        name = self.geometry_table()
+        index = table('SpatialIndex', column('rowid'), column('f_table_name'),
+                      column('f_geometry_column'), column('search_frame'))
+        rowids = select([index.c.rowid], and_(
+            index.c.f_table_name == name,
+            index.c.f_geometry_column == self.geom_col,
+            index.c.search_frame == envelope))
+        return literal_column('%s.rowid' % name).in_(rowids)
+
     def begin (self):
-        pass
+        self._local.pending = []
 
     def commit (self):
         if self.writable:
+            written = self.pending()
+            self.flush_transaction()
             self.session.commit()
+            if written:
+                self.version += 1
+                self.modified = time.time()
+                if self.cache is not None:
+                    self.cache.clear()
+        self._local.pending = []
 
     def rollback (self):
+        self._local.pending = []
         if self.writable:
             self.session.rollback()
 
+    def pending(self):
+        """Writes queued by the transaction running on this thread."""
+        if not hasattr(self._local, 'pending'):
+            self._local.pending = []
+        return self._local.pending
+
+    def fid_value(self, value):
+        try:
+            return int(value)
+        except (TypeError, ValueError):
+            return value
+
     def create (self, action):
-        model = __import__(self.model, fromlist=['*'])
-        cls = getattr(model, self.cls)
         feature = action.feature
-        obj =  cls()
-        for prop in feature.properties.keys():
-            setattr(obj, prop, feature.properties[prop])
-        if self.geom_rel and self.geom_cls:
-            geom_cls = getattr(model, self.geom_cls)
-            geom_obj = geom_cls()
-            setattr(geom_obj, self.geom_col, WKT.to_wkt(feature.geometry))
-            try:
-                getattr(obj, self.geom_rel).append(geom_obj)
-            except:
-                # Handle specific exception
-                setattr(obj, self.geom_rel, geom_obj)
-            self.session.add(geom_obj)
-        elif feature.geometry:
-            setattr(obj, self.geom_col, WKT.to_wkt(feature.geometry))
-        else:
-            pass
-        self.session.add(obj)
-        return self.select(action)
-        
+        result = Feature(None, feature.geometry, dict(feature.properties))
+        self.pending().append(('create', action, result))
+        return [result]
 
     def update (self, action):
-        model = __import__(self.model, fromlist=['*'])
-        cls = getattr(model, self.cls)
         feature = action.feature
-        obj = self.session.query(cls).get(int(action.id))
-        for prop in feature.properties.keys():
-            setattr(obj, prop, feature.properties[prop])
-        if self.geom_rel and self.geom_cls:
-            geom_obj = getattr(obj, self.geom_rel)
-            setattr(geom_obj, self.geom_col, WKT.to_wkt(feature.geometry))
-            self.session.add(geom_obj)
-        elif feature.geometry:
-            setattr(obj, self.geom_col, WKT.to_wkt(feature.geometry))
-        else:
-            pass
-        self.session.add(obj)
-        return self.select(action)
-        
+        result = Feature(self.fid_value(action.id), feature.geometry,
+                         dict(feature.properties))
+        self.pending().append(('update', action, result))
+        return [result]
+
     def delete (self, action):
-        model = __import__(self.model, fromlist=['*'])
-        cls = getattr(model, self.cls)
-        obj = self.session.query(cls).get(action.id)
-        if self.geom_rel and self.geom_col:
-            geom_obj = getattr(obj, self.geom_rel)
-            if isinstance(geom_obj, (tuple, list, dict, set)):
-                #TODO Should all related objects be purged
-                self.session.delete(geom_obj[-1])
-            else:
-                self.session.delete(geom_obj)
-        self.session.delete(obj)
+        self.pending().append(('delete', action, None))
         return []
 
-    def select (self, action):
-        model = __import__(self.model, fromlist=['*'])
-        cls = getattr(model, self.cls)
-        geom_cls = None
-        if self.geom_cls:
-            geom_cls = getattr(model, self.geom_cls)
-        if action.id is not None:
-            result = [self.session.query(cls).get(action.id)]
-        else:
+    def flush_transaction(self):
+        """Write the queued actions of the transaction in bulk: all
+           inserts in one flush, updates as executemany statements and
+           deletes by a single IN query. The features returned by
+           create and update are completed in place, so nothing has to
+           be selected again once written."""
+        pending = self.pending()
+        creates = [(a, r) for m, a, r in pending if m == 'create']
+        updates = [(a, r) for m, a, r in pending if m == 'update']
+        deletes = [self.fid_value(a.id) for m, a, r in pending
+                   if m == 'delete']
+        if creates:
+            self.bulk_create(creates)
+        if updates:
+            self.bulk_update(updates)
+        if deletes:
+            self.bulk_delete(deletes)
+
+    def check_properties(self, feature):
+        """Raise TransactionError if feature has properties that are not
+           columns of the layer."""
+        unknown = [k for k in feature.properties.keys()
+                   if k not in self.projector().writable]
+        if unknown:
+            raise TransactionError("Layer %s has no properties %s"
+                                   % (self.name, ', '.join(sorted(unknown))))
+
+    def bulk_create(self, creates):
+        projector = self.projector()
+        cls = projector.cls
+        objs = []
+        for action, result in creates:
+            feature = action.feature
+            self.check_properties(feature)
+            obj =  cls()
+            for prop in feature.properties.keys():
+                setattr(obj, prop, feature.properties[prop])
             if self.geom_rel and self.geom_cls:
-                main_table = cls.__tablename__
-                geom_table = geom_cls.__tablename__
-                join_condition = self.join_condition or "%s.%s_id=%s.id" % (
-			main_table, geom_table, geom_table)
-                query = self.session.query(cls, geom_cls).filter(join_condition)
-            else:
-                query = self.session.query(cls)
-            if action.attributes:
-                query = query.filter(
-                    and_(
-                        *[self.feature_predicate(getattr(cls, k),
-				v['type'], v['value'])
-				for k, v in action.attributes.iteritems()]
-                    )
-                )
-            if action.bbox:
-                if self.geom_rel and self.geom_cls:
-                    geom_element = getattr(geom_cls, self.geom_col)
+                geom_obj = projector.geom_cls()
+                setattr(geom_obj, self.geom_col, WKT.to_wkt(feature.geometry))
+                try:
+                    getattr(obj, self.geom_rel).append(geom_obj)
+                except:
+                    # Handle specific exception
+                    setattr(obj, self.geom_rel, geom_obj)
+                self.session.add(geom_obj)
+            elif feature.geometry:
+                setattr(obj, self.geom_col, WKT.to_wkt(feature.geometry))
+            self.session.add(obj)
+            objs.append((obj, result))
+        # one flush for the whole batch assigns the new ids
+        self.session.flush()
+        for obj, result in objs:
+            result.id = getattr(obj, self.fid_col)
+
+    def bulk_update(self, updates):
+        cls = self.projector().cls
+        for action, result in updates:
+            self.check_properties(action.feature)
+        if self.geom_rel and self.geom_cls:
+            fid = getattr(cls, self.fid_col)
+            ids = [result.id for action, result in updates]
+            objs = dict([(getattr(obj, self.fid_col), obj) for obj in
+                self.session.query(cls).filter(fid.in_(ids)).all()])
+            missing = [id for id in ids if id not in objs]
+            if missing:
+                raise TransactionError("No features %s in layer %s to update"
+                                 % (missing, self.name))
+            for action, result in updates:
+                feature = action.feature
+                obj = objs[result.id]
+                for prop in feature.properties.keys():
+                    setattr(obj, prop, feature.properties[prop])
+                geom_obj = getattr(obj, self.geom_rel)
+                setattr(geom_obj, self.geom_col, WKT.to_wkt(feature.geometry))
+                self.session.add(geom_obj)
+            return
+
+        # updates setting the same columns share one executemany statement;
+        # column values are bound as v_<column>, the fid under a name no
+        # property can turn into
+        table = cls.__table__
+        statements = {}
+        for action, result in updates:
+            feature = action.feature
+            values = dict([('v_%s' % k, v)
+                           for k, v in feature.properties.items()])
+            if feature.geometry:
+                values['v_%s' % self.geom_col] = WKT.to_wkt(feature.geometry)
+            keys = tuple(sorted(values.keys()))
+            values['_tgext_fid'] = result.id
+            statements.setdefault(keys, []).append(values)
+        for keys, rows in statements.items():
+            columns = {}
+            for key in keys:
+                col = key[2:]
+                if col == self.geom_col:
+                    columns[col] = self.spatial_func('GeomFromText')(
+                        bindparam(key), self.srid)
                 else:
-                    geom_element = getattr(cls, self.geom_col)
-                query = query.filter(geom_element.intersects(
-                    self.session.scalar(func.GeomFromText(
-			self.bbox2wkt(action.bbox), self.srid))))
-            if self.order:
-                query = query.order_by(getattr(cls, self.order))
-            if action.maxfeatures:
-                query.limit(action.maxfeatures)
-            else:   
-                query.limit(1000)
-            if action.startfeature:
-                query.offset(action.startfeature)
-            result = query.all()
+                    columns[col] = bindparam(key)
+            statement = table.update().where(
+                table.c[self.fid_col] == bindparam('_tgext_fid')).values(
+                columns)
+            updated = self.session.execute(statement, rows).rowcount
+            if updated is not None and 0 <= updated < len(rows):
+                ids = [row['_tgext_fid'] for row in rows]
+                raise TransactionError("Features %s of layer %s not all "
+                                       "found to update" % (ids, self.name))
+
+    def bulk_delete(self, ids):
+        """Delete the features ids with a single statement, or through
+           the ORM when the layer's relations cascade deletes, and raise
+           TransactionError if any of them is missing."""
+        projector = self.projector()
+        cls = projector.cls
+        fid = getattr(cls, self.fid_col)
+        ids = list(set(ids))
+        if (self.geom_rel and self.geom_cls) or projector.cascade_delete:
+            objs = self.session.query(cls).filter(fid.in_(ids)).all()
+            deleted = len(objs)
+            for obj in objs:
+                if self.geom_rel and self.geom_cls:
+                    geom_obj = getattr(obj, self.geom_rel)
+                    if isinstance(geom_obj, (tuple, list, dict, set)):
+                        #TODO Should all related objects be purged
+                        self.session.delete(geom_obj[-1])
+                    else:
+                        self.session.delete(geom_obj)
+                self.session.delete(obj)
+        else:
+            table = cls.__table__
+            deleted = self.session.execute(
+                table.delete().where(table.c[self.fid_col].in_(ids))).rowcount
+        if deleted is not None and 0 <= deleted < len(ids):
+            raise TransactionError("Features %s of layer %s not all found "
+                                   "to delete" % (sorted(ids), self.name))
+
+    def cache_key(self, action):
+        """Normalize the parts of a select action that decide its result.
+           The bbox is rounded to cache_precision decimals so requests
+           for practically the same area share an entry."""
+        bbox = None
+        if action.bbox:
+            bbox = tuple([round(float(c), self.cache_precision)
+                          for c in action.bbox])
+        attributes = None
+        if action.attributes:
+            attributes = tuple(sorted([(k, v['type'], v['value'])
+                                       for k, v in action.attributes.items()]))
+        properties = self.request_param('propertyname')
+        if properties:
+            properties = tuple(sorted(set(names(properties))))
+        return (self.name, action.id, bbox, attributes, action.maxfeatures,
+                action.startfeature, self.request_param('after'),
+                self.request_param('after_fid'), self.request_param('format'), self.simplify_tolerance(),
+                properties, self.output_srid())
+
+    def feature_size(self, feature):
+        """Rough estimate of the memory held by a cached feature."""
+        def count(coords):
+            if coords and isinstance(coords[0], (list, tuple)):
+                return sum([count(c) for c in coords])
+            return len(coords)
+        size = 200 + 24 * count(feature.geometry.get('coordinates', ()))
+        for key, value in feature.properties.items():
+            size += 60 + len(key) + len(unicode(value))
+        return size
+
+    def select (self, action):
+        # the snapping grid is in the layer's SRID, reprojected requests
+        # are cached by their own bbox; projected layers only snap to a
+        # configured snap_extent
+        if (self.snap_bbox and self.snap_extent is not None
+                and action.bbox and action.id is None
+                and not action.startfeature and self.output_srid() is None
+                and self.request_param('after') is None):
+            features = self.select_snapped(action)
+        else:
+            features = self.cached_select(action)
+        self.page_cursor(action, features)
+        return features
+
+    def page_cursor(self, action, features):
+        """Remember where the page after features starts when keyset
+           paging filled the page, see next_cursor."""
+        cursor = None
+        limit = self.page_limit(action)
+        if (self.paging == 'keyset' and self.order and action.id is None
+                and limit and len(features) >= limit):
+            last = features[-1]
+            cursor = {'after': last.sort_key, 'after_fid': last.id}
+        self._local.cursor = cursor
 
+    def select_snapped(self, action):
+        """Answer a bbox request from the grid tiles covering it. Each
+           tile is selected (and cached) on its own, the union is then cut
+           down to the features the bbox filter of an unsnapped select
+           would keep, and paged.
+           A tile holding max_features features may have been cut short,
+           the request is then selected unsnapped instead."""
+        bbox = [float(c) for c in action.bbox]
+        seen = {}
         features = []
-        for row_tuple in result:
-            props = {}
-            id = None
-            geom = None
-            if not isinstance(row_tuple, (tuple, list, dict, set)):
-                row_tuple = (row_tuple,)
-            for  row in row_tuple:
-                if isinstance(row, cls):
-                    cols = cls.__table__.c.keys()
-                    for col in cols:
-                        if col == self.fid_col:
-                            id = getattr(row, col)
-                        elif col == self.geom_col:
-                            geom = getattr(row, col) and WKT.from_wkt(
-                                self.session.scalar(getattr(row, col).wkt))
-                        else:
-                            if self.attribute_cols == '*' or col in self.attribute_cols:
-                                if col not in self.attribute_ignore:
-                                    props[col] = getattr(row, col)
-                elif isinstance(row, geom_cls) and geom_cls:
-                    cols = geom_cls.__table__.c.keys()
-                    for col in cols:
-                        if col == self.fid_col:
-                            pass
-                        elif col == self.geom_col:
-                            geom = getattr(row, col) and WKT.from_wkt(
-                                self.session.scalar(getattr(row, col).wkt))
-                        else:
-                            if self.attribute_cols == '*' or col in self.attribute_cols:
-                                if col not in self.attribute_ignore:
-                                    props[col] = getattr(row, col)
-                else:
+        for tile in tiles.snap(bbox, self.snap_extent):
+            tile_action = copy.copy(action)
+            tile_action.bbox = tile
+            tile_action.maxfeatures = None
+            tile_features = self.cached_select(tile_action)
+            if self.max_features and len(tile_features) >= self.max_features:
+                return self.cached_select(action)
+            for feature in tile_features:
+                if feature.id in seen:
+                    continue
+                seen[feature.id] = True
+                feature_bounds = tiles.bounds(feature.geometry)
+                if not feature_bounds or \
+                        not tiles.intersects(feature_bounds, bbox):
+                    continue
+                if self.bbox_filter != 'bbox' and \
+                        not tiles.geometry_intersects(feature.geometry, bbox):
                     continue
+                features.append(feature)
+        if self.order:
+            features.sort(key=lambda f: (f.sort_key, f.id))
+        if action.maxfeatures:
+            features = features[:int(action.maxfeatures)]
+        return features
+
+    def cached_select (self, action):
+        if self.cache is None:
+            return list(self.iter_select(action))
+        key = self.cache_key(action)
+        features = self.cache.get(key)
+        if features is None:
+            features = list(self.iter_select(action))
+            self.cache.set(key, features,
+                           sum([self.feature_size(f) for f in features]))
+        return list(features)
+
+    def geometry_element(self):
+        """The mapped geometry column, on the geometry class for geom_rel
+           layers."""
+        projector = self.projector()
+        if self.geom_rel and self.geom_cls:
+            return getattr(projector.geom_cls, self.geom_col)
+        return getattr(projector.cls, self.geom_col)
+
+    def geometry_source(self):
+        """The geometry column of the layer's table, for the expressions
+           of the columns clause. GeoAlchemy wraps the mapped attribute in
+           AsBinary wherever it appears there, inside functions too, and
+           AsText(AsBinary(geom)) is NULL on SpatiaLite and loses the SRID
+           Transform needs on PostGIS."""
+        projector = self.projector()
+        cls = projector.cls
+        if self.geom_rel and self.geom_cls:
+            cls = projector.geom_cls
+        return RawColumn(cls.__table__.c[self.geom_col])
 
-            for key, value in props.items():
-                if isinstance(value, str): 
-                    props[key] = unicode(value, self.encoding)
-                elif isinstance(value, datetime.datetime) or isinstance(value, datetime.date):
-                    # stringify datetimes 
-                    props[key] = str(value)
-                    
+    def select_plan(self):
+        """The projector plan of the properties asked for by the
+           propertyname parameter of the request, all by default."""
+        return self.projector().select_plan(
+            self.request_param('propertyname'))
+
+    def base_query(self, plan, *columns):
+        """Query the fid and the columns of plan, joined with the geometry
+           class for geom_rel layers, followed by columns. Only plain
+           columns are loaded, no ORM instances are built for them."""
+        projector = self.projector()
+        query = self.read_session.query(
+            *(projector.columns(plan) + list(columns)))
+        return self.join_query(query)
+
+    def join_query(self, query):
+        """Join query with the geometry class for geom_rel layers."""
+        if self.geom_rel and self.geom_cls:
+            projector = self.projector()
+            main_table = projector.cls.__tablename__
+            geom_table = projector.geom_cls.__tablename__
+            join_condition = self.join_condition or "%s.%s_id=%s.id" % (
+                main_table, geom_table, geom_table)
+            return query.filter(join_condition)
+        return query
+
+    def filter_query(self, query, action):
+        """Restrict query to the attribute and bbox filters of action."""
+        if action.attributes:
+            predicate, values = self.attribute_filter(action.attributes)
+            query = query.filter(predicate).params(**values)
+        if action.bbox:
+            query = query.filter(self.bbox_predicate(
+                self.geometry_element(), action.bbox, self.output_srid()))
+        return query
+
+    def page_query(self, query, action):
+        """Order query and cut it to the page requested by action."""
+        if self.order:
+            projector = self.projector()
+            order_col = getattr(projector.cls, self.order)
+            fid = projector.fid
+            query = query.order_by(order_col)
+            if self.order != self.fid_col:
+                # the fid breaks ties, so rows sharing an order value
+                # keep their place from one page to the next
+                query = query.order_by(fid)
+            # keyset paging seeks past the last seen (order value, fid),
+            # so deep pages cost the same as the first one
+            after = self.request_param('after')
+            if self.paging == 'keyset' and after is not None:
+                after_fid = self.request_param('after_fid')
+                if self.order == self.fid_col:
+                    query = query.filter(fid > self.fid_value(after))
+                elif after_fid is None:
+                    query = query.filter(order_col > after)
+                else:
+                    query = query.filter(or_(
+                        order_col > after,
+                        and_(order_col == after,
+                             fid > self.fid_value(after_fid))))
+        limit = self.page_limit(action)
+        if limit:
+            query = query.limit(limit)
+        if action.startfeature:
+            query = query.offset(action.startfeature)
+        return query
+
+    def page_limit(self, action):
+        """The number of features a page of action holds at most, 0
+           without a limit."""
+        limit = self.max_features
+        if action.maxfeatures:
+            limit = int(action.maxfeatures)
+            if self.max_features:
+                limit = min(limit, self.max_features)
+        return limit or 0
+
+    def execute(self, query):
+        """Run query, fetching rows in batches from a server side cursor
+           instead of buffering the whole result set if yield_per is
+           set."""
+        if self.yield_per:
+            if hasattr(query, 'execution_options'):
+                query = query.execution_options(stream_results=True)
+            return query.yield_per(self.yield_per)
+        timer = self.timer()
+        if timer is None:
+            return query.all()
+        start = time.time()
+        result = query.all()
+        timer.add('sql', time.time() - start)
+        return result
+
+    def features(self, result, geometry_format='wkt', plan=None):
+        projector = self.projector()
+        decode = self.decoder(geometry_format)
+        timer = self.timer()
+        if timer is not None:
+            for feature in self.timed_features(timer, result, decode, plan):
+                yield feature
+            return
+        for row in result:
+            feature = projector.feature(row, decode, plan)
+            if feature is not None:
+                yield feature
+
+    def timed_features(self, timer, result, decode, plan=None):
+        """features() recording the time spent fetching rows, converting
+           properties and decoding geometries in timer."""
+        projector = self.projector()
+        clock = time.time
+        rows = iter(result)
+        sql = properties = decoding = 0.0
+        try:
+            while True:
+                start = clock()
                 try:
-                    if isinstance(value, decimal.Decimal):
-                        props[key] = unicode(str(value), self.encoding)
-                except:
-                    pass
-                    
-            if (geom):
-                features.append( Feature( id, geom, props ) ) 
-        return features
+                    row = rows.next()
+                except StopIteration:
+                    sql += clock() - start
+                    break
+                fetched = clock()
+                feature = projector.feature(row, None, plan)
+                converted = clock()
+                sql += fetched - start
+                properties += converted - fetched
+                if feature is None:
+                    continue
+                if decode is not None:
+                    feature.geometry = decode(feature.geometry)
+                    decoding += clock() - converted
+                    if feature.geometry is None:
+                        continue
+                timer.rows += 1
+                yield feature
+        finally:
+            timer.add('sql', sql)
+            timer.add('properties', properties)
+            timer.add('decode', decoding)
+
+    def iter_select (self, action, geometry_format='wkt'):
+        """Generate the features matching action one at a time, so callers
+           streaming a response never hold the complete result. Unless
+           geometry_format is 'wkt' or 'arrays' (see decoder), feature
+           geometries are the WKB or TWKB bytes returned by the
+           database."""
+        # the geometry is serialized by the database as part of the main
+        # select, so fetching a page of features is a single round trip
+        plan = self.select_plan()
+        query = self.select_query(action, geometry_format, plan)
+        return self.features(self.execute(query), geometry_format, plan)
+
+    def select_query(self, action, geometry_format='wkt', plan=None):
+        """The query selecting the features of action."""
+        if plan is None:
+            plan = self.select_plan()
+        query = self.base_query(plan,
+            self.geometry_column(self.geometry_source(), geometry_format))
+        if action.id is not None:
+            return query.filter(
+                getattr(self.projector().cls, self.fid_col) == action.id)
+        return self.page_query(self.filter_query(query, action), action)
+
+    def count_query(self, action):
+        """The query counting the features of action, without paging.
+           Like select, it skips rows without a geometry."""
+        fid = self.projector().fid
+        query = self.join_query(self.read_session.query(func.count(fid)))
+        query = query.filter(self.geometry_element() != None)
+        if action.id is not None:
+            return query.filter(fid == action.id)
+        return self.filter_query(query, action)
+
+    def hits(self, action):
+        """Return the number of features matching action, ignoring
+           paging, and whether it is an estimate. With hits_estimate, the
+           planner statistics of PostgreSQL are used for requests without
+           attribute filters. Otherwise the rows are counted, and the
+           count is cached along with the features."""
+        if self.hits_estimate:
+            estimate = self.estimate_hits(action)
+            if estimate is not None:
+                return estimate, True
+        key = None
+        if self.cache is not None:
+            key = ('hits', self.output_srid()) + self.cache_key(action)[:4]
+            count = self.cache.get(key)
+            if count is not None:
+                return count, False
+        timer = self.timer()
+        start = time.time()
+        count = self.count_query(action).scalar() or 0
+        if timer is not None:
+            timer.add('sql', time.time() - start)
+        if key is not None:
+            self.cache.set(key, count, 64)
+        return count, False
+
+    def estimate_hits(self, action):
+        """The planner's estimate of the number of features of an action
+           with no attribute filter, None if there is no estimate: the
+           row count of the table's statistics without a bbox, the rows
+           expected from the bbox filter otherwise."""
+        if (self.dialect_name() not in ('postgres', 'postgresql')
+                or action.id is not None or action.attributes):
+            return None
+        if action.bbox:
+            query = self.filter_query(self.base_query(()), action)
+            estimate = self.explain(query)[0][3]
+        else:
+            cls = self.projector().cls
+            bind = self.read_session.get_bind(class_mapper(cls))
+            estimate = bind.execute(text("SELECT reltuples FROM pg_class "
+                "WHERE oid = CAST(:name AS regclass)"),
+                name=cls.__table__.fullname).scalar()
+        # tables never analyzed have no statistics
+        if estimate is None or estimate < 0:
+            return None
+        return int(estimate)
+
+    def compile_query(self, query):
+        """Return the engine of query, its SQL and its parameters, to run
+           it (or a variant of it) outside of the ORM."""
+        bind = self.read_session.get_bind(class_mapper(self.projector().cls))
+        compiled = query.statement.compile(bind=bind)
+        # values bound by Query.params, e.g. those of attribute filters
+        params = compiled.construct_params(query._params)
+        if compiled.positional:
+            params = tuple([params[key] for key in compiled.positiontup])
+        return bind, unicode(compiled), params
+
+    def explain(self, query):
+        """The plan the database chooses for query, as a list of steps
+           (operation, table, estimated cost, estimated rows, whether the
+           whole table is read), outermost first. SQLite does not estimate
+           costs and rows, they are None."""
+        bind, sql, params = self.compile_query(query)
+        args = params and (params,) or ()
+        steps = []
+        if self.dialect_name() in ('postgres', 'postgresql'):
+            plan = bind.execute('EXPLAIN (FORMAT JSON) ' + sql,
+                                *args).scalar()
+            if isinstance(plan, basestring):
+                plan = json.loads(plan)
+            def walk(node):
+                operation = node['Node Type']
+                steps.append((operation, node.get('Relation Name'),
+                              node.get('Total Cost'), node.get('Plan Rows'),
+                              operation.endswith('Seq Scan')))
+                for child in node.get('Plans', []):
+                    walk(child)
+            walk(plan[0]['Plan'])
+            return steps
+        for row in bind.execute('EXPLAIN QUERY PLAN ' + sql, *args):
+            detail = row[-1]
+            words = detail.split()
+            table = None
+            if words[0] in ('SCAN', 'SEARCH') and len(words) > 1:
+                table = words[1]
+                if table == 'TABLE' and len(words) > 2:
+                    table = words[2]
+            steps.append((detail, table, None, None,
+                          words[0] == 'SCAN' and table is not None
+                          and 'USING' not in words
+                          and 'VIRTUAL' not in words))
+        return steps
+
+    def iter_tile (self, z, x, y, extent=4096, buffer=64):
+        """Generate the features of XYZ tile z/x/y of the Web Mercator
+           grid, clipped in the database to the tile grown by buffer
+           pixels of extent, transformed to Web Mercator and simplified to
+           the tile resolution if the layer simplifies geometries. The
+           clip box is transformed to the layer SRID, so the geometries
+           are clipped (and filtered with the index) before they are
+           transformed."""
+        bbox = tiles.tile_bounds(z, x, y, tiles.MERCATOR_EXTENT)
+        pad = (bbox[2] - bbox[0]) * buffer / float(extent)
+        clip = (bbox[0] - pad, bbox[1] - pad, bbox[2] + pad, bbox[3] + pad)
+        srid = None
+        if int(self.srid) not in tiles.MERCATOR_SRIDS:
+            srid = tiles.WEB_MERCATOR
+        geom_element = self.geometry_element()
+        geometry = self.spatial_func('Intersection')(self.geometry_source(),
+            self.envelope(clip, srid))
+        if srid is not None:
+            geometry = self.spatial_func('Transform')(geometry, srid)
+        if self.simplify:
+            geometry = self.spatial_func('SimplifyPreserveTopology')(
+                geometry,
+                (bbox[2] - bbox[0]) / float(extent) * self.simplify_factor)
+        plan = self.select_plan()
+        query = self.base_query(plan, self.serialize(geometry, 'tile'))
+        query = query.filter(self.bbox_predicate(geom_element, clip, srid))
+        return self.features(self.execute(query), 'tile', plan)
@@ -0,0 +1,214 @@
+"""Mapbox Vector Tile encoder.
+
+Encodes features, already clipped to a tile by the database, into a
+version 2 vector tile: coordinates are quantized to the tile extent and
+written as protobuf geometry commands along with the feature properties.
+Only the small subset of protobuf needed for vector tiles is implemented,
+so no protobuf library is required.
+"""
+
+import struct
+
+DEFAULT_EXTENT = 4096
+
+POINT, LINESTRING, POLYGON = 1, 2, 3
+MOVE_TO, LINE_TO, CLOSE_PATH = 1, 2, 7
+
+
+def _varint(value):
+    out = []
+    while value > 0x7f:
+        out.append(chr((value & 0x7f) | 0x80))
+        value >>= 7
+    out.append(chr(value))
+    return ''.join(out)
+
+
+def _key(field, wire_type):
+    return _varint((field << 3) | wire_type)
+
+
+def _bytes(field, data):
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _uint(field, value):
+    return _key(field, 0) + _varint(value)
+
+
+def _packed(field, values):
+    return _bytes(field, ''.join([_varint(v) for v in values]))
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _command(command, count):
+    return (command & 0x7) | (count << 3)
+
+
+def _value(value):
+    """Encode a property value as a vector tile Value message."""
+    if isinstance(value, bool):
+        return _uint(7, int(value))
+    if isinstance(value, (int, long)):
+        if value < 0:
+            return _uint(6, _zigzag(value))
+        return _uint(5, value)
+    if isinstance(value, float):
+        return _key(3, 1) + struct.pack('<d', value)
+    if isinstance(value, str):
+        value = value.decode('utf-8', 'replace')
+    return _bytes(1, unicode(value).encode('utf-8'))
+
+
+class TileGeometry(object):
+    """Quantizes coordinates to a tile and writes geometry commands."""
+
+    def __init__(self, bbox, extent=DEFAULT_EXTENT):
+        self.minx = bbox[0]
+        self.maxy = bbox[3]
+        self.xscale = extent / float(bbox[2] - bbox[0])
+        self.yscale = extent / float(bbox[3] - bbox[1])
+
+    def quantize(self, coords):
+        """Tile pixel coordinates of coords, y pointing down, with
+           repeated points dropped."""
+        points = []
+        last = None
+        for c in coords:
+            point = (int(round((c[0] - self.minx) * self.xscale)),
+                     int(round((self.maxy - c[1]) * self.yscale)))
+            if point != last:
+                points.append(point)
+                last = point
+        return points
+
+    def encode(self, geometry):
+        """Return (geometry type, command integers) for a GeoJSON style
+           geometry dict, or None if nothing is left after quantizing."""
+        gtype = geometry['type']
+        if gtype == 'GeometryCollection':
+            return self.encode_collection(geometry['geometries'])
+        coords = geometry['coordinates']
+        if gtype == 'Point':
+            gtype, coords = 'MultiPoint', [coords]
+        elif gtype == 'LineString':
+            gtype, coords = 'MultiLineString', [coords]
+        elif gtype == 'Polygon':
+            gtype, coords = 'MultiPolygon', [coords]
+        self.cursor = (0, 0)
+        commands = []
+        if gtype == 'MultiPoint':
+            points = self.quantize(coords)
+            if points:
+                commands.append(_command(MOVE_TO, len(points)))
+                self.extend(commands, points)
+            return commands and (POINT, commands) or None
+        elif gtype == 'MultiLineString':
+            for line in coords:
+                points = self.quantize(line)
+                if len(points) < 2:
+                    continue
+                self.path(commands, points)
+            return commands and (LINESTRING, commands) or None
+        elif gtype == 'MultiPolygon':
+            for polygon in coords:
+                for index, ring in enumerate(polygon):
+                    points = self.quantize(ring)
+                    if len(points) > 1 and points[0] == points[-1]:
+                        points = points[:-1]
+                    if len(points) < 3:
+                        if index == 0:
+                            break
+                        continue
+                    # exterior rings have a positive area in tile
+                    # coordinates, interior rings a negative one
+                    if (area(points) > 0) != (index == 0):
+                        points.reverse()
+                    self.path(commands, points)
+                    commands.append(_command(CLOSE_PATH, 1))
+            return commands and (POLYGON, commands) or None
+        return None
+
+    def encode_collection(self, geometries):
+        """Clipping can turn a geometry into a collection; keep the parts
+           of its highest dimension."""
+        for gtype, parts in (('Polygon', 'MultiPolygon'),
+                             ('LineString', 'MultiLineString'),
+                             ('Point', 'MultiPoint')):
+            coords = []
+            for geometry in geometries:
+                if geometry['type'] == gtype:
+                    coords.append(geometry['coordinates'])
+                elif geometry['type'] == parts:
+                    coords.extend(geometry['coordinates'])
+            if coords:
+                return self.encode({'type': parts, 'coordinates': coords})
+        return None
+
+    def path(self, commands, points):
+        commands.append(_command(MOVE_TO, 1))
+        self.extend(commands, points[:1])
+        commands.append(_command(LINE_TO, len(points) - 1))
+        self.extend(commands, points[1:])
+
+    def extend(self, commands, points):
+        x0, y0 = self.cursor
+        for x, y in points:
+            commands.append(_zigzag(x - x0))
+            commands.append(_zigzag(y - y0))
+            x0, y0 = x, y
+        self.cursor = (x0, y0)
+
+
+def area(points):
+    """Twice the signed area of a ring."""
+    total = 0
+    for i in range(len(points)):
+        x1, y1 = points[i - 1]
+        x2, y2 = points[i]
+        total += x1 * y2 - x2 * y1
+    return total
+
+
+def encode_layer(name, features, bbox, extent=DEFAULT_EXTENT):
+    """Encode the features of a tile covering bbox as a Layer message."""
+    tile_geometry = TileGeometry(bbox, extent)
+    keys = {}
+    values = {}
+    parts = [_uint(15, 2), _bytes(1, str(name))]
+    for feature in features:
+        encoded = tile_geometry.encode(feature.geometry)
+        if encoded is None:
+            continue
+        gtype, commands = encoded
+        tags = []
+        for key, value in feature.properties.items():
+            if value is None:
+                continue
+            tags.append(keys.setdefault(key, len(keys)))
+            value = _value(value)
+            tags.append(values.setdefault(value, len(values)))
+        message = []
+        if isinstance(feature.id, (int, long)) and feature.id >= 0:
+            message.append(_uint(1, feature.id))
+        if tags:
+            message.append(_packed(2, tags))
+        message.append(_uint(3, gtype))
+        message.append(_packed(4, commands))
+        parts.append(_bytes(2, ''.join(message)))
+    for key, index in sorted(keys.items(), key=lambda item: item[1]):
+        if isinstance(key, unicode):
+            key = key.encode('utf-8')
+        parts.append(_bytes(3, key))
+    for value, index in sorted(values.items(), key=lambda item: item[1]):
+        parts.append(_bytes(4, value))
+    parts.append(_uint(5, extent))
+    return ''.join(parts)
+
+
+def encode(layers):
+    """Encode a Tile message from (name, features, bbox, extent) layers."""
+    return ''.join([_bytes(3, encode_layer(*layer)) for layer in layers])
@@ -0,0 +1,166 @@
+from vectorformats.Feature import Feature
+from vectorformats.Formats import WKT
+from sqlalchemy import types
+from sqlalchemy.orm import class_mapper
+
+import datetime
+
+try:
+    import decimal
+except:
+    decimal = None
+
+
+def names(value):
+    """Normalize a column list given either as a sequence or as a comma
+       separated config string."""
+    if isinstance(value, basestring):
+        return [name.strip() for name in value.split(',') if name.strip()]
+    return list(value or [])
+
+
+class FeatureProjector (object):
+    """Row to Feature mapping for a GeoAlchemy layer.
+
+       Everything that does not change between requests is resolved once:
+       the mapped classes, the columns that end up as properties, and a
+       converter for each of them chosen from its column type. Only those
+       columns are selected, as plain columns rather than ORM entities,
+       so a row is (fid, property values..., [order value,] geometry) and
+       turning it into a Feature is a walk over that fixed plan."""
+
+    def __init__(self, datasource):
+        resolve = datasource.registry.resolve
+        self.cls = resolve(datasource.model, datasource.cls)
+        self.geom_cls = None
+        if datasource.geom_cls:
+            self.geom_cls = resolve(datasource.model, datasource.geom_cls)
+        self.encoding = datasource.encoding
+        self.fid_col = datasource.fid_col
+
+        wanted = None
+        if datasource.attribute_cols != '*':
+            wanted = frozenset(names(datasource.attribute_cols))
+        ignore = frozenset(names(datasource.attribute_ignore))
+
+        entities = [self.cls]
+        if self.geom_cls:
+            entities.append(self.geom_cls)
+        # (mapped column attribute, property name, converter or None)
+        self.plan = []
+        for entity in entities:
+            for column in entity.__table__.c:
+                col = column.key
+                if col == datasource.fid_col or col == datasource.geom_col:
+                    continue
+                if wanted is not None and col not in wanted:
+                    continue
+                if col in ignore:
+                    continue
+                self.plan.append((getattr(entity, col), col,
+                                  self.converter(column.type)))
+        self.plan = tuple(self.plan)
+        # the columns of the layer's class a written property may set
+        self.writable = frozenset([
+            column.key for column in self.cls.__table__.c
+            if column.key not in (datasource.fid_col, datasource.geom_col)])
+        # whether deleting a feature has to go through the ORM so the
+        # delete cascades of its relations are applied
+        self.cascade_delete = False
+        for prop in class_mapper(self.cls).iterate_properties:
+            if 'delete' in getattr(prop, 'cascade', ()):
+                self.cascade_delete = True
+        self.fid = getattr(self.cls, self.fid_col)
+        # the order column is always selected, whatever properties are
+        # returned, so features can be sorted again once selected
+        self.order = None
+        if datasource.order and datasource.order != datasource.fid_col:
+            self.order = getattr(self.cls, datasource.order)
+        # plans restricted to the properties requested by name
+        self.plans = {}
+
+    def select_plan(self, properties=None):
+        """The part of the plan for the requested property names, given
+           as a list or comma separated string; the whole plan if none
+           are requested. Names outside of the plan are ignored."""
+        if not properties:
+            return self.plan
+        key = frozenset(names(properties))
+        plan = self.plans.get(key)
+        if plan is None:
+            plan = tuple([step for step in self.plan if step[1] in key])
+            if len(self.plans) < 256:
+                self.plans[key] = plan
+        return plan
+
+    def columns(self, plan=None):
+        """Columns to select for plan, ahead of the geometry."""
+        if plan is None:
+            plan = self.plan
+        columns = [self.fid] + [attribute for attribute, col, convert in plan]
+        if self.order is not None:
+            columns.append(self.order)
+        return columns
+
+    def converter(self, coltype):
+        """Return the function turning values of coltype into something
+           every output format can encode, or None if they can be used
+           as they are."""
+        if isinstance(coltype, (types.DateTime, types.Date)):
+            return str
+        if isinstance(coltype, types.Float):
+            return None
+        if isinstance(coltype, types.Numeric):
+            return self.decimal_to_unicode
+        if isinstance(coltype, types.String):
+            return self.str_to_unicode
+        if isinstance(coltype, (types.Integer, types.Boolean)):
+            return None
+        return self.any_to_unicode
+
+    def str_to_unicode(self, value):
+        if isinstance(value, str):
+            return unicode(value, self.encoding)
+        return value
+
+    def decimal_to_unicode(self, value):
+        if decimal is not None and isinstance(value, decimal.Decimal):
+            return unicode(str(value), self.encoding)
+        return value
+
+    def any_to_unicode(self, value):
+        if isinstance(value, str):
+            return unicode(value, self.encoding)
+        elif isinstance(value, (datetime.datetime, datetime.date)):
+            return str(value)
+        return self.decimal_to_unicode(value)
+
+    def feature(self, row, decode=WKT.from_wkt, plan=None):
+        """Build the Feature for a row of the columns of plan followed by
+           the geometry, or None if the row has no geometry or decode
+           finds it empty. The geometry is parsed by decode, or passed on
+           as it is if decode is None.
+           The value of the order column is kept as the feature's
+           sort_key."""
+        geometry = row[-1]
+        if not geometry:
+            return None
+        if plan is None:
+            plan = self.plan
+        props = {}
+        index = 1
+        for attribute, col, convert in plan:
+            value = row[index]
+            if convert is not None and value is not None:
+                value = convert(value)
+            props[col] = value
+            index += 1
+        if decode is not None:
+            geometry = decode(geometry)
+            if geometry is None:
+                return None
+        feature = Feature(row[0], geometry, props)
+        feature.sort_key = row[0]
+        if self.order is not None:
+            feature.sort_key = row[index]
+        return feature
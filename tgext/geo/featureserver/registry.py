@@ -0,0 +1,213 @@
+"""Registry of the FeatureServer layers of an application.
+
+The geo.<layer>.* settings of a layer are read from the configuration
+once, and its GeoAlchemy datasource is only built when the layer is
+first used, so mounting many layers costs little at startup. Layers on
+the same database share one engine and its connection pool, and model
+classes are imported once for all layers using them.
+"""
+
+import threading
+
+from tg import config
+from paste.deploy.converters import asbool
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker, scoped_session
+
+from tgext.geo.cache import LRUCache
+import mvt
+
+
+def layer_settings(name):
+    """Read the settings of layer name from the application config."""
+    settings = {}
+    settings['model'] = config.get("geo.%s.model"%name, None)
+    settings['cls'] = config.get("geo.%s.cls"%name, None)
+    settings['fid'] = config.get("geo.%s.fid"%name, "gid")
+    settings['geometry'] = config.get("geo.%s.geometry"%name, "the_geom")
+    settings['geom_rel'] = config.get("geo.%s.geom_rel"%name, None)
+    settings['geom_cls'] = config.get("geo.%s.geom_cls"%name, None)
+    settings['join_condition'] = config.get("geo.%s.join_condition"%name,
+                                            None)
+    settings['order'] = config.get("geo.%s.order"%name, settings['fid'])
+    settings['srid'] = config.get("geo.%s.srid"%name, 4326)
+    settings['dburi'] = config.get("geo.%s.dburi"%name,
+                                   config.get("sqlalchemy.url", None))
+    settings['sql_echo'] = config.get("sqlalchemy.echo", None)
+    settings['writable'] = asbool(config.get("geo.%s.writable"%name, False))
+    settings['encoding'] = config.get("geo.%s.encoding"%name, "utf-8")
+    settings['attribute_cols'] = config.get("geo.%s.attribute_cols"%name,
+                                            "*")
+    settings['attribute_ignore'] = config.get(
+        "geo.%s.attribute_ignore"%name, [])
+    settings['max_features'] = config.get("geo.%s.max_features"%name, 1000)
+    settings['paging'] = config.get("geo.%s.paging"%name, "offset")
+    settings['yield_per'] = config.get("geo.%s.yield_per"%name, 0)
+    settings['bbox_filter'] = config.get("geo.%s.bbox_filter"%name,
+                                         "intersects")
+    settings['cache_enabled'] = asbool(
+        config.get("geo.%s.cache_enabled"%name, False))
+    settings['cache_size'] = config.get("geo.%s.cache_size"%name, 1000)
+    settings['cache_memory'] = config.get("geo.%s.cache_memory"%name, 0)
+    settings['cache_ttl'] = config.get("geo.%s.cache_ttl"%name, 300)
+    settings['cache_precision'] = config.get(
+        "geo.%s.cache_precision"%name, 6)
+    settings['snap_bbox'] = asbool(config.get("geo.%s.snap_bbox"%name,
+                                              False))
+    settings['snap_extent'] = config.get("geo.%s.snap_extent"%name, None)
+    settings['simplify'] = asbool(config.get("geo.%s.simplify"%name, False))
+    settings['simplify_factor'] = config.get(
+        "geo.%s.simplify_factor"%name, 1.0)
+    settings['twkb_precision'] = config.get("geo.%s.twkb_precision"%name, 6)
+    settings['pool_size'] = config.get("geo.%s.pool_size"%name, None)
+    settings['max_overflow'] = config.get("geo.%s.max_overflow"%name, None)
+    settings['statement_timeout'] = config.get(
+        "geo.%s.statement_timeout"%name, None)
+    settings['read_dburi'] = config.get("geo.%s.read_dburi"%name, None)
+    settings['timing'] = asbool(config.get("geo.%s.timing"%name, False))
+    settings['search_mode'] = config.get("geo.%s.search_mode"%name, "like")
+    settings['search_config'] = config.get("geo.%s.search_config"%name,
+                                           "simple")
+    settings['hits_estimate'] = asbool(
+        config.get("geo.%s.hits_estimate"%name, False))
+    settings['geometry_decoder'] = config.get(
+        "geo.%s.geometry_decoder"%name, "wkt")
+    settings['output_srids'] = config.get("geo.%s.output_srids"%name, None)
+    # used by the controllers only
+    settings['streaming'] = asbool(config.get("geo.%s.streaming"%name,
+                                              False))
+    settings['etags'] = asbool(config.get("geo.%s.etags"%name, False))
+    settings['etag_query'] = config.get("geo.%s.etag_query"%name, None)
+    settings['single_process'] = asbool(
+        config.get("geo.%s.single_process"%name, False))
+    settings['cache_control'] = config.get("geo.%s.cache_control"%name,
+                                           None)
+    settings['tile_extent'] = config.get("geo.%s.tile_extent"%name,
+                                         mvt.DEFAULT_EXTENT)
+    settings['tile_buffer'] = config.get("geo.%s.tile_buffer"%name, 64)
+    return settings
+
+
+class LayerRegistry(object):
+    """Settings, datasources, engines and model classes of the layers,
+       each created once and shared by the controllers serving them."""
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.clear()
+
+    def clear(self):
+        """Forget everything, e.g. after the configuration changed."""
+        self.lock.acquire()
+        try:
+            self.layers = {}
+            self.datasources = {}
+            self.engines = {}
+            self.classes = {}
+        finally:
+            self.lock.release()
+
+    def _once(self, store, key, create):
+        """store[key], set to create() on first use."""
+        value = store.get(key)
+        if value is None:
+            self.lock.acquire()
+            try:
+                value = store.get(key)
+                if value is None:
+                    value = store[key] = create()
+            finally:
+                self.lock.release()
+        return value
+
+    def settings(self, name):
+        """The settings of layer name, read from the config once."""
+        return self._once(self.layers, name, lambda: layer_settings(name))
+
+    def resolve(self, model, name):
+        """The class name of the module model, imported once."""
+        def load():
+            module = __import__(model, fromlist=['*'])
+            return getattr(module, name)
+        return self._once(self.classes, (model, name), load)
+
+    def session(self, dburi, sql_echo=None, pool_size=None,
+                max_overflow=None, statement_timeout=None):
+        """Return the engine for dburi and a thread local session over it,
+           shared by all layers using the same database and pool
+           settings."""
+        def create():
+            options = {'echo': sql_echo}
+            if pool_size is not None:
+                options['pool_size'] = int(pool_size)
+            if max_overflow is not None:
+                options['max_overflow'] = int(max_overflow)
+            if statement_timeout and dburi.startswith('postgres'):
+                options['connect_args'] = {'options':
+                    '-c statement_timeout=%d' % int(statement_timeout)}
+            engine = create_engine(dburi, **options)
+            return engine, scoped_session(sessionmaker(bind=engine))
+        key = (dburi, sql_echo, pool_size, max_overflow, statement_timeout)
+        return self._once(self.engines, key, create)
+
+    def datasource(self, name, session=None):
+        """The GeoAlchemy datasource of layer name, built on first use.
+           Without a session, the layer gets the shared session of its
+           database."""
+        return self._once(self.datasources, (name, session),
+                          lambda: self.build(name, session))
+
+    def build(self, name, session=None):
+        from datasource import GeoAlchemy
+        settings = self.settings(name)
+        cache = None
+        if settings['cache_enabled']:
+            cache = LRUCache(
+                max_entries = settings['cache_size'],
+                max_bytes = settings['cache_memory'],
+                ttl = settings['cache_ttl'])
+        return GeoAlchemy(
+            name,
+            srid = settings['srid'],
+            fid = settings['fid'],
+            geometry = settings['geometry'],
+            order = settings['order'],
+            attribute_cols = settings['attribute_cols'],
+            attribute_ignore = settings['attribute_ignore'],
+            writable = settings['writable'],
+            encoding = settings['encoding'],
+            session = session,
+            dburi = settings['dburi'],
+            sql_echo = settings['sql_echo'],
+            layer = name,
+            model = settings['model'],
+            geom_rel = settings['geom_rel'],
+            geom_cls = settings['geom_cls'],
+            join_condition = settings['join_condition'],
+            cls = settings['cls'],
+            max_features = settings['max_features'],
+            paging = settings['paging'],
+            yield_per = settings['yield_per'],
+            bbox_filter = settings['bbox_filter'],
+            cache = cache,
+            cache_precision = settings['cache_precision'],
+            snap_bbox = settings['snap_bbox'],
+            snap_extent = settings['snap_extent'],
+            simplify = settings['simplify'],
+            simplify_factor = settings['simplify_factor'],
+            twkb_precision = settings['twkb_precision'],
+            pool_size = settings['pool_size'],
+            max_overflow = settings['max_overflow'],
+            statement_timeout = settings['statement_timeout'],
+            read_dburi = settings['read_dburi'],
+            timing = settings['timing'],
+            search_mode = settings['search_mode'],
+            search_config = settings['search_config'],
+            hits_estimate = settings['hits_estimate'],
+            geometry_decoder = settings['geometry_decoder'],
+            output_srids = settings['output_srids'],
+            registry = self
+        )
+
+
+registry = LayerRegistry()
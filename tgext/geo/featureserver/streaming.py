@@ -0,0 +1,225 @@
+"""Streaming feature encoders.
+
+FeatureServer renders a response from a complete list of features. The
+encoders here consume an iterator of vectorformats Features instead and
+generate the GeoJSON, GML or KML document in chunks, so they can be handed
+to the WSGI server as the response body.
+"""
+
+from xml.sax.saxutils import escape, quoteattr
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+import wkb
+
+# number of features rendered into each chunk handed to the WSGI server
+CHUNK_SIZE = 100
+
+
+def chunked(pieces, size=CHUNK_SIZE, separator=''):
+    """Join the strings generated by pieces, separated by separator, into
+       chunks of size pieces."""
+    chunk = []
+    lead = ''
+    for piece in pieces:
+        chunk.append(piece)
+        if len(chunk) >= size:
+            yield lead + separator.join(chunk)
+            lead = separator
+            chunk = []
+    if chunk:
+        yield lead + separator.join(chunk)
+
+
+def _text(value):
+    if value is None:
+        return ''
+    if isinstance(value, str):
+        value = value.decode('utf-8')
+    return escape(unicode(value)).encode('utf-8')
+
+
+def _coords(coords, sep=' '):
+    return sep.join(['%s,%s' % (c[0], c[1]) for c in coords])
+
+
+def geojson(features, layer=None):
+    """Encode features as a GeoJSON FeatureCollection."""
+    return document('geojson', [(layer, features)])
+
+
+def _geojson_feature(feature, layer=None):
+    # the geometry is written by wkb.geojson, which reads array backed
+    # coordinates without building lists of them
+    members = ['"type": "Feature"',
+               '"id": %s' % json.dumps(feature.id),
+               '"geometry": %s' % (feature.geometry and
+                                   wkb.geojson(feature.geometry) or 'null'),
+               '"properties": %s' % json.dumps(feature.properties)]
+    if layer is not None:
+        members.append('"layer": %s' % json.dumps(layer))
+    return '{%s}' % ', '.join(members)
+
+
+def _gml_geometry(geometry):
+    gtype = geometry['type']
+    coords = geometry['coordinates']
+    if gtype == 'Point':
+        return '<gml:Point><gml:coordinates>%s,%s</gml:coordinates>' \
+               '</gml:Point>' % (coords[0], coords[1])
+    elif gtype == 'LineString':
+        return '<gml:LineString><gml:coordinates>%s</gml:coordinates>' \
+               '</gml:LineString>' % _coords(coords)
+    elif gtype == 'Polygon':
+        rings = ['<gml:outerBoundaryIs><gml:LinearRing><gml:coordinates>%s'
+                 '</gml:coordinates></gml:LinearRing></gml:outerBoundaryIs>'
+                 % _coords(coords[0])]
+        for ring in coords[1:]:
+            rings.append('<gml:innerBoundaryIs><gml:LinearRing>'
+                         '<gml:coordinates>%s</gml:coordinates>'
+                         '</gml:LinearRing></gml:innerBoundaryIs>'
+                         % _coords(ring))
+        return '<gml:Polygon>%s</gml:Polygon>' % ''.join(rings)
+    elif gtype in ('MultiPoint', 'MultiLineString', 'MultiPolygon'):
+        member = gtype[5:]
+        parts = ['<gml:%sMember>%s</gml:%sMember>' % (
+                    member[0].lower() + member[1:],
+                    _gml_geometry({'type': member, 'coordinates': part}),
+                    member[0].lower() + member[1:])
+                 for part in coords]
+        return '<gml:%s>%s</gml:%s>' % (gtype, ''.join(parts), gtype)
+    raise ValueError("Unsupported geometry type %s" % gtype)
+
+
+def gml(features, layer='layer'):
+    """Encode features as a WFS FeatureCollection of GML 2 features."""
+    return document('gml', [(layer, features)])
+
+
+def _gml_feature(feature, layer):
+    props = ''.join(['<fs:%s>%s</fs:%s>' % (
+                         str(key), _text(value), str(key))
+                     for key, value in feature.properties.items()])
+    return '<gml:featureMember><fs:%s fid=%s><fs:geometry>%s' \
+           '</fs:geometry>%s</fs:%s></gml:featureMember>' % (
+               layer, quoteattr(str(feature.id)),
+               _gml_geometry(feature.geometry), props, layer)
+
+
+def _kml_geometry(geometry):
+    gtype = geometry['type']
+    coords = geometry['coordinates']
+    if gtype == 'Point':
+        return '<Point><coordinates>%s,%s</coordinates></Point>' % (
+            coords[0], coords[1])
+    elif gtype == 'LineString':
+        return '<LineString><coordinates>%s</coordinates></LineString>' % \
+            _coords(coords)
+    elif gtype == 'Polygon':
+        rings = ['<outerBoundaryIs><LinearRing><coordinates>%s</coordinates>'
+                 '</LinearRing></outerBoundaryIs>' % _coords(coords[0])]
+        for ring in coords[1:]:
+            rings.append('<innerBoundaryIs><LinearRing><coordinates>%s'
+                         '</coordinates></LinearRing></innerBoundaryIs>'
+                         % _coords(ring))
+        return '<Polygon>%s</Polygon>' % ''.join(rings)
+    elif gtype in ('MultiPoint', 'MultiLineString', 'MultiPolygon'):
+        return '<MultiGeometry>%s</MultiGeometry>' % ''.join(
+            [_kml_geometry({'type': gtype[5:], 'coordinates': part})
+             for part in coords])
+    raise ValueError("Unsupported geometry type %s" % gtype)
+
+
+def kml(features, layer='layer'):
+    """Encode features as a KML Document of Placemarks."""
+    return document('kml', [(layer, features)])
+
+
+def _kml_feature(feature, layer=None):
+    data = ''.join(['<Data name=%s><value>%s</value></Data>' % (
+                        quoteattr(str(key)), _text(value))
+                    for key, value in feature.properties.items()])
+    if layer is not None:
+        data = '<Data name="layer"><value>%s</value></Data>' % \
+            _text(layer) + data
+    return '<Placemark id=%s><name>%s</name><ExtendedData>%s' \
+           '</ExtendedData>%s</Placemark>' % (
+               quoteattr(str(feature.id)), _text(feature.id), data,
+               _kml_geometry(feature.geometry))
+
+
+# opening tag of GML feature collections, without its closing bracket
+GML_COLLECTION = ('<wfs:FeatureCollection '
+                  'xmlns:fs="http://featureserver.org/fs" '
+                  'xmlns:wfs="http://www.opengis.net/wfs" '
+                  'xmlns:gml="http://www.opengis.net/gml"')
+
+
+def gml_hits(count):
+    """The empty GML FeatureCollection answering a resultType=hits
+       request with count features."""
+    return GML_COLLECTION + ' numberOfFeatures="%d"/>' % count
+
+
+def transaction_failed(message):
+    """The WFS-T response of a transaction that failed with
+       message."""
+    return ('<wfs:WFS_TransactionResponse version="1.0.0" '
+            'xmlns:wfs="http://www.opengis.net/wfs">'
+            '<wfs:TransactionResult><wfs:Status><wfs:FAILED/></wfs:Status>'
+            '<wfs:Message>%s</wfs:Message></wfs:TransactionResult>'
+            '</wfs:WFS_TransactionResponse>' % _text(message))
+
+
+# document format -> (header, footer, separator, feature encoder, whether
+#                     the feature encoder always needs the layer name)
+documents = {
+    'geojson': ('{"type": "FeatureCollection", "features": [', ']}', ', ',
+                _geojson_feature, False),
+    'gml': (GML_COLLECTION + '>', '</wfs:FeatureCollection>', '',
+            _gml_feature, True),
+    'kml': ('<?xml version="1.0" encoding="UTF-8"?>'
+            '<kml xmlns="http://earth.google.com/kml/2.0"><Document>',
+            '</Document></kml>', '', _kml_feature, False),
+}
+
+
+def document(format, layers, tag_layer=False):
+    """Encode the features of several layers, given as (layer name,
+       features) pairs, into one document. With tag_layer the layer name
+       is added to each GeoJSON feature and KML placemark."""
+    header, footer, separator, encode, needs_layer = documents[format]
+
+    def pieces():
+        for layer, features in layers:
+            if not (tag_layer or needs_layer):
+                layer = None
+            for feature in features:
+                yield encode(feature, layer)
+
+    yield header
+    for chunk in chunked(pieces(), separator=separator):
+        yield chunk
+    yield footer
+
+
+# request format name -> (document format, content type)
+formats = {
+    'geojson': ('geojson', 'application/json'),
+    'json': ('geojson', 'application/json'),
+    'gml': ('gml', 'text/xml'),
+    'wfs': ('gml', 'text/xml'),
+    'kml': ('kml', 'application/vnd.google-earth.kml+xml'),
+}
+
+# request format name -> (content type, encoder)
+encoders = {
+    'geojson': ('application/json', geojson),
+    'json': ('application/json', geojson),
+    'gml': ('text/xml', gml),
+    'wfs': ('text/xml', gml),
+    'kml': ('application/vnd.google-earth.kml+xml', kml),
+}
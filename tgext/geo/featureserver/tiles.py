@@ -0,0 +1,221 @@
+"""Tile grid helpers for the FeatureServer datasource.
+
+Grids are quadtrees over a layer extent: level z divides the extent width
+into 2**z square tiles, counted from the lower left corner.
+"""
+
+import math
+import re
+
+import wkb
+
+MERCATOR_SRIDS = (900913, 3857, 3785, 102113)
+# SRID of the XYZ tile grid of vector tiles
+WEB_MERCATOR = 3857
+# longitude/latitude SRIDs the geographic extent is right for
+GEOGRAPHIC_SRIDS = (4326, 4269, 4258, 4283, 4617, 4674)
+MERCATOR_EXTENT = (-20037508.342789244, -20037508.342789244,
+                   20037508.342789244, 20037508.342789244)
+GEOGRAPHIC_EXTENT = (-180.0, -90.0, 180.0, 90.0)
+
+
+def default_extent(srid):
+    """Grid extent used for a layer in srid when none is configured, None
+       for projected SRIDs, whose extent has to be configured."""
+    if int(srid) in MERCATOR_SRIDS:
+        return MERCATOR_EXTENT
+    if int(srid) in GEOGRAPHIC_SRIDS:
+        return GEOGRAPHIC_EXTENT
+    return None
+
+
+def parse_srs(value):
+    """The EPSG code of an srsName, given as "EPSG:3857", as an OGC URN or
+       URL ending in the code, or as the bare number. CRS:84 is the
+       longitude/latitude axis order of EPSG:4326."""
+    if value.strip().upper() == 'CRS:84':
+        return 4326
+    match = re.match(r'^(?:EPSG:|urn:(?:x-)?ogc:def:crs:EPSG:[^:]*:|'
+                     r'http://www\.opengis\.net/gml/srs/epsg\.xml#)?'
+                     r'(\d+)$', value.strip(), re.I)
+    if match is None:
+        raise ValueError("Unsupported srsName %s" % value)
+    return int(match.group(1))
+
+
+def parse_extent(value, srid):
+    """Read a grid extent from a "minx,miny,maxx,maxy" config string, or
+       the default extent of srid."""
+    if not value:
+        return default_extent(srid)
+    if isinstance(value, basestring):
+        value = value.split(',')
+    return tuple([float(c) for c in value])
+
+
+def zoom_resolution(zoom, extent, tile_size=256):
+    """Map units per pixel at zoom level zoom of the grid."""
+    return (extent[2] - extent[0]) / (tile_size * 2 ** int(zoom))
+
+
+def tile_bounds(z, x, y, extent):
+    """Bounds of tile x, y of level z, with rows counted from the top of
+       the extent as in XYZ tile schemes."""
+    size = (extent[2] - extent[0]) / 2 ** int(z)
+    return (extent[0] + x * size, extent[3] - (y + 1) * size,
+            extent[0] + (x + 1) * size, extent[3] - y * size)
+
+
+def snap(bbox, extent):
+    """Return the bboxes of the grid tiles covering bbox, taken from the
+       deepest level whose tiles are still at least as large as bbox.
+       Nearby requests for similar areas therefore map to the same tiles,
+       never more than two in each direction."""
+    width = extent[2] - extent[0]
+    size = max(bbox[2] - bbox[0], bbox[3] - bbox[1])
+    z = 0
+    while z < 30 and width / 2 ** (z + 1) >= size:
+        z += 1
+    tile = width / 2 ** z
+    x0 = int(math.floor((bbox[0] - extent[0]) / tile))
+    y0 = int(math.floor((bbox[1] - extent[1]) / tile))
+    x1 = int(math.ceil((bbox[2] - extent[0]) / tile))
+    y1 = int(math.ceil((bbox[3] - extent[1]) / tile))
+    tiles = []
+    for x in range(x0, max(x1, x0 + 1)):
+        for y in range(y0, max(y1, y0 + 1)):
+            tiles.append((extent[0] + x * tile, extent[1] + y * tile,
+                          extent[0] + (x + 1) * tile,
+                          extent[1] + (y + 1) * tile))
+    return tiles
+
+
+def bounds(geometry):
+    """Bounding box of a GeoJSON style geometry dict, None if empty."""
+    if geometry['type'] == 'GeometryCollection':
+        members = [bounds(member) for member in geometry['geometries']]
+        members = [member for member in members if member]
+        if not members:
+            return None
+        return (min([b[0] for b in members]), min([b[1] for b in members]),
+                max([b[2] for b in members]), max([b[3] for b in members]))
+    xs = []
+    ys = []
+
+    def walk(coords):
+        if isinstance(coords, wkb.Coordinates):
+            xs.extend(coords.values[0::coords.dims])
+            ys.extend(coords.values[1::coords.dims])
+        elif coords and isinstance(coords[0], (list, tuple,
+                                               wkb.Coordinates)):
+            for c in coords:
+                walk(c)
+        elif coords:
+            xs.append(coords[0])
+            ys.append(coords[1])
+    walk(geometry['coordinates'])
+    if not xs:
+        return None
+    return (min(xs), min(ys), max(xs), max(ys))
+
+
+def intersects(a, b):
+    """Whether the bboxes a and b overlap."""
+    return not (a[2] < b[0] or a[0] > b[2] or a[3] < b[1] or a[1] > b[3])
+
+
+def _point_in(point, bbox):
+    return (bbox[0] <= point[0] <= bbox[2]
+            and bbox[1] <= point[1] <= bbox[3])
+
+
+def _segment_intersects(p, q, bbox):
+    """Whether the segment from p to q meets bbox, by clipping it to the
+       bbox (Liang-Barsky)."""
+    t0, t1 = 0.0, 1.0
+    for axis in (0, 1):
+        start = p[axis]
+        delta = float(q[axis] - start)
+        low = bbox[axis] - start
+        high = bbox[axis + 2] - start
+        if delta == 0:
+            if low > 0 or high < 0:
+                return False
+            continue
+        a, b = low / delta, high / delta
+        if a > b:
+            a, b = b, a
+        t0 = max(t0, a)
+        t1 = min(t1, b)
+        if t0 > t1:
+            return False
+    return True
+
+
+def _line_intersects(points, bbox):
+    points = list(points)
+    if len(points) == 1:
+        return _point_in(points[0], bbox)
+    for i in range(1, len(points)):
+        if _segment_intersects(points[i - 1], points[i], bbox):
+            return True
+    return False
+
+
+def _inside(x, y, rings):
+    """Whether x, y lies inside the polygon of rings, holes excluded
+       (even-odd rule)."""
+    inside = False
+    for ring in rings:
+        ring = list(ring)
+        j = len(ring) - 1
+        for i in range(len(ring)):
+            xi, yi = ring[i][0], ring[i][1]
+            xj, yj = ring[j][0], ring[j][1]
+            if ((yi > y) != (yj > y)
+                    and x < (xj - xi) * (y - yi) / float(yj - yi) + xi):
+                inside = not inside
+            j = i
+    return inside
+
+
+def _polygon_intersects(rings, bbox):
+    for ring in rings:
+        if _line_intersects(ring, bbox):
+            return True
+    # no boundary crosses the bbox: it is either wholly inside the
+    # polygon or wholly outside
+    return bool(rings) and _inside(bbox[0], bbox[1], rings)
+
+
+def geometry_intersects(geometry, bbox):
+    """Whether a GeoJSON style geometry dict intersects bbox, boundaries
+       included, as the Intersects predicate of the database tells for
+       the envelope of bbox."""
+    gtype = geometry['type']
+    if gtype == 'GeometryCollection':
+        for member in geometry['geometries']:
+            if geometry_intersects(member, bbox):
+                return True
+        return False
+    coords = geometry['coordinates']
+    if not coords:
+        return False
+    if gtype == 'Point':
+        return _point_in(coords, bbox)
+    if gtype == 'MultiPoint':
+        for point in coords:
+            if _point_in(point, bbox):
+                return True
+        return False
+    if gtype == 'LineString':
+        return _line_intersects(coords, bbox)
+    if gtype == 'Polygon':
+        return _polygon_intersects(coords, bbox)
+    for part in coords:
+        if gtype == 'MultiLineString':
+            if _line_intersects(part, bbox):
+                return True
+        elif _polygon_intersects(part, bbox):
+            return True
+    return False
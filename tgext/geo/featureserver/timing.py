@@ -0,0 +1,140 @@
+"""Request timing for FeatureServer layers.
+
+A RequestTimer adds up the time a request spends in each phase: running
+SQL and fetching rows, decoding geometries, converting properties and
+encoding the response. LayerStats aggregates finished requests into a
+histogram per phase.
+"""
+
+import threading
+import time
+
+PHASES = ('sql', 'decode', 'properties', 'encode', 'total')
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000,
+           30000)
+
+
+class RequestTimer(object):
+    """Time spent by one request, by phase, with the rows and bytes it
+       produced."""
+
+    def __init__(self):
+        self.start = time.time()
+        self.phases = {}
+        self.rows = 0
+        self.bytes = 0
+        self.total = None
+
+    def add(self, phase, seconds):
+        self.phases[phase] = self.phases.get(phase, 0.0) + seconds
+
+    def finish(self):
+        """Stop the clock; the time not spent in the datasource phases is
+           counted as encoding."""
+        self.total = time.time() - self.start
+        spent = sum([self.phases.get(phase, 0.0)
+                     for phase in ('sql', 'decode', 'properties')])
+        self.add('encode', max(self.total - spent, 0.0))
+
+    def server_timing(self):
+        """Value of the Server-Timing header, in milliseconds."""
+        timings = ['%s;dur=%.1f' % (phase, self.phases[phase] * 1000)
+                   for phase in PHASES if phase in self.phases]
+        if self.total is not None:
+            timings.append('total;dur=%.1f' % (self.total * 1000))
+        return ', '.join(timings)
+
+
+class Histogram(object):
+    """Counts of durations in fixed buckets."""
+
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, ms):
+        index = 0
+        while index < len(BUCKETS) and ms > BUCKETS[index]:
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += ms
+        self.max = max(self.max, ms)
+
+    def percentile(self, fraction):
+        """Upper bound of the bucket holding the fraction percentile."""
+        if not self.count:
+            return None
+        rank = fraction * self.count
+        seen = 0
+        for index, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                if index < len(BUCKETS):
+                    return min(BUCKETS[index], self.max)
+                return self.max
+        return self.max
+
+    def as_dict(self):
+        buckets = [('le_%d' % bound, count)
+                   for bound, count in zip(BUCKETS, self.counts)]
+        buckets.append(('le_inf', self.counts[-1]))
+        return {
+            'count': self.count,
+            'mean': self.count and self.sum / self.count or 0.0,
+            'max': self.max,
+            'p50': self.percentile(0.5),
+            'p90': self.percentile(0.9),
+            'p99': self.percentile(0.99),
+            'buckets': dict(buckets),
+        }
+
+
+class LayerStats(object):
+    """Histograms of the phase durations of a layer's requests, shared
+       by the threads serving it."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.lock.acquire()
+        try:
+            self.requests = 0
+            self.rows = 0
+            self.bytes = 0
+            self.histograms = dict([(phase, Histogram())
+                                    for phase in PHASES])
+        finally:
+            self.lock.release()
+
+    def record(self, timer):
+        self.lock.acquire()
+        try:
+            self.requests += 1
+            self.rows += timer.rows
+            self.bytes += timer.bytes
+            for phase, seconds in timer.phases.items():
+                self.histograms[phase].add(seconds * 1000)
+            if timer.total is not None:
+                self.histograms['total'].add(timer.total * 1000)
+        finally:
+            self.lock.release()
+
+    def as_dict(self):
+        self.lock.acquire()
+        try:
+            return {
+                'requests': self.requests,
+                'rows': self.rows,
+                'bytes': self.bytes,
+                'ms': dict([(phase, histogram.as_dict())
+                            for phase, histogram in self.histograms.items()]),
+            }
+        finally:
+            self.lock.release()
@@ -0,0 +1,292 @@
+"""WKB geometry decoding and encoding.
+
+Geometries selected as WKB are decoded with struct.unpack_from on the
+bytes returned by the database, reading each sequence of points in one
+call. decode() stores every sequence in a Coordinates object, a flat
+array('d') of the ordinates, instead of a Python list and a float object
+per ordinate. The ordinates are copied into the array once, through a
+buffer over the WKB bytes rather than a slice of them; decode_lists()
+builds the nested lists vectorformats and FeatureServer expect. Both produce GeoJSON style geometry dicts, which
+geojson() and encode() write back out, straight from the arrays. Points
+have 2, 3 (Z or M) or 4 (Z and M) ordinates; geometries with an M
+ordinate are marked with 'measured': True, which GeoJSON output drops.
+An empty point, written with NaN ordinates, decodes to None and is left
+out of multipoints and collections.
+
+Standard (OGC/ISO) WKB and PostGIS EWKB are read, in either byte order.
+"""
+
+import struct
+import sys
+from array import array
+from itertools import izip
+
+try:
+    import simplejson as json
+except ImportError:
+    import json
+
+TYPES = {1: 'Point', 2: 'LineString', 3: 'Polygon', 4: 'MultiPoint',
+         5: 'MultiLineString', 6: 'MultiPolygon', 7: 'GeometryCollection'}
+TYPE_CODES = dict([(name, code) for code, name in TYPES.items()])
+
+EWKB_Z = 0x80000000
+EWKB_M = 0x40000000
+EWKB_SRID = 0x20000000
+
+NATIVE = sys.byteorder == 'little' and '<' or '>'
+
+
+class Coordinates(object):
+    """A sequence of points stored as a flat array('d') of dims ordinates
+       per point. Indexing and iterating give the points as tuples, so the
+       geometry helpers written for lists of coordinates read it as
+       well."""
+
+    __slots__ = ('values', 'dims')
+
+    def __init__(self, values, dims=2):
+        self.values = values
+        self.dims = dims
+
+    def __len__(self):
+        return len(self.values) // self.dims
+
+    def __getitem__(self, index):
+        dims = self.dims
+        if isinstance(index, slice):
+            start, stop, step = index.indices(len(self))
+            if step != 1:
+                return [self[i] for i in range(start, stop, step)]
+            return Coordinates(self.values[start * dims:stop * dims], dims)
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return tuple(self.values[index * dims:(index + 1) * dims])
+
+    def __iter__(self):
+        values = iter(self.values)
+        return izip(*[values] * self.dims)
+
+    def __eq__(self, other):
+        return list(self) == [tuple(point) for point in other]
+
+    def __ne__(self, other):
+        return not self == other
+
+    def tolist(self):
+        return [list(point) for point in self]
+
+    def __repr__(self):
+        return 'Coordinates(%r)' % self.tolist()
+
+
+class Reader(object):
+    """Reads geometries from WKB data, starting at offset."""
+
+    def __init__(self, data, arrays=True):
+        self.data = data
+        self.offset = 0
+        self.arrays = arrays
+
+    def unpack(self, order, format, size):
+        values = struct.unpack_from(order + format, self.data, self.offset)
+        self.offset += size
+        return values
+
+    def points(self, order, count, dims):
+        """Read count points of dims ordinates."""
+        size = count * dims * 8
+        if self.arrays:
+            values = array('d')
+            values.fromstring(buffer(self.data, self.offset, size))
+            if order != NATIVE:
+                values.byteswap()
+            self.offset += size
+            return Coordinates(values, dims)
+        values = iter(self.unpack(order, '%dd' % (count * dims), size))
+        return [list(point) for point in zip(*[values] * dims)]
+
+    def geometry(self):
+        order = self.data[self.offset] == '\x01' and '<' or '>'
+        self.offset += 1
+        code, = self.unpack(order, 'I', 4)
+        z = m = False
+        if code & (EWKB_Z | EWKB_M | EWKB_SRID):
+            z = bool(code & EWKB_Z)
+            m = bool(code & EWKB_M)
+            if code & EWKB_SRID:
+                self.offset += 4
+            code &= 0xffff
+        elif code > 1000:
+            # ISO WKB: 1000 Z, 2000 M, 3000 ZM
+            z = code // 1000 in (1, 3)
+            m = code // 1000 in (2, 3)
+            code %= 1000
+        dims = 2 + z + m
+        gtype = TYPES.get(code)
+        if gtype is None:
+            raise ValueError("Unsupported WKB geometry type %d" % code)
+        if gtype == 'Point':
+            coordinates = list(self.unpack(order, '%dd' % dims, dims * 8))
+            if not [c for c in coordinates if c == c]:
+                # POINT EMPTY, all its ordinates are NaN
+                return None
+        elif gtype == 'LineString':
+            count, = self.unpack(order, 'I', 4)
+            coordinates = self.points(order, count, dims)
+        elif gtype == 'Polygon':
+            rings, = self.unpack(order, 'I', 4)
+            coordinates = []
+            for i in range(rings):
+                count, = self.unpack(order, 'I', 4)
+                coordinates.append(self.points(order, count, dims))
+        else:
+            parts, = self.unpack(order, 'I', 4)
+            members = [self.geometry() for i in range(parts)]
+            members = [member for member in members if member is not None]
+            if gtype == 'GeometryCollection':
+                geometry = {'type': gtype, 'geometries': members}
+                if m:
+                    geometry['measured'] = True
+                return geometry
+            coordinates = [member['coordinates'] for member in members]
+        geometry = {'type': gtype, 'coordinates': coordinates}
+        if m:
+            geometry['measured'] = True
+        return geometry
+
+
+def _bytes(data):
+    if isinstance(data, unicode):
+        return data.encode('latin-1')
+    return str(data)
+
+
+def decode(data):
+    """Decode WKB into a geometry dict with Coordinates sequences, None
+       for an empty point."""
+    return Reader(_bytes(data)).geometry()
+
+
+def decode_lists(data):
+    """Decode WKB into a geometry dict of nested lists, None for an empty
+       point."""
+    return Reader(_bytes(data), arrays=False).geometry()
+
+
+def _points(coords, drop=0):
+    """The points of a sequence as JSON arrays, without their last drop
+       ordinates."""
+    if isinstance(coords, Coordinates):
+        keep = coords.dims - drop
+        format = '[' + ','.join(['%r'] * keep) + ']'
+        if drop:
+            return '[' + ','.join([format % point[:keep]
+                                   for point in coords]) + ']'
+        return '[' + ','.join([format % point for point in coords]) + ']'
+    if drop:
+        return json.dumps([point[:len(point) - drop] for point in coords])
+    return json.dumps(coords)
+
+
+def geojson(geometry):
+    """Encode a geometry dict as GeoJSON text, writing Coordinates without
+       turning them into lists first. M ordinates have no place in
+       GeoJSON and are left out."""
+    gtype = geometry['type']
+    if gtype == 'GeometryCollection':
+        return '{"type": "GeometryCollection", "geometries": [%s]}' % \
+            ', '.join([geojson(g) for g in geometry['geometries']])
+    coords = geometry['coordinates']
+    drop = geometry.get('measured') and 1 or 0
+    if gtype == 'Point':
+        text = json.dumps(list(coords)[:len(coords) - drop])
+    elif gtype in ('LineString', 'MultiPoint'):
+        text = _points(coords, drop)
+    elif gtype in ('Polygon', 'MultiLineString'):
+        text = '[' + ','.join([_points(ring, drop) for ring in coords]) + ']'
+    else:
+        text = '[' + ','.join(['[' + ','.join([_points(ring, drop)
+                                               for ring in polygon]) + ']'
+                               for polygon in coords]) + ']'
+    return '{"type": "%s", "coordinates": %s}' % (gtype, text)
+
+
+def _dims(coords):
+    """Number of ordinates of the points of coords, 0 if empty."""
+    if isinstance(coords, Coordinates):
+        return coords.dims
+    if coords and isinstance(coords[0], (int, long, float)):
+        return len(coords)
+    for part in coords:
+        dims = _dims(part)
+        if dims:
+            return dims
+    return 0
+
+
+def _geometry_dims(geometry):
+    if geometry['type'] == 'GeometryCollection':
+        for member in geometry['geometries']:
+            dims = _geometry_dims(member)
+            if dims:
+                return dims
+        return 0
+    return _dims(geometry['coordinates'])
+
+
+def _write_points(out, coords):
+    if isinstance(coords, Coordinates):
+        values = coords.values
+        if NATIVE != '<':
+            values = array('d', values)
+            values.byteswap()
+        out.append(struct.pack('<I', len(coords)))
+        out.append(values.tostring())
+        return
+    out.append(struct.pack('<I', len(coords)))
+    for point in coords:
+        out.append(struct.pack('<%dd' % len(point), *point))
+
+
+def _write(out, geometry, flags):
+    gtype = geometry['type']
+    # ISO WKB: 1000 Z, 2000 M, 3000 ZM
+    out.append(struct.pack('<BI', 1, TYPE_CODES[gtype] + flags))
+    if gtype == 'GeometryCollection':
+        members = geometry['geometries']
+        out.append(struct.pack('<I', len(members)))
+        for member in members:
+            _write(out, member, flags)
+        return
+    coords = geometry['coordinates']
+    if gtype == 'Point':
+        out.append(struct.pack('<%dd' % len(coords), *coords))
+    elif gtype == 'LineString':
+        _write_points(out, coords)
+    elif gtype == 'Polygon':
+        out.append(struct.pack('<I', len(coords)))
+        for ring in coords:
+            _write_points(out, ring)
+    else:
+        member = gtype[5:]
+        out.append(struct.pack('<I', len(coords)))
+        for part in coords:
+            _write(out, {'type': member, 'coordinates': part}, flags)
+
+
+def encode(geometry):
+    """Encode a geometry dict as little endian (ISO) WKB, copying the
+       ordinates of Coordinates sequences as they are. A third ordinate
+       is Z unless the geometry is 'measured'."""
+    dims = _geometry_dims(geometry) or 2
+    m = geometry.get('measured') and 1 or 0
+    z = dims - 2 - m
+    if z not in (0, 1) or dims > 4:
+        raise ValueError("Cannot encode %d ordinates per point%s as WKB"
+                         % (dims, m and ' with M' or ''))
+    out = []
+    _write(out, geometry, z * 1000 + m * 2000)
+    return ''.join(out)
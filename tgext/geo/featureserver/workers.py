@@ -0,0 +1,55 @@
+"""Bounded thread pool for running datasource queries concurrently."""
+
+import Queue
+import sys
+import threading
+
+
+class ThreadPool(object):
+    """A fixed number of daemon threads, started on first use, running
+       functions on behalf of request threads."""
+
+    def __init__(self, size):
+        self.size = int(size)
+        self.tasks = Queue.Queue()
+        self.threads = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        self.lock.acquire()
+        try:
+            while len(self.threads) < self.size:
+                thread = threading.Thread(target=self.work)
+                thread.setDaemon(True)
+                thread.start()
+                self.threads.append(thread)
+        finally:
+            self.lock.release()
+
+    def work(self):
+        while True:
+            func, item, index, results = self.tasks.get()
+            try:
+                results.put((index, True, func(item)))
+            except:
+                results.put((index, False, sys.exc_info()))
+
+    def map(self, func, items):
+        """Return [func(item) for item in items], computed by the pool's
+           threads. The first exception raised by func is re-raised."""
+        if not self.threads:
+            self.start()
+        results = Queue.Queue()
+        for index, item in enumerate(items):
+            self.tasks.put((func, item, index, results))
+        values = [None] * len(items)
+        error = None
+        for i in range(len(items)):
+            index, ok, value = results.get()
+            if ok:
+                values[index] = value
+            elif error is None:
+                error = value
+        if error is not None:
+            raise error[0], error[1], error[2]
+        return values
@@ -0,0 +1,131 @@
+"""TileCache helpers for tgext.geo tilecache controllers."""
+
+from hashlib import md5
+import copy
+import os
+
+from TileCache.Service import Service, wsgiHandler
+
+from tgext.geo.cache import LRUCache
+
+
+def tileETag(cache, tile, data=None):
+    """ETag of tile as stored in cache, None if it is not cached. Disk
+    caches give it from the tile's file: its path, modification time and
+    size, so the tile is not read (it may be sent with X-SendFile) and a
+    tile rendered again gets a new one. Other caches hash the tile data,
+    read from the cache unless given as data."""
+    base = cache
+    if isinstance(cache, MemoryCache):
+        base = cache.cache
+    if base.__class__.__name__ == 'Disk':
+        path = base.getKey(tile)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        return '"%s"' % md5(repr((path, stat.st_mtime,
+                                  stat.st_size))).hexdigest()
+    if data is None:
+        data = cache.get(tile)
+    if not data:
+        return None
+    return '"%s"' % md5(data).hexdigest()
+
+
+def _matches(etag, environ):
+    ifNoneMatch = environ.get('HTTP_IF_NONE_MATCH', '')
+    return etag in [tag.strip() for tag in ifNoneMatch.split(',')]
+
+
+def conditionalHandler(environ, start_response, service, cacheControl=None):
+    """Serve a TileCache request like wsgiHandler, adding an ETag of the
+    tile (see tileETag) and the cacheControl Cache-Control header to
+    successful responses. A tile the client holds, as told by a matching
+    If-None-Match, is answered with 304 Not Modified before it would be
+    rendered or read."""
+    state = {}
+    def renderTile(tile, force=False):
+        if not force and environ.get('HTTP_IF_NONE_MATCH'):
+            etag = tileETag(service.cache, tile)
+            if etag is not None and _matches(etag, environ):
+                state['etag'] = etag
+                state['notModified'] = True
+                return (tile.layer.format(), '')
+        format, image = Service.renderTile(service, tile, force)
+        state['etag'] = tileETag(service.cache, tile, image)
+        return (format, image)
+    # a copy of the service rendering tiles through renderTile, for this
+    # request only
+    requestService = copy.copy(service)
+    requestService.renderTile = renderTile
+
+    captured = []
+    def capture(status, headers, exc_info=None):
+        captured[:] = [status, headers]
+        return lambda data: None
+    body = ''.join(wsgiHandler(environ, capture, requestService))
+    status, headers = captured
+    if status.startswith('200'):
+        etag = state.get('etag')
+        if etag is None and body:
+            etag = '"%s"' % md5(body).hexdigest()
+        headers = [h for h in headers
+                   if h[0].lower() not in ('etag', 'cache-control')]
+        if etag is not None:
+            headers.append(('ETag', etag))
+        if cacheControl:
+            headers.append(('Cache-Control', cacheControl))
+        if state.get('notModified') or (etag is not None
+                                        and _matches(etag, environ)):
+            start_response('304 Not Modified',
+                           [h for h in headers if h[0].lower() not in
+                            ('content-length', 'content-type',
+                             'x-sendfile')])
+            return []
+    start_response(status, headers)
+    return [body]
+
+
+class MemoryCache(object):
+    """In-process memory tier in front of a TileCache cache.
+
+    Tiles read from or written to the wrapped cache are kept in an LRU
+    cache bounded by max_bytes of tile data (and max_entries tiles, if
+    set). A single instance is shared by all the threads of a worker
+    process. Everything but get, set and delete, such as locking, is
+    handled by the wrapped cache.
+    """
+
+    def __init__(self, cache, max_bytes=64 * 1024 * 1024, max_entries=0):
+        self.cache = cache
+        self.memory = LRUCache(max_entries=max_entries, max_bytes=max_bytes)
+
+    def __getattr__(self, name):
+        return getattr(self.cache, name)
+
+    def key(self, tile):
+        return (tile.layer.name, tile.x, tile.y, tile.z)
+
+    def get(self, tile):
+        key = self.key(tile)
+        data = self.memory.get(key)
+        if data is None:
+            data = self.cache.get(tile)
+            if data:
+                self.memory.set(key, data, len(data))
+        return data
+
+    def set(self, tile, data):
+        data = self.cache.set(tile, data)
+        if data:
+            self.memory.set(self.key(tile), data, len(data))
+        return data
+
+    def delete(self, tile):
+        self.memory.delete(self.key(tile))
+        return self.cache.delete(tile)
+
+    def stats(self):
+        """Hit and miss counts and size of the memory tier."""
+        return self.memory.stats()